@@ -0,0 +1,98 @@
+"""
+双语段落插入阶段的基准测试
+
+分别测量旧的插入方式（每段都 list(parent).index() 查找位置，逐个属性复制格式）和
+DocumentTranslationResource.insert_paragraph_translation 在不同段落数下的耗时，
+用于确认插入阶段的耗时随段落数线性增长。
+
+用法:
+    python benchmarks/bench_insert.py --sizes 500 1000 2000 4000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+
+from main import DocumentTranslationResource, api
+
+
+def build_document(paragraph_count):
+    """生成包含指定数量段落的文档"""
+    doc = Document()
+    for i in range(paragraph_count):
+        doc.add_paragraph(f"第{i}段测试文本")
+    return doc
+
+
+def legacy_insert(doc, paragraphs_to_translate):
+    """旧的插入方式：从后往前遍历，每段都复制父元素的子节点列表查找位置"""
+    for paragraph, translated_text in reversed(paragraphs_to_translate):
+        p = doc.add_paragraph()
+        parent_element = paragraph._p.getparent()
+        index_in_parent = list(parent_element).index(paragraph._p)
+        parent_element.insert(index_in_parent + 1, p._p)
+
+        # 旧实现通过 python-docx 的属性代理逐项复制格式
+        run = p.add_run(translated_text)
+        if paragraph.style:
+            p.style = paragraph.style
+        if paragraph.alignment is not None:
+            p.alignment = paragraph.alignment
+        for orig_run in paragraph.runs:
+            if orig_run.font.size:
+                run.font.size = orig_run.font.size
+            if orig_run.font.name:
+                run.font.name = orig_run.font.name
+            if orig_run.font.bold:
+                run.font.bold = orig_run.font.bold
+            if orig_run.font.italic:
+                run.font.italic = orig_run.font.italic
+            if orig_run.font.underline:
+                run.font.underline = orig_run.font.underline
+            if orig_run.font.color and orig_run.font.color.rgb:
+                run.font.color.rgb = orig_run.font.color.rgb
+            if any([orig_run.font.bold, orig_run.font.italic, orig_run.font.underline, orig_run.font.size]):
+                break
+
+
+def linear_insert(doc, paragraphs_to_translate):
+    resource = DocumentTranslationResource(api=api)
+    for paragraph, translated_text in paragraphs_to_translate:
+        resource.insert_paragraph_translation(paragraph, translated_text)
+
+
+def measure(insert, paragraph_count):
+    doc = build_document(paragraph_count)
+    paragraphs_to_translate = [(p, f"translated {i}") for i, p in enumerate(doc.paragraphs)]
+    start = time.perf_counter()
+    insert(doc, paragraphs_to_translate)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="双语段落插入阶段基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 1000, 2000, 4000])
+    parser.add_argument("--skip-legacy", action="store_true", help="不测量旧的插入方式")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        row = {"paragraphs": size, "linear_seconds": measure(linear_insert, size)}
+        if not args.skip_legacy:
+            row["legacy_seconds"] = measure(legacy_insert, size)
+        row["linear_us_per_paragraph"] = row["linear_seconds"] / size * 1e6
+        results.append(row)
+        print(json.dumps(row))
+
+    # 线性增长时，每段耗时在不同规模下应基本保持不变
+    per_paragraph = [row["linear_us_per_paragraph"] for row in results]
+    print(json.dumps({"linear_growth_ratio": max(per_paragraph) / min(per_paragraph)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+文档翻译流水线的基准测试
+
+用 corpus.py 生成不同规模的合成文档，对进程内的桩服务（stub_server.py）运行完整的本地翻译流程，
+分别记录各阶段的耗时（load、collect、translate、insert、save，stream 引擎没有 load/insert 阶段），
+结果以 JSON 写入文件，便于在不同提交之间比较。
+
+每次运行都使用新的翻译记忆库，保证所有文本都会真正经过翻译请求。
+
+用法:
+    python benchmarks/bench_pipeline.py --scales small medium --engines docx stream --latency 0.05 \
+        --output bench_output.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+WORK_DIR = tempfile.mkdtemp(prefix="bench_pipeline_")
+# 导入 main 之前设置环境变量：只使用本地引擎，翻译记忆和术语表放在临时目录中，
+# 不使用检查点（否则上一次运行留下的检查点会让相同种子的文档跳过翻译请求）
+os.environ.setdefault("TRANSLATION_BACKEND", "local")
+os.environ.setdefault("TRANSLATION_MEMORY_PATH", os.path.join(WORK_DIR, "memory", "warmup.sqlite3"))
+os.environ.setdefault("GLOSSARY_DIR", os.path.join(WORK_DIR, "glossaries"))
+os.environ.setdefault("CHECKPOINT_ENABLED", "0")
+
+import main
+from corpus import SCALES, generate
+from stub_server import StubCompletionServer
+
+PHASES = ("download", "load", "collect", "translate", "insert", "save")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_once(resource, stub, input_path, engine, run_index):
+    """运行一次完整的翻译流程，返回耗时和统计信息"""
+    main.translation_memory = main.TranslationMemory(
+        os.path.join(WORK_DIR, "memory", f"{engine}_{run_index}_{time.time_ns()}.sqlite3")
+    )
+    output_path = os.path.join(WORK_DIR, f"output_{engine}.docx")
+    context = main.TranslationContext()
+    requests_before = stub.requests
+    start = time.perf_counter()
+    resource.translate_document(input_path, output_path, "英语", "", "bench-key", context, engine)
+    total = time.perf_counter() - start
+
+    timings = context.timing_summary()
+    stats = context.summary()
+    return {
+        "total_seconds": round(total, 4),
+        "phases": {phase: timings[phase] for phase in PHASES if phase in timings},
+        "upstream_requests": stub.requests - requests_before,
+        "segments": stats.get("segments_found", 0),
+        "segments_sent": stats.get("segments_sent", 0),
+        "untranslated": stats.get("untranslated", 0),
+        "output_bytes": os.path.getsize(output_path),
+    }
+
+
+def main_():
+    parser = argparse.ArgumentParser(description="文档翻译流水线基准测试")
+    parser.add_argument("--scales", choices=sorted(SCALES), nargs="+", default=["small", "medium"])
+    parser.add_argument("--engines", choices=main.TRANSLATION_ENGINES, nargs="+", default=list(main.TRANSLATION_ENGINES))
+    parser.add_argument("--latency", type=float, default=0.05, help="桩服务每个请求的延迟（秒）")
+    parser.add_argument("--repeat", type=int, default=1, help="每个组合重复运行的次数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="结果JSON文件路径，不传时只输出到标准输出")
+    args = parser.parse_args()
+
+    stub = StubCompletionServer(latency=args.latency)
+    main.API_URL = stub.start()
+    resource = main.DocumentTranslationResource(api=main.api)
+
+    results = []
+    for scale in args.scales:
+        input_path = os.path.join(WORK_DIR, f"{scale}.docx")
+        document = generate(input_path, seed=args.seed, **SCALES[scale])
+        for engine in args.engines:
+            for run_index in range(args.repeat):
+                row = {"scale": scale, "engine": engine, "run": run_index, "document": document}
+                row.update(run_once(resource, stub, input_path, engine, run_index))
+                results.append(row)
+                print(json.dumps(row, ensure_ascii=False), flush=True)
+    stub.stop()
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "latency": args.latency,
+            "packed_translation": main.Config.PACKED_TRANSLATION,
+            "max_concurrent_per_key": main.Config.UPSTREAM_MAX_CONCURRENT_PER_KEY,
+            "global_max_concurrent": main.Config.GLOBAL_MAX_CONCURRENT_REQUESTS,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,90 @@
+"""
+双语文档保存阶段的基准测试
+
+生成包含大量图片的文档，翻译后分别用 python-docx 的 Document.save（所有部件重新压缩）和
+DocumentTranslationResource.save_document（只重写改动过的部件，其余部件原样复制压缩数据）保存，
+比较耗时和CPU时间。翻译接口被替换为本地函数，不发送网络请求。
+
+用法:
+    python benchmarks/bench_save.py --images 20 50 --image-size 1024
+"""
+import argparse
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+
+from main import DocumentTranslationResource, api
+
+
+def build_png(size):
+    """生成一张随机噪点PNG图片（几乎无法再压缩，接近真实照片）"""
+    rows = b"".join(b"\x00" + os.urandom(size * 3) for _ in range(size))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b"")
+
+
+def build_document(path, image_count, image_size):
+    doc = Document()
+    for i in range(image_count):
+        doc.add_paragraph(f"第{i}张图片的说明文字")
+        doc.add_picture(io.BytesIO(build_png(image_size)))
+    doc.save(path)
+
+
+def translate_stub(resource):
+    async def batch_translate_texts(texts, *args, **kwargs):
+        return [f"translated {text}" for text in texts]
+
+    resource.batch_translate_texts = batch_translate_texts
+
+
+def measure(save, path):
+    start, cpu_start = time.perf_counter(), time.process_time()
+    save(path)
+    return time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="双语文档保存阶段基准测试")
+    parser.add_argument("--images", type=int, nargs="+", default=[20, 50])
+    parser.add_argument("--image-size", type=int, default=1024, help="图片边长（像素）")
+    args = parser.parse_args()
+
+    resource = DocumentTranslationResource(api=api)
+    translate_stub(resource)
+    with tempfile.TemporaryDirectory() as workdir:
+        for image_count in args.images:
+            input_path = os.path.join(workdir, f"images_{image_count}.docx")
+            build_document(input_path, image_count, args.image_size)
+            doc = resource.process_docx(input_path, "英语", "")
+
+            full_seconds, full_cpu = measure(doc.save, os.path.join(workdir, "full.docx"))
+            passthrough_seconds, passthrough_cpu = measure(
+                lambda path: resource.save_document(doc, input_path, path), os.path.join(workdir, "passthrough.docx")
+            )
+            print(json.dumps({
+                "images": image_count,
+                "input_mb": round(os.path.getsize(input_path) / 1024 / 1024, 2),
+                "full_save_seconds": full_seconds,
+                "full_save_cpu_seconds": full_cpu,
+                "passthrough_seconds": passthrough_seconds,
+                "passthrough_cpu_seconds": passthrough_cpu,
+                "speedup": full_seconds / passthrough_seconds,
+            }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+基准测试用的合成 .docx 文档生成器
+
+按规模生成包含普通段落、M×K 表格（含合并单元格）、多样式文本片段和嵌入图片的文档，
+文本内容是带编号的中文句子，保证不会被翻译记忆或术语表直接命中。
+
+用法:
+    python benchmarks/corpus.py --output /tmp/corpus --scale medium
+"""
+import argparse
+import io
+import json
+import os
+import random
+import struct
+import zlib
+
+from docx import Document
+from docx.shared import Inches, Pt, RGBColor
+
+# 预设规模：段落数、表格数、每个表格的行数和列数、图片数、图片边长（像素）
+SCALES = {
+    "small": {"paragraphs": 50, "tables": 2, "rows": 5, "cols": 4, "images": 1, "image_size": 128},
+    "medium": {"paragraphs": 500, "tables": 10, "rows": 10, "cols": 6, "images": 5, "image_size": 512},
+    "large": {"paragraphs": 2000, "tables": 40, "rows": 20, "cols": 8, "images": 20, "image_size": 1024},
+}
+
+SENTENCES = [
+    "本制度适用于公司全体员工",
+    "各部门应当按照规定的流程办理审批手续",
+    "财务部负责对报销单据进行复核",
+    "未经批准不得擅自变更合同条款",
+    "发生安全事故时应立即上报并保护现场",
+    "年度考核结果作为奖金发放的依据",
+]
+
+
+def sentence(rng, index):
+    """生成一句带编号的中文文本"""
+    return f"{rng.choice(SENTENCES)}（第{index}条）。"
+
+
+def build_png(size, rng):
+    """生成一张随机噪点PNG图片"""
+    rows = b"".join(b"\x00" + rng.randbytes(size * 3) for _ in range(size))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b"")
+
+
+def add_formatted_paragraph(doc, rng, index):
+    """添加一个由多个不同格式的文本片段组成的段落"""
+    paragraph = doc.add_paragraph()
+    for part in range(rng.randint(1, 4)):
+        run = paragraph.add_run(sentence(rng, f"{index}-{part}"))
+        run.bold = rng.random() < 0.3
+        run.italic = rng.random() < 0.2
+        run.underline = rng.random() < 0.1
+        run.font.size = Pt(rng.choice([10, 10.5, 12, 14]))
+        if rng.random() < 0.2:
+            run.font.color.rgb = RGBColor(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    return paragraph
+
+
+def add_table(doc, rng, index, rows, cols):
+    """添加一个 rows×cols 的表格，第一行横向合并前两列，第一列纵向合并前两行"""
+    table = doc.add_table(rows=rows, cols=cols)
+    table.style = "Table Grid"
+    # 合并之前逐行填充，避免 table.cell() 每次都重新计算整个表格的网格
+    for r, row in enumerate(table.rows):
+        for c, cell in enumerate(row.cells):
+            cell.text = f"表{index}第{r}行第{c}列内容"
+    if cols >= 2:
+        table.cell(0, 0).merge(table.cell(0, 1))
+    if rows >= 3:
+        table.cell(1, 0).merge(table.cell(2, 0))
+    return table
+
+
+def generate(path, paragraphs, tables, rows, cols, images, image_size, seed=0):
+    """
+    生成一个合成文档
+
+    Returns:
+        文档的规模描述
+    """
+    rng = random.Random(seed)
+    doc = Document()
+    doc.sections[0].header.paragraphs[0].text = "合成基准测试文档页眉"
+    doc.sections[0].footer.paragraphs[0].text = "合成基准测试文档页脚"
+
+    # 表格和图片均匀穿插在段落之间
+    table_every = max(1, paragraphs // (tables + 1)) if tables else None
+    image_every = max(1, paragraphs // (images + 1)) if images else None
+    table_count = image_count = 0
+    for i in range(paragraphs):
+        add_formatted_paragraph(doc, rng, i)
+        if table_every and (i + 1) % table_every == 0 and table_count < tables:
+            add_table(doc, rng, table_count, rows, cols)
+            table_count += 1
+        if image_every and (i + 1) % image_every == 0 and image_count < images:
+            doc.add_picture(io.BytesIO(build_png(image_size, rng)), width=Inches(2))
+            image_count += 1
+    for index in range(table_count, tables):
+        add_table(doc, rng, index, rows, cols)
+    for _ in range(image_count, images):
+        doc.add_picture(io.BytesIO(build_png(image_size, rng)), width=Inches(2))
+    doc.save(path)
+
+    return {
+        "paragraphs": paragraphs,
+        "tables": tables,
+        "rows": rows,
+        "cols": cols,
+        "images": images,
+        "image_size": image_size,
+        "bytes": os.path.getsize(path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成基准测试用的合成 .docx 文档")
+    parser.add_argument("--output", required=True, help="输出目录")
+    parser.add_argument("--scale", choices=sorted(SCALES), nargs="+", default=sorted(SCALES))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    for scale in args.scale:
+        path = os.path.join(args.output, f"{scale}.docx")
+        print(json.dumps({"scale": scale, "path": path, **generate(path, seed=args.seed, **SCALES[scale])}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+基准测试用的进程内 chat completion 桩服务
+
+在独立线程的事件循环中运行一个 aiohttp 服务，模拟 /v1/chat/completions 接口：
+单段请求返回 "[译]原文"，打包请求（{"segments": [...]}）按编号返回结构化结果。
+每个请求先等待固定延迟，用于模拟上游模型的响应时间。
+"""
+import asyncio
+import json
+import threading
+
+from aiohttp import web
+
+
+class StubCompletionServer:
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._loop = None
+        self._runner = None
+        self._started = threading.Event()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def handle(self, request):
+        data = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        content = data["messages"][-1]["content"]
+        try:
+            payload = json.loads(content)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and isinstance(payload.get("segments"), list):
+            content = json.dumps({
+                "translations": [{"id": segment["id"], "text": f"[译]{segment['text']}"} for segment in payload["segments"]]
+            }, ensure_ascii=False)
+        else:
+            content = f"[译]{content}"
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+    def start(self):
+        """在后台线程中启动服务，返回服务地址"""
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self._loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._runner = web.AppRunner(app)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, self.host, self.port)
+            self._loop.run_until_complete(site.start())
+            # 端口为0时使用系统分配的端口
+            self.port = self._runner.addresses[0][1]
+            self._started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, name="stub-completion-server", daemon=True).start()
+        self._started.wait()
+        return self.url
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
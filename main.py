@@ -1,25 +1,50 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, has_request_context, Response
 import requests
 from flask_restx import Api, Resource, fields
-import traceback
 import logging
 import base64
 import os
 import tempfile
 import uuid
+import zipfile
 import shutil
+import struct
 from docx import Document
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
 import openai
 import io
+import copy
+import difflib
 import json
 import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
 import aiohttp
 import re
 import time
 import urllib.parse
+import hashlib
+import heapq
+import itertools
+import queue
+import random
+import sys
+import email.utils
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
 from typing import List, Dict, Any
 from lxml import etree
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import FileWrapper
 from datetime import datetime
 
 # 导入腾讯云OCR SDK
@@ -30,7 +55,7 @@ try:
     from tencentcloud.common.profile.http_profile import HttpProfile
     from tencentcloud.ocr.v20181119 import ocr_client, models
 except ImportError:
-    print("请安装腾讯云SDK: pip install tencentcloud-sdk-python")
+    logging.getLogger("monkey_tools_deyong").warning("请安装腾讯云SDK: pip install tencentcloud-sdk-python")
 
 app = Flask(__name__, static_folder=None)
 api = Api(
@@ -53,6 +78,220 @@ class Config:
     FILE_ACCESS_URL_PREFIX = "http://localhost:5001/files/"
     # 文件过期时间（秒）
     FILE_EXPIRY_SECONDS = 3600 * 24 * 7  # 7天
+    # 翻译记忆库（持久化翻译缓存）文件路径，同一台机器上的所有worker进程共享
+    TRANSLATION_MEMORY_PATH = os.environ.get(
+        'TRANSLATION_MEMORY_PATH',
+        os.path.join(os.path.dirname(os.path.dirname(__file__)), 'translation_cache', 'translation_memory.sqlite3')
+    )
+    # 进程内LRU缓存的最大条目数
+    TRANSLATION_MEMORY_LRU_SIZE = int(os.environ.get('TRANSLATION_MEMORY_LRU_SIZE', 10000))
+    # 文档翻译检查点：是否启用、SQLite文件路径、未完成的检查点保留时间（秒）
+    CHECKPOINT_ENABLED = os.environ.get('CHECKPOINT_ENABLED', '1') == '1'
+    CHECKPOINT_PATH = os.environ.get(
+        'CHECKPOINT_PATH',
+        os.path.join(os.path.dirname(os.path.dirname(__file__)), 'translation_cache', 'checkpoints.sqlite3')
+    )
+    CHECKPOINT_TTL = int(os.environ.get('CHECKPOINT_TTL', 3600 * 24 * 7))
+    # 是否启用多段打包翻译
+    PACKED_TRANSLATION = os.environ.get('PACKED_TRANSLATION', '1') == '1'
+    # 打包翻译每次请求的原文token预算
+    PACKED_MAX_TOKENS = int(os.environ.get('PACKED_MAX_TOKENS', 1500))
+    # 超过该长度的段落不参与打包，单独请求
+    PACKED_SEGMENT_MAX_CHARS = int(os.environ.get('PACKED_SEGMENT_MAX_CHARS', 200))
+    # 超过该token数的段落在句子边界拆分后并发翻译，0表示不拆分
+    SPLIT_SEGMENT_MAX_TOKENS = int(os.environ.get('SPLIT_SEGMENT_MAX_TOKENS', 300))
+    # 共享连接池的总连接数上限和单个主机的连接数上限
+    HTTP_POOL_LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', 100))
+    HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', 30))
+    # DNS缓存时间和空闲连接保活时间（秒）
+    HTTP_DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', 300))
+    HTTP_KEEPALIVE_TIMEOUT = int(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 60))
+    # 单次上游请求的总超时时间（秒）
+    HTTP_TIMEOUT = int(os.environ.get('HTTP_TIMEOUT', 300))
+    # 整个进程同时发往上游LLM的请求数上限，以及每个API密钥的并发上限
+    GLOBAL_MAX_CONCURRENT_REQUESTS = int(os.environ.get('GLOBAL_MAX_CONCURRENT_REQUESTS', 30))
+    UPSTREAM_MAX_CONCURRENT_PER_KEY = int(os.environ.get('UPSTREAM_MAX_CONCURRENT_PER_KEY', 10))
+    # 团队在公平排队中的权重，格式为 "团队ID:权重,团队ID:权重"，未配置的团队权重为1
+    UPSTREAM_TEAM_WEIGHTS = os.environ.get('UPSTREAM_TEAM_WEIGHTS', '')
+    # 上游请求重试：单次请求最多尝试次数、退避基数和上限（秒）、每个文档的重试预算
+    RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 5))
+    RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.5))
+    RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 30))
+    RETRY_BUDGET_PER_DOCUMENT = int(os.environ.get('RETRY_BUDGET_PER_DOCUMENT', 200))
+    # 默认的本地翻译引擎（docx 或 stream），可以在请求中通过 engine 参数覆盖
+    TRANSLATION_ENGINE = os.environ.get('TRANSLATION_ENGINE', 'docx')
+    # 异步翻译任务的后台线程数、最多排队的任务数，以及已完成任务的保留时间（秒）
+    TRANSLATION_JOB_WORKERS = int(os.environ.get('TRANSLATION_JOB_WORKERS', 4))
+    TRANSLATION_JOB_MAX_PENDING = int(os.environ.get('TRANSLATION_JOB_MAX_PENDING', 500))
+    TRANSLATION_JOB_TTL = int(os.environ.get('TRANSLATION_JOB_TTL', 3600 * 24))
+    # 批量翻译：单次请求最多的文档数，以及同时下载和翻译的文档数
+    BATCH_MAX_DOCUMENTS = int(os.environ.get('BATCH_MAX_DOCUMENTS', 100))
+    BATCH_DOCUMENT_CONCURRENCY = int(os.environ.get('BATCH_DOCUMENT_CONCURRENCY', 8))
+    # 保存双语文档时重新压缩改动过的XML部件所用的 deflate 压缩级别（0-9），未改动的部件原样复制
+    DOCX_COMPRESS_LEVEL = int(os.environ.get('DOCX_COMPRESS_LEVEL', 6))
+    # 文档翻译后端：sidecar 只使用5005端口的翻译服务，local 只使用本地引擎，auto 优先翻译服务、失败时回退本地
+    TRANSLATION_BACKEND = os.environ.get('TRANSLATION_BACKEND', 'auto')
+    # 翻译服务（sidecar）的地址、健康检查地址，以及连接和读取超时（秒）
+    SIDECAR_URL = os.environ.get('SIDECAR_URL', 'http://localhost:5005')
+    SIDECAR_HEALTH_URL = os.environ.get('SIDECAR_HEALTH_URL', SIDECAR_URL + '/')
+    SIDECAR_CONNECT_TIMEOUT = float(os.environ.get('SIDECAR_CONNECT_TIMEOUT', 3))
+    SIDECAR_READ_TIMEOUT = float(os.environ.get('SIDECAR_READ_TIMEOUT', 600))
+    # 翻译服务连续失败多少次后熔断，熔断期间健康检查的间隔（秒）
+    SIDECAR_FAILURE_THRESHOLD = int(os.environ.get('SIDECAR_FAILURE_THRESHOLD', 3))
+    SIDECAR_PROBE_INTERVAL = float(os.environ.get('SIDECAR_PROBE_INTERVAL', 30))
+    # 术语表目录（每种目标语言一个 .json 或 .tsv 文件），以及检查文件变化的最短间隔（秒）
+    GLOSSARY_DIR = os.environ.get(
+        'GLOSSARY_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'glossaries')
+    )
+    GLOSSARY_RELOAD_INTERVAL = float(os.environ.get('GLOSSARY_RELOAD_INTERVAL', 5))
+    # 不含中文字符的文本（例如已经是目标语言的文本）是否原样保留；数字、日期、编号等始终原样保留
+    SKIP_TEXT_WITHOUT_SOURCE_SCRIPT = os.environ.get('SKIP_TEXT_WITHOUT_SOURCE_SCRIPT', '1') == '1'
+    # 追踪span的导出方式：none 不导出（默认），file 追加写入JSONL文件，otlp 以 OTLP/HTTP JSON 发送到收集器
+    TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'none')
+    TRACE_FILE_PATH = os.environ.get(
+        'TRACE_FILE_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'traces', 'spans.jsonl')
+    )
+    # file 模式下JSONL文件的大小上限（字节），超过后改名为 <文件名>.1（覆盖上一个备份）并重新开始写入
+    TRACE_FILE_MAX_BYTES = int(os.environ.get('TRACE_FILE_MAX_BYTES', 100 * 1024 * 1024))
+    TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+    # 等待导出的span数上限，超过后丢弃新的span，不阻塞请求
+    TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', 10000))
+    # 日志级别、格式（json 结构化日志或 text 纯文本）、等待输出的日志条数上限
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+    # 逐段文本的日志（发送请求、翻译成功等）的采样比例，0-1
+    LOG_SEGMENT_SAMPLE_RATE = float(os.environ.get('LOG_SEGMENT_SAMPLE_RATE', 0.01))
+    # 服务模式：wsgi 使用 Werkzeug 服务器，asgi 使用 uvicorn，工具接口直接在服务器的事件循环中执行
+    SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+    # ASGI 模式下执行其余（同步）接口的线程数
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+    # ASGI 模式下 /metrics、/manifest.json 使用的独立线程数，不和其他同步接口排队
+    ASGI_CONTROL_THREADS = int(os.environ.get('ASGI_CONTROL_THREADS', 4))
+    # ASGI 模式下文件下载每次读取并交给事件循环发送的字节数
+    ASGI_FILE_CHUNK_SIZE = int(os.environ.get('ASGI_FILE_CHUNK_SIZE', 256 * 1024))
+    # ASGI 服务关闭时等待正在处理的同步接口请求完成的最长时间（秒）
+    ASGI_SHUTDOWN_TIMEOUT = float(os.environ.get('ASGI_SHUTDOWN_TIMEOUT', 30))
+
+# 当前的追踪span，日志记录中的 trace_id 和工作流ID也从这里读取
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    把日志记录格式化为一行JSON
+
+    除了时间、级别和消息外，还包括当前span的 trace_id/span_id、工作流ID，
+    以及通过 extra 传入的结构化字段。
+    """
+
+    # LogRecord 自带的属性，其余属性都是 extra 传入的字段
+    RESERVED = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "sampled"}
+
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED and value is not None:
+                data[key] = value
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class QueueLogHandler(logging.Handler):
+    """
+    非阻塞的日志处理器：调用线程只做一次入队，由后台线程写到目标处理器
+
+    事件循环和翻译热路径不会因为标准输出的写入而阻塞；队列满时丢弃日志并计数。
+    """
+
+    def __init__(self, target, queue_size):
+        super().__init__()
+        self.target = target
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            # fork 出的子进程不会继承输出线程，需要重新创建
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def emit(self, record):
+        # 在调用线程中确定消息、异常堆栈和追踪信息，后台线程只负责输出
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        span = current_span.get()
+        if span is not None:
+            record.trace_id = span.trace_id
+            record.span_id = span.span_id
+            for key, value in span.tags.items():
+                setattr(record, key, value)
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped_total.inc()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                self.target.handle(record)
+            except Exception:
+                pass
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """等待已入队的日志全部输出"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.join()
+        self.target.flush()
+
+
+class SegmentSampleFilter(logging.Filter):
+    """按比例采样逐段文本的日志（extra={"sampled": True}），其余日志全部保留"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, "sampled", False) or random.random() < self.rate
+
+
+def configure_logging():
+    """配置服务日志：结构化JSON（或纯文本）、按级别过滤、逐段日志采样、后台线程输出"""
+    target = logging.StreamHandler(sys.stdout)
+    if Config.LOG_FORMAT == "text":
+        target.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    else:
+        target.setFormatter(JsonLogFormatter())
+    handler = QueueLogHandler(target, Config.LOG_QUEUE_SIZE)
+    service_logger = logging.getLogger("monkey_tools_deyong")
+    service_logger.handlers = [handler]
+    service_logger.filters = [SegmentSampleFilter(Config.LOG_SEGMENT_SAMPLE_RATE)]
+    service_logger.setLevel(Config.LOG_LEVEL)
+    service_logger.propagate = False
+    atexit.register(handler.flush)
+    return service_logger
+
+
+logger = configure_logging()
     
 # 尝试从环境变量或配置文件加载配置
 try:
@@ -63,17 +302,35 @@ try:
     elif os.environ.get('FILE_ACCESS_URL_PREFIX'):
         Config.FILE_ACCESS_URL_PREFIX = os.environ.get('FILE_ACCESS_URL_PREFIX')
     
-    print(f"文件访问URL前缀: {Config.FILE_ACCESS_URL_PREFIX}")
+    logger.info("文件访问URL前缀: %s", Config.FILE_ACCESS_URL_PREFIX)
 except Exception as e:
-    print(f"加载配置失败: {str(e)}")
+    logger.error("加载配置失败: %s", e)
 
-# 设置异步翻译的最大并发请求数
-MAX_CONCURRENT_REQUESTS = 10
-# 每批处理的文本数量
+# 本地翻译引擎：docx 使用 python-docx 对象模型，stream 使用流式 OOXML 引擎
+TRANSLATION_ENGINES = ("docx", "stream")
+# 文档翻译后端
+TRANSLATION_BACKENDS = ("sidecar", "local", "auto")
+# 追踪span的导出方式
+TRACE_EXPORTERS = ("file", "otlp", "none")
+# 写入span标签的工作流请求头（标签名: 请求头）
+WORKFLOW_HEADERS = {
+    "app_id": "x-monkeys-appid",
+    "user_id": "x-monkeys-userid",
+    "team_id": "x-monkeys-teamid",
+    "workflow_id": "x-monkeys-workflowid",
+    "workflow_instance_id": "x-monkeys-workflow-instanceid",
+}
+
+# 每批处理的文本数量（打包翻译时一次请求最多包含的段落数）
 BATCH_SIZE = 20
+# 打包请求没有拿到响应（网络错误、非200状态、重试用尽）时 translate_packed_async 的返回值，
+# 与响应校验失败（None）区分：只有校验失败才拆分为单段请求
+PACKED_REQUEST_FAILED = object()
 
 # 设置API密钥和URL
 API_URL = "https://api.cursorai.art"
+# 翻译使用的模型
+TRANSLATION_MODEL = "gpt-4o"
 DIFY_API_URL = "https://api.dify.ai/v1"
 
 # 特定词语的固定翻译
@@ -126,6 +383,11 @@ SPECIAL_TRANSLATIONS = {
     "公司": "Công ty",
     "人事部": "Phòng nhân sự"
 }
+# SPECIAL_TRANSLATIONS 作为内置的越南语术语表，适用于以下目标语言名称。
+# 其中的单字数字单位和常用词出现在句子中间时不一定是术语（例如"千万不要"），只在整段文本完全相同时使用
+VIETNAMESE_LANGUAGE_NAMES = ("越南语", "越南文", "越南", "Vietnamese", "vi", "vi-VN", "Tiếng Việt")
+# 注入提示词的术语的最短长度，更短的术语（单字）只用于整段文本的精确匹配
+GLOSSARY_MIN_INJECTED_TERM_LENGTH = 2
 
 # 创建上传文件的目录
 UPLOAD_FOLDER = 'uploads'
@@ -134,171 +396,2518 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 限制上传文件大小为16MB
 app.config['OUTPUT_FILES_DIR'] = Config.OUTPUT_FILES_DIR
 
-ai_translation_ns = api.namespace("ai_translation", description="Document Translation API")
-ocr_ns = api.namespace("ocr", description="腾讯云OCR API")
-dify_ns = api.namespace("dify", description="Dify API")
-inference_ns = api.namespace("inference", description="Inference API")
 
-# Define document translation request and response models
-document_translation_request = ai_translation_ns.model(
-    "DocumentTranslationRequest",
-    {
-        "url": fields.String(required=True, description="URL of the document to translate"),
-        "target_language": fields.String(required=True, description="Target language for translation"),
-        "special_requirements": fields.String(required=False, description="Special requirements for translation"),
-        "api_key": fields.String(required=False, description="API key for translation service")
-    }
+class Metric:
+    """
+    Prometheus 指标的基类，按标签值分别计数
+
+    更新只需要一次加锁和一次字典操作，可以放在逐段翻译的热路径上。
+    """
+
+    type_name = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def format_labels(names, values, extra=()):
+        pairs = list(zip(names, values)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{name}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def samples(self):
+        """返回 (后缀, 标签值, 额外标签, 数值) 的列表"""
+        with self._lock:
+            return [("", key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, key, extra, value in self.samples():
+            value = repr(float(value)) if isinstance(value, float) else str(value)
+            lines.append(f"{self.name}{suffix}{self.format_labels(self.labels, key, extra)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, *label_values, value=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+
+class Gauge(Metric):
+    """数值在导出时通过回调函数读取，回调返回 {标签值元组: 数值}"""
+
+    type_name = "gauge"
+
+    def __init__(self, name, description, labels=(), callback=None):
+        super().__init__(name, description, labels)
+        self.callback = callback
+
+    def samples(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning("读取指标 %s 失败: %s", self.name, e)
+            return []
+        return [("", key, (), value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # 每个桶的计数（最后一个是 +Inf）、总和
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            snapshot = [(key, list(state[0]), state[1]) for key, state in self._values.items()]
+        samples = []
+        for key, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", key, (("le", "+Inf" if bound == float("inf") else f"{bound:g}"),), cumulative))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """进程内的指标注册表，按 Prometheus 文本格式导出"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=(), callback=None):
+        return self.register(Gauge(name, description, labels, callback))
+
+    def histogram(self, name, description, labels=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+# HTTP 接口
+HTTP_NAMESPACES = ("ai_translation", "ocr", "dify", "inference", "files", "metrics")
+http_requests_total = metrics.counter(
+    "http_requests_total", "HTTP requests handled, by namespace, method and status", ("namespace", "method", "status")
+)
+http_request_duration_seconds = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by namespace", ("namespace",)
+)
+# 上游服务（翻译模型、Dify、推理、翻译服务sidecar、腾讯云OCR）
+upstream_requests_total = metrics.counter(
+    "upstream_requests_total", "Upstream calls by backend and status code", ("backend", "status")
+)
+upstream_request_duration_seconds = metrics.histogram(
+    "upstream_request_duration_seconds", "Upstream call latency by backend", ("backend",)
 )
+# 翻译过程中的事件，与 TranslationContext 的统计项同名（segments_done、memory_hits 等）
+translation_events_total = metrics.counter(
+    "translation_events_total", "Translation pipeline events, named like the per-document stats", ("event",)
+)
+translation_memory_lookups_total = metrics.counter(
+    "translation_memory_lookups_total", "Translation memory lookups by result (lru, sqlite, miss)", ("result",)
+)
+documents_translated_total = metrics.counter(
+    "documents_translated_total", "Documents translated by engine and outcome", ("engine", "outcome")
+)
+bytes_downloaded_total = metrics.counter("bytes_downloaded_total", "Bytes of source documents downloaded")
+bytes_served_total = metrics.counter("bytes_served_total", "Bytes of translated files served from /files")
 
-document_translation_response = ai_translation_ns.model(
-    "DocumentTranslationResponse",
-    {
-        "message": fields.String(description="Response message"),
-        "document_url": fields.String(description="URL to the translated document"),
-        "error": fields.String(description="Error message if any")
-    }
+
+def http_namespace(path):
+    """请求路径所属的命名空间，未知路径归为 other，避免标签数量无限增长"""
+    namespace = path.strip("/").split("/", 1)[0]
+    return namespace if namespace in HTTP_NAMESPACES else "other"
+
+
+trace_spans_dropped_total = metrics.counter(
+    "trace_spans_dropped_total", "Tracing spans dropped because the export queue was full"
+)
+log_records_dropped_total = metrics.counter(
+    "log_records_dropped_total", "Log records dropped because the log queue was full"
 )
 
-class NoSuccessfulRequestLoggingFilter(logging.Filter):
-    def filter(self, record):
-        return "GET /" not in record.getMessage()
 
-# 获取 Flask 的默认日志记录器
-log = logging.getLogger("werkzeug")
-# 创建并添加过滤器
-log.addFilter(NoSuccessfulRequestLoggingFilter())
+class Span:
+    """
+    一个处理阶段的追踪span
 
-@app.before_request
-def before_request():
-    request.app_id = request.headers.get("x-monkeys-appid")
-    request.user_id = request.headers.get("x-monkeys-userid")
-    request.team_id = request.headers.get("x-monkeys-teamid")
-    request.workflow_id = request.headers.get("x-monkeys-workflowid")
-    request.workflow_instance_id = request.headers.get("x-monkeys-workflow-instanceid")
+    同一个工作流运行（x-monkeys-workflow-instanceid）中的所有工具调用共享同一个 trace_id，
+    工作流相关的ID作为 tags 从父span继承到所有子span。
+    """
 
-# 添加静态文件托管路由
-@app.route('/files/<path:filename>')
-def serve_file(filename):
-    """提供对文件的访问"""
-    return send_file(os.path.join(Config.OUTPUT_FILES_DIR, filename))
+    def __init__(self, name, trace_id, parent_id=None, tags=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.tags = tags or {}
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
 
-@api.errorhandler(Exception)
-def handle_exception(error):
-    return {"message": str(error)}, 500
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
 
-@app.get("/manifest.json")
-def get_manifest():
-    return {
-        "schema_version": "v1",
-        "display_name": "Deyong",
-        "namespace": "monkey_tools_deyong",
-        "auth": {"type": "none"},
-        "api": {"type": "openapi", "url": "/swagger.json"},
-        "contact_email": "dev@inf-monkeys.com",
-        "categories": ["ai", "translation", "document"],
-        "description": {
-            "zh-CN": "Deyong Tools",
-            "en-US": "Deyong Tools"
-        },
-        "icon": "emoji:📄:#3a8fe5",
-        "credentials": [
-            {
-                "name": "cursor-ai",
-                "type": "aksk",
-                "displayName": {
-                    "zh-CN": "Cursor AI",
-                    "en-US": "Cursor AI"
-                },
-                "iconUrl": "emoji:🤖:#3a8fe5",
-                "properties": [
-                    {
-                        "displayName": {
-                            "zh-CN": "从 Cursor AI 获取你的 API Key",
-                            "en-US": "Get your API Key from Cursor AI"
-                        },
-                        "type": "notice",
-                        "name": "docs"
-                    },
-                    {
-                        "displayName": {
-                            "zh-CN": "API Key",
-                            "en-US": "API Key"
-                        },
-                        "type": "string",
-                        "name": "api_key",
-                        "required": True
-                    }
-                ]
-            },
-            {
-                "name": "dify",
-                "type": "aksk",
-                "displayName": {
-                    "zh-CN": "Dify",
-                    "en-US": "Dify"
-                },
-                "iconUrl": "https://dify.ai/favicon.ico",
-                "properties": [
-                    {
-                        "displayName": {
-                            "zh-CN": "从 [Dify](https://dify.ai) 获取你的 API Key",
-                            "en-US": "Get your API Key from [Dify](https://dify.ai)"
-                        },
-                        "type": "notice",
-                        "name": "docs"
-                    },
-                    {
-                        "displayName": {
-                            "zh-CN": "API Key",
-                            "en-US": "API Key"
-                        },
-                        "type": "string",
-                        "name": "api_key",
-                        "required": True
-                    }
-                ]
+    def set_error(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "tags": self.tags,
+            "attributes": self.attributes,
+        }
+
+    @staticmethod
+    def otlp_value(value):
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def to_otlp(self):
+        """转换为 OTLP/HTTP JSON 格式的span"""
+        attributes = {**{f"monkeys.{key}": value for key, value in self.tags.items()}, **self.attributes}
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": self.otlp_value(value)} for key, value in attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class SpanExporter:
+    """
+    在后台线程中批量导出已结束的span，请求线程只做一次不阻塞的入队
+    """
+
+    def __init__(self, mode, file_path, otlp_endpoint, queue_size, batch_size=256, interval=2.0, file_max_bytes=0):
+        self.mode = mode if mode in TRACE_EXPORTERS else "none"
+        self.file_path = file_path
+        # 文件大小上限，0表示不限制
+        self.file_max_bytes = file_max_bytes
+        self.otlp_endpoint = otlp_endpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            # fork 出的子进程不会继承导出线程，需要重新创建
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def export(self, span):
+        if self.mode == "none":
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            trace_spans_dropped_total.inc()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.warning("导出追踪span失败: %s", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, spans):
+        if self.mode == "file":
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self._rotate()
+            with open(self.file_path, "a", encoding="utf-8") as f:
+                for span in spans:
+                    f.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+        elif self.mode == "otlp":
+            payload = {
+                "resourceSpans": [{
+                    "resource": {"attributes": [
+                        {"key": "service.name", "value": {"stringValue": "monkey-tools-deyong"}}
+                    ]},
+                    "scopeSpans": [{"scope": {"name": "monkey_tools_deyong"}, "spans": [span.to_otlp() for span in spans]}],
+                }]
             }
-        ]
-    }
+            response = requests.post(self.otlp_endpoint, json=payload, timeout=5)
+            response.raise_for_status()
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    file_base64 = None
-    file_type = None
-    
-    # 检查是否是从本地上传的文件
-    if 'file' in request.files and request.files['file'].filename != '':
-        file = request.files['file']
-        
-        # 获取文件类型
-        file_type = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
-        if file_type not in ['jpg', 'jpeg', 'png', 'bmp', 'pdf']:
-            return jsonify({'error': '不支持的文件类型'}), 400
-        
-        # 保存文件
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        
-        # 将文件转换为base64编码
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-            file_base64 = base64.b64encode(file_content).decode('utf-8')
-        
-        # 删除临时文件
-        os.remove(file_path)
-        
-    # 检查是否提供了CDN URL
-    elif 'cdn_url' in request.form and request.form['cdn_url'] != '':
-        cdn_url = request.form['cdn_url']
-        
+    def _rotate(self):
+        """文件超过大小上限时改名为备份文件，只保留一个备份"""
+        if self.file_max_bytes <= 0:
+            return
         try:
-            # 从URL获取文件内容
-            response = requests.get(cdn_url, stream=True)
-            response.raise_for_status() # 确保请求成功
-            
-            # 从URL中提取文件类型
-            content_type = response.headers.get('Content-Type', '')
+            if os.path.getsize(self.file_path) >= self.file_max_bytes:
+                os.replace(self.file_path, self.file_path + ".1")
+        except FileNotFoundError:
+            pass
+
+    def flush(self):
+        """等待已入队的span全部导出"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.join()
+
+
+
+class Tracer:
+    """
+    创建和传递追踪span
+
+    当前span保存在 contextvars 中，同一线程内和 asyncio 子任务中自动继承；
+    交给其他线程或共享事件循环执行的任务需要用 activate() 显式传递。
+    """
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    @staticmethod
+    def trace_id_for(tags):
+        """同一个工作流运行的所有span使用同一个trace_id，没有工作流ID时随机生成"""
+        instance_id = tags.get("workflow_instance_id")
+        if instance_id:
+            return hashlib.sha256(instance_id.encode("utf-8")).hexdigest()[:32]
+        return f"{random.getrandbits(128):032x}"
+
+    def start_span(self, name, tags=None, **attributes):
+        """创建span，父span为当前span；没有当前span时开始一个新的trace"""
+        parent = current_span.get()
+        if parent is None:
+            tags = tags or {}
+            return Span(name, self.trace_id_for(tags), None, tags, attributes)
+        return Span(name, parent.trace_id, parent.span_id, parent.tags, attributes)
+
+    def finish(self, span):
+        span.end()
+        self.exporter.export(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """
+        在当前span下记录一个子span
+
+        用法:
+            with tracer.span("download", url=document_url):
+                ...
+        """
+        span = self.start_span(name, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            current_span.reset(token)
+            self.finish(span)
+
+    @contextlib.contextmanager
+    def activate(self, span):
+        """在其他线程中把 span 设为当前span"""
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+
+    @staticmethod
+    async def run_in_span(coro, span):
+        """在共享事件循环中执行协程时继承调用方的当前span"""
+        current_span.set(span)
+        return await coro
+
+
+tracer = Tracer(SpanExporter(
+    Config.TRACE_EXPORTER, Config.TRACE_FILE_PATH, Config.TRACE_OTLP_ENDPOINT, Config.TRACE_QUEUE_SIZE,
+    file_max_bytes=Config.TRACE_FILE_MAX_BYTES
+))
+atexit.register(tracer.exporter.flush)
+
+
+@contextlib.contextmanager
+def observe_upstream(backend):
+    """
+    记录一次上游调用的耗时和状态码，并为这次调用创建一个追踪span；
+    调用方在拿到响应后设置 call["status"]，未设置（抛出异常）时状态记为 error
+
+    用法:
+        with observe_upstream("dify") as call:
+            response = ...
+            call["status"] = response.status
+    """
+    call = {"status": "error"}
+    start = time.perf_counter()
+    with tracer.span(f"upstream.{backend}", backend=backend) as span:
+        try:
+            yield call
+        finally:
+            upstream_request_duration_seconds.observe(time.perf_counter() - start, backend)
+            upstream_requests_total.inc(backend, str(call["status"]))
+            span.set_attribute("http.status_code", call["status"])
+
+
+class RetryableUpstreamError(Exception):
+    """上游返回了可以重试的错误（429 或 5xx）"""
+
+    def __init__(self, message, status, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头，支持秒数和HTTP日期两种格式
+
+    Returns:
+        需要等待的秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class TranslationContext:
+    """
+    单个文档翻译过程的上下文，用于在各个翻译步骤之间传递并汇总统计信息
+    """
+
+    def __init__(self, parent=None, team_id=None):
+        self.stats = {}
+        self.retry_budget = Config.RETRY_BUDGET_PER_DOCUMENT
+        # 批量翻译中每个文档有自己的上下文，统计信息同时累加到整个批次的上下文中
+        self.parent = parent
+        # 发起翻译的团队，用于上游请求的公平排队
+        self.team_id = team_id if team_id is not None or parent is None else parent.team_id
+        # 批量翻译中已经完成的文档结果
+        self.documents = []
+        # 各处理阶段（下载、加载、收集、翻译、插入、保存）的累计耗时（秒）
+        self.timings = {}
+        # 文档翻译的检查点，没有启用时为None
+        self.checkpoint = None
+        # 文档上一个版本的译文，增量翻译时用于沿用未修改分段的译文
+        self.reference = None
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        """累加某个统计项"""
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+        if self.parent is not None:
+            self.parent.incr(name, value)
+        else:
+            # 子上下文的统计会累加到父上下文，只在最顶层记录一次全局指标
+            translation_events_total.inc(name, value=value)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        统计一个处理阶段的耗时，同时记录一个同名的追踪span
+        
+        用法:
+            with context.phase("translate"):
+                ...
+        """
+        start = time.perf_counter()
+        try:
+            with tracer.span(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def timing_summary(self):
+        """返回各阶段耗时的快照（秒）"""
+        with self._lock:
+            return {name: round(seconds, 4) for name, seconds in self.timings.items()}
+
+    def add_document(self, result):
+        """记录批量翻译中一个文档的结果"""
+        with self._lock:
+            self.documents.append(result)
+
+    def consume_retry(self):
+        """扣减一次重试预算，预算用尽时返回False"""
+        with self._lock:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+    def summary(self):
+        """返回统计信息的快照"""
+        with self._lock:
+            return dict(self.stats)
+
+
+class SqliteWriter:
+    """
+    SQLite的后台写入线程，调用方只做一次不阻塞的入队
+
+    写入线程把积压的语句合并到一个事务中提交，翻译协程不会因为逐条提交而阻塞事件循环。
+    同一个写入器中的语句按入队顺序执行。
+    """
+
+    def __init__(self, path, name, batch_size=500):
+        self.path = path
+        self.name = name
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            # fork 出的子进程不会继承写入线程，需要重新创建
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, sql, params=()):
+        """把一条写入语句加入队列"""
+        self._ensure_started()
+        self._queue.put((sql, params))
+
+    def _run(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                conn.execute("BEGIN")
+                for sql, params in batch:
+                    conn.execute(sql, params)
+                conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                logger.warning("写入 %s 失败，丢弃 %d 条语句: %s", self.path, len(batch), e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self):
+        """等待已入队的语句全部写入"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.join()
+
+
+class TranslationMemory:
+    """
+    翻译记忆库：进程内LRU缓存 + 磁盘上的SQLite存储
+
+    缓存键由规范化后的原文、目标语言、特殊翻译要求和模型共同决定。
+    SQLite文件使用WAL模式，可以在服务重启后继续使用，并被多个worker进程共享。
+    """
+
+    def __init__(self, path, lru_size=10000):
+        self.path = path
+        self.lru_size = lru_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 写入在后台线程中批量提交，读取仍然使用每个线程自己的连接
+        self._writer = SqliteWriter(path, "translation-memory-writer")
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "key TEXT PRIMARY KEY, translation TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        # sqlite连接不能跨线程使用，每个线程维护自己的连接
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def normalize(text):
+        """规范化原文：统一Unicode形式并合并空白字符"""
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+    def make_key(self, text, target_language, special_requirements="", model=TRANSLATION_MODEL):
+        raw = json.dumps(
+            [self.normalize(text), target_language, special_requirements or "", model],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, translation):
+        with self._lock:
+            self._lru[key] = translation
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def get(self, key):
+        """查询翻译记忆，未命中时返回None"""
+        with self._lock:
+            translation = self._lru.get(key)
+            if translation is not None:
+                self._lru.move_to_end(key)
+                translation_memory_lookups_total.inc("lru")
+                return translation
+        try:
+            row = self._connect().execute(
+                "SELECT translation FROM translations WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("读取翻译记忆库失败: %s", e)
+            translation_memory_lookups_total.inc("miss")
+            return None
+        if row is None:
+            translation_memory_lookups_total.inc("miss")
+            return None
+        translation_memory_lookups_total.inc("sqlite")
+        self._remember(key, row[0])
+        return row[0]
+
+    def put(self, key, translation):
+        """写入翻译记忆，LRU缓存立即生效，SQLite由后台线程批量写入"""
+        self._remember(key, translation)
+        self._writer.submit(
+            "INSERT OR REPLACE INTO translations (key, translation, updated_at) VALUES (?, ?, ?)",
+            (key, translation, time.time())
+        )
+
+    def flush(self):
+        """等待尚未写入SQLite的翻译记忆全部写入"""
+        self._writer.flush()
+
+
+translation_memory = TranslationMemory(Config.TRANSLATION_MEMORY_PATH, Config.TRANSLATION_MEMORY_LRU_SIZE)
+# 基准测试会替换 translation_memory，退出时写入当时使用的实例
+atexit.register(lambda: translation_memory.flush())
+
+
+class TranslationCheckpoint:
+    """
+    一次文档翻译任务的检查点：已经完成的段落译文，按规范化后的原文索引
+
+    打开时把已有的译文一次性读入内存，翻译过程中的查询不访问磁盘；
+    每段译文完成后交给后台线程批量写入SQLite，进程崩溃或上游故障后重试同一个任务时只翻译缺少的段落。
+    """
+
+    def __init__(self, store, job_key, entries):
+        self.store = store
+        self.job_key = job_key
+        self.entries = entries
+        # 打开检查点时已经存在的段落数，大于0表示这是一次恢复
+        self.resumed = len(entries)
+        self._lock = threading.Lock()
+
+    def get(self, text):
+        """查询检查点中的译文，不存在时返回None"""
+        return self.entries.get(translation_memory.normalize(text))
+
+    def record(self, text, translation):
+        """记录一段已完成的译文"""
+        if not translation.strip():
+            return
+        source = translation_memory.normalize(text)
+        with self._lock:
+            if self.entries.get(source) == translation:
+                return
+            self.entries[source] = translation
+        self.store.write(self.job_key, source, translation)
+
+    def discard(self):
+        """文档翻译成功后删除检查点"""
+        self.store.delete(self.job_key)
+
+
+class TranslationCheckpointStore:
+    """
+    文档翻译检查点的SQLite存储
+
+    任务键由文档内容的哈希和翻译参数（目标语言、特殊翻译要求、模型）共同决定，
+    同一个文档用相同参数重新翻译时自动从上次中断的位置继续。
+    超过 ttl 没有再被打开的检查点会被清理。
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_cleanup = 0.0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 写入和删除在后台线程中按顺序批量提交，翻译协程只做入队
+        self._writer = SqliteWriter(path, "checkpoint-writer")
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint_jobs ("
+            "job_key TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint_segments ("
+            "job_key TEXT NOT NULL, source TEXT NOT NULL, translation TEXT NOT NULL, "
+            "PRIMARY KEY (job_key, source))"
+        )
+
+    def _connect(self):
+        # sqlite连接不能跨线程使用，每个线程维护自己的连接
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_job_key(file_path, target_language, special_requirements="", model=TRANSLATION_MODEL):
+        """根据文档内容和翻译参数计算任务键"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        params = json.dumps([target_language, special_requirements or "", model], ensure_ascii=False)
+        digest.update(params.encode("utf-8"))
+        return digest.hexdigest()
+
+    def open(self, file_path, target_language, special_requirements=""):
+        """
+        打开（或创建）一个文档翻译任务的检查点
+
+        Returns:
+            TranslationCheckpoint，读写失败时返回None，翻译照常进行
+        """
+        try:
+            job_key = self.make_job_key(file_path, target_language, special_requirements)
+            self._cleanup()
+            # 读取之前先写入尚在队列中的段落，例如同一进程中刚刚失败的上一次尝试
+            self._writer.flush()
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO checkpoint_jobs (job_key, updated_at) VALUES (?, ?)", (job_key, time.time())
+            )
+            rows = conn.execute(
+                "SELECT source, translation FROM checkpoint_segments WHERE job_key = ?", (job_key,)
+            ).fetchall()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("打开翻译检查点失败: %s", e)
+            return None
+        return TranslationCheckpoint(self, job_key, dict(rows))
+
+    def write(self, job_key, source, translation):
+        self._writer.submit(
+            "INSERT OR REPLACE INTO checkpoint_segments (job_key, source, translation) VALUES (?, ?, ?)",
+            (job_key, source, translation)
+        )
+
+    def delete(self, job_key):
+        # 与写入使用同一个队列，排在该任务所有已入队的段落之后执行
+        self._writer.submit("DELETE FROM checkpoint_segments WHERE job_key = ?", (job_key,))
+        self._writer.submit("DELETE FROM checkpoint_jobs WHERE job_key = ?", (job_key,))
+
+    def flush(self):
+        """等待尚未写入的检查点全部写入"""
+        self._writer.flush()
+
+    def _cleanup(self):
+        # 每小时最多清理一次过期的检查点
+        now = time.time()
+        if now - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = now
+        conn = self._connect()
+        expired = [row[0] for row in conn.execute(
+            "SELECT job_key FROM checkpoint_jobs WHERE updated_at < ?", (now - self.ttl,)
+        )]
+        for job_key in expired:
+            self.delete(job_key)
+
+
+translation_checkpoints = TranslationCheckpointStore(Config.CHECKPOINT_PATH, Config.CHECKPOINT_TTL)
+atexit.register(translation_checkpoints.flush)
+
+
+class Glossary:
+    """
+    一种目标语言的术语表，使用 Aho-Corasick 自动机一次扫描找出文本中出现的所有术语
+
+    exact_terms 中的术语和短于 GLOSSARY_MIN_INJECTED_TERM_LENGTH 的术语只在整段文本恰好是该术语时使用，
+    不会注入到提示词中。
+    """
+
+    def __init__(self, terms, exact_terms=None):
+        self.terms = {term: translation for term, translation in terms.items() if term}
+        self.exact_terms = exact_terms or {}
+        # 自动机的转移表、失败指针、节点对应的术语，以及指向最近的术语节点的后缀链接
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        self._suffix = [0]
+        for term in self.terms:
+            if len(term) < GLOSSARY_MIN_INJECTED_TERM_LENGTH:
+                continue
+            node = 0
+            for ch in term:
+                next_node = self._goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][ch] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                    self._suffix.append(0)
+                node = next_node
+            self._output[node] = term
+        
+        # 按层次遍历计算失败指针
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[child] = fail
+                self._suffix[child] = fail if self._output[fail] is not None else self._suffix[fail]
+                queue.append(child)
+
+    def exact(self, text):
+        """整段文本恰好是一个术语时返回固定译法"""
+        text = text.strip()
+        translation = self.terms.get(text)
+        return translation if translation is not None else self.exact_terms.get(text)
+
+    def match(self, text):
+        """
+        找出文本中出现的术语，重叠时优先取最左、最长的术语
+        
+        Returns:
+            按出现顺序排列、去重后的 (术语, 译法) 列表
+        """
+        found = []
+        node = 0
+        for end, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            hit = node if self._output[node] is not None else self._suffix[node]
+            while hit:
+                term = self._output[hit]
+                found.append((end - len(term) + 1, -len(term), term))
+                hit = self._suffix[hit]
+        
+        matched = []
+        seen = set()
+        covered_until = 0
+        for start, negative_length, term in sorted(found):
+            if start < covered_until:
+                continue
+            covered_until = start - negative_length
+            if term not in seen:
+                seen.add(term)
+                matched.append((term, self.terms[term]))
+        return matched
+
+
+class GlossaryStore:
+    """
+    按目标语言管理术语表，内置表之外还会加载术语表目录中的文件，文件变化时自动重新加载
+
+    术语表文件的文件名（不含扩展名）就是目标语言名称：
+        越南语.json: {"术语": "译法", ...}，或 {"languages": ["越南语", "vi"], "terms": {...}}
+        英语.tsv: 每行一个 "术语<TAB>译法"
+    同一种语言的文件术语会覆盖内置术语。语言名称不区分大小写。
+    内置术语只用于整段文本的精确匹配，文件中的术语还会在文本中出现时注入到提示词中。
+    """
+
+    def __init__(self, directory, reload_interval, builtin=()):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        # 内置术语表：(语言名称列表, 术语字典)，只用于精确匹配
+        self.builtin = list(builtin)
+        self._signature = None
+        self._checked_at = 0
+        self._aliases = {}
+        self._tables = {}
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def language_key(language):
+        return (language or "").strip().casefold()
+
+    def _scan(self):
+        """返回术语表目录中文件的 (文件名, 修改时间, 大小)，用于判断是否需要重新加载"""
+        try:
+            entries = sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in os.scandir(self.directory)
+                if entry.is_file() and entry.name.endswith((".json", ".tsv"))
+            )
+        except FileNotFoundError:
+            entries = []
+        return tuple(entries)
+
+    def _read_file(self, path):
+        """读取一个术语表文件，返回 (语言名称列表, 术语字典)"""
+        name = os.path.splitext(os.path.basename(path))[0]
+        if path.endswith(".tsv"):
+            terms = {}
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip() or line.startswith("#") or "\t" not in line:
+                        continue
+                    term, translation = line.rstrip("\r\n").split("\t", 1)
+                    terms[term.strip()] = translation.strip()
+            return [name], terms
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data.get("terms"), dict):
+            return [name] + list(data.get("languages") or []), data["terms"]
+        return [name], data
+
+    def _add_table(self, languages, terms, aliases, tables, exact_only=False):
+        keys = [self.language_key(language) for language in languages if self.language_key(language)]
+        # 任意一个名称已经登记过时合并到已有的表中
+        canonical = next((aliases[key] for key in keys if key in aliases), keys[0])
+        # 每种语言一对字典：(注入提示词的术语, 只用于精确匹配的术语)
+        tables.setdefault(canonical, ({}, {}))[1 if exact_only else 0].update(
+            {str(term): str(translation) for term, translation in terms.items()}
+        )
+        for key in keys:
+            aliases.setdefault(key, canonical)
+
+    def _reload(self, signature):
+        aliases = {}
+        tables = {}
+        for languages, terms in self.builtin:
+            self._add_table(languages, terms, aliases, tables, exact_only=True)
+        for name, _, _ in signature:
+            path = os.path.join(self.directory, name)
+            try:
+                languages, terms = self._read_file(path)
+                self._add_table(languages, terms, aliases, tables)
+            except (OSError, ValueError, AttributeError) as e:
+                logger.warning("加载术语表 %s 失败: %s", path, e)
+        self._aliases = aliases
+        self._tables = tables
+        self._compiled = {}
+        self._signature = signature
+        logger.info(
+            "已加载术语表: %s",
+            ", ".join(f"{key}({len(terms) + len(exact)})" for key, (terms, exact) in tables.items()) or "无",
+            extra={"glossary_terms": {key: len(terms) + len(exact) for key, (terms, exact) in tables.items()}}
+        )
+
+    def get(self, target_language):
+        """
+        获取目标语言的术语表
+        
+        Returns:
+            Glossary 对象，没有对应术语表时返回None
+        """
+        with self._lock:
+            now = time.time()
+            if self._signature is None or now - self._checked_at >= self.reload_interval:
+                self._checked_at = now
+                signature = self._scan()
+                if signature != self._signature:
+                    self._reload(signature)
+            
+            canonical = self._aliases.get(self.language_key(target_language))
+            if canonical is None:
+                return None
+            glossary = self._compiled.get(canonical)
+            if glossary is None:
+                glossary = Glossary(*self._tables[canonical])
+                self._compiled[canonical] = glossary
+            return glossary
+
+
+glossary_store = GlossaryStore(
+    Config.GLOSSARY_DIR, Config.GLOSSARY_RELOAD_INTERVAL,
+    builtin=[(VIETNAMESE_LANGUAGE_NAMES, SPECIAL_TRANSLATIONS)]
+)
+
+
+# 源语言（中文）使用的文字：CJK统一汉字及其扩展区、兼容汉字和〇
+SOURCE_SCRIPT = re.compile("[\u3007\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0003134f]")
+# 不需要翻译的文本模式，按顺序匹配
+PASSTHROUGH_PATTERNS = (
+    # 只有标点和符号
+    ("symbol", re.compile(r"[\W_]+")),
+    # 日期和时间：2024-01-31、2024/1/31、31.01.2024、09:30、2024-01-31 09:30:00
+    ("date", re.compile(r"\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}(?:[ T]\d{1,2}:\d{2}(?::\d{2})?)?|\d{1,2}:\d{2}(?::\d{2})?")),
+    # 数字和金额：1,250,000 VND、¥1,000.00、-12.5%、(3)
+    ("number", re.compile(
+        r"[(\[]?[+\-−±]?(?:[A-Z]{3}\s|[¥$€£₫]\s?)?\d[\d,.\s]*(?:%|‰)?(?:\s?(?:[A-Z]{3}|[¥$€£₫đ]))?[)\]]?"
+    )),
+    # 网址和邮箱
+    ("code", re.compile(r"(?:https?://|www\.)\S+|[\w.+\-]+@[\w\-]+(?:\.[\w\-]+)+")),
+    # 编号、型号等：AB-1234、ISO9001、V2.0、PN#12/3
+    ("code", re.compile(r"(?=\S*[\dA-Z])[A-Za-z0-9][A-Za-z0-9_\-./:#+]*")),
+)
+
+
+# 拆分超长段落使用的句子边界和分句边界，分隔符（包括后面的引号括号和空白）保留在前一个片段中
+SENTENCE_BOUNDARY = re.compile(r".+?(?:[。！？!?；;…]+[”’\"'」』）)\]]*\s*|\.(?:\s+|$)|\n\s*|$)", re.S)
+CLAUSE_BOUNDARY = re.compile(r".+?(?:[，,、：:]+\s*|$)", re.S)
+
+
+def classify_passthrough(text):
+    """
+    判断文本是否不包含需要翻译的源语言内容
+    
+    Args:
+        text: 原文
+    
+    Returns:
+        不需要翻译时返回类别（symbol、date、number、code、no_source_script），否则返回None
+    """
+    stripped = text.strip()
+    if SOURCE_SCRIPT.search(stripped):
+        return None
+    for category, pattern in PASSTHROUGH_PATTERNS:
+        if pattern.fullmatch(stripped):
+            return category
+    if Config.SKIP_TEXT_WITHOUT_SOURCE_SCRIPT:
+        return "no_source_script"
+    return None
+
+
+class AsyncRuntime:
+    """
+    进程级的后台事件循环，持有一个长连接复用的 aiohttp 连接池
+
+    Flask 的请求线程通过 run() 把协程提交到这个事件循环中执行，
+    翻译、Dify 和推理请求因此共享同一组 keep-alive 连接，不再每次重新握手。
+    ASGI 模式下改用服务器自己的事件循环（见 adopt()），不再单独创建线程。
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            # fork 出的子进程不会继承事件循环线程，需要重新创建
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="async-runtime", daemon=True)
+                thread.start()
+                self._loop = loop
+                self._thread = thread
+                self._session = None
+                self._pid = os.getpid()
+            return self._loop
+
+    @property
+    def loop(self):
+        return self._ensure_started()
+
+    def adopt(self, loop):
+        """
+        使用调用方正在运行的事件循环作为共享事件循环，ASGI 服务器启动时在该事件循环中调用
+
+        Args:
+            loop: 服务器的事件循环
+        """
+        with self._lock:
+            self._loop = loop
+            self._thread = threading.current_thread()
+            self._session = None
+            self._pid = os.getpid()
+
+    async def close(self):
+        """关闭共享的 aiohttp 会话，只能在共享事件循环中调用"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def shutdown(self, timeout=5):
+        """进程退出前关闭共享的 aiohttp 会话"""
+        if self._session is None or self._loop is None or not self._loop.is_running():
+            return
+        if threading.current_thread() is self._thread or self._pid != os.getpid():
+            return
+        try:
+            self.run(self.close(), timeout)
+        except Exception as e:
+            logger.warning("关闭共享连接池失败: %s", e)
+
+    def run(self, coro, timeout=None):
+        """
+        在共享事件循环中执行协程，并阻塞等待结果
+
+        Args:
+            coro: 要执行的协程
+            timeout: 等待结果的超时时间（秒）
+
+        Returns:
+            协程的返回值
+        """
+        loop = self._ensure_started()
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("不能在共享事件循环线程中同步等待协程")
+        span = current_span.get()
+        if span is not None:
+            coro = tracer.run_in_span(coro, span)
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+    def get_session(self):
+        """获取共享的 aiohttp 会话，只能在共享事件循环中调用"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=Config.HTTP_POOL_LIMIT,
+                limit_per_host=Config.HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=Config.HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=Config.HTTP_KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=Config.HTTP_TIMEOUT),
+            )
+        return self._session
+
+
+
+async_runtime = AsyncRuntime()
+atexit.register(async_runtime.shutdown)
+
+
+class InflightTranslations:
+    """
+    进程内正在请求API翻译的文本，按翻译记忆键索引
+
+    同时翻译的多个文档中出现相同的文本时，只有第一个文档发送请求，其余文档等待它的结果。
+    只在共享事件循环中使用，不需要加锁。
+    """
+
+    def __init__(self):
+        self._futures = {}
+
+    def claim(self, key):
+        """
+        登记一个需要翻译的文本
+        
+        Returns:
+            (是否由调用方负责翻译, 翻译结果的 Future)
+        """
+        loop = asyncio.get_running_loop()
+        future = self._futures.get(key)
+        # 事件循环重新创建后（例如fork之后），旧的 Future 已经失效
+        if future is not None and future.get_loop() is loop:
+            return False, future
+        future = loop.create_future()
+        self._futures[key] = future
+        return True, future
+
+    def resolve(self, key, translated_text):
+        """设置翻译结果，唤醒等待相同文本的其他文档"""
+        future = self._futures.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(translated_text)
+
+
+inflight_translations = InflightTranslations()
+
+
+def estimate_tokens(text):
+    """粗略估算文本的token数：非ASCII字符按1个token计，ASCII字符按4个字符1个token计"""
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + (len(text) - non_ascii) // 4 + 1
+
+
+def parse_team_weights(value):
+    """解析 "团队ID:权重,团队ID:权重" 格式的团队权重配置"""
+    weights = {}
+    for item in (value or "").split(","):
+        team_id, _, weight = item.partition(":")
+        try:
+            if team_id.strip() and float(weight) > 0:
+                weights[team_id.strip()] = float(weight)
+        except ValueError:
+            logger.warning("忽略无效的团队权重配置: %s", item)
+    return weights
+
+
+def workflow_tags(headers):
+    """从请求头中读取工作流相关的ID，headers 需要支持按小写名称查询"""
+    return {name: headers.get(header) for name, header in WORKFLOW_HEADERS.items() if headers.get(header)}
+
+
+def current_team_id():
+    """当前HTTP请求所属的团队，不在请求上下文中时返回None"""
+    return getattr(request, "team_id", None) if has_request_context() else None
+
+
+class UpstreamScheduler:
+    """
+    进程级的上游LLM请求调度器，所有发往上游的请求都要先在这里获取名额
+
+    全局和每个API密钥分别有并发上限。等待中的请求按团队加权公平排队（WFQ）：
+    每个请求按token数和团队权重计算虚拟完成时间，总是先放行虚拟完成时间最小、
+    并且所属API密钥还有名额的请求，一个团队的大任务不会让其他团队一直排队。
+    只在共享事件循环中使用，不需要加锁。
+    """
+
+    DEFAULT_TEAM = "default"
+
+    def __init__(self, max_concurrent, max_per_key, weights=None):
+        self.max_concurrent = max_concurrent
+        self.max_per_key = max_per_key
+        self.weights = dict(weights or {})
+        self.granted = 0
+        self.granted_by_team = {}
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+        self._sequence = itertools.count()
+        self._reset(None)
+
+    def _reset(self, loop):
+        # fork 之后事件循环重新创建，旧的等待者和计数全部作废
+        self._loop = loop
+        self.active = 0
+        self.active_by_key = {}
+        # 每个API密钥一个按虚拟完成时间排序的堆
+        self.waiting_by_key = {}
+        self.queued_by_team = {}
+        self.virtual_time = 0.0
+        self.team_finish = {}
+
+    @staticmethod
+    def key_id(api_key):
+        """API密钥的摘要，避免在内存统计和接口中出现明文密钥"""
+        return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def queued(self):
+        return sum(self.queued_by_team.values())
+
+    async def acquire(self, api_key=None, team_id=None, cost=1):
+        """
+        排队获取一个上游请求名额
+        
+        Args:
+            api_key: 请求使用的API密钥
+            team_id: 发起请求的团队
+            cost: 请求的代价（token数），代价越大，同一团队后续请求的虚拟完成时间越晚
+        
+        Returns:
+            排队等待的秒数
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._reset(loop)
+        team = team_id or self.DEFAULT_TEAM
+        start = max(self.virtual_time, self.team_finish.get(team, 0.0))
+        finish = start + max(cost, 1) / self.weights.get(team, 1.0)
+        self.team_finish[team] = finish
+        
+        key = self.key_id(api_key)
+        waiter = {
+            "start": start, "team": team, "key": key,
+            "enqueued_at": time.monotonic(), "future": loop.create_future(),
+        }
+        heapq.heappush(self.waiting_by_key.setdefault(key, []), (finish, next(self._sequence), waiter))
+        self.queued_by_team[team] = self.queued_by_team.get(team, 0) + 1
+        self._dispatch()
+        try:
+            await waiter["future"]
+        except asyncio.CancelledError:
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                # 已经分配了名额但调用方被取消，归还名额
+                self.release(api_key)
+            elif not waiter.get("removed"):
+                waiter["removed"] = True
+                self.queued_by_team[team] -= 1
+            raise
+        return time.monotonic() - waiter["enqueued_at"]
+
+    def release(self, api_key=None):
+        """归还一个名额，并放行下一个请求"""
+        key = self.key_id(api_key)
+        if self.active_by_key.get(key, 0) <= 0:
+            return
+        self.active -= 1
+        self.active_by_key[key] -= 1
+        if not self.active_by_key[key]:
+            del self.active_by_key[key]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.max_concurrent:
+            # 在还有名额的API密钥中，选择队首虚拟完成时间最小的请求
+            best = None
+            for key, heap in list(self.waiting_by_key.items()):
+                while heap and heap[0][2].get("removed"):
+                    heapq.heappop(heap)
+                if not heap:
+                    del self.waiting_by_key[key]
+                    continue
+                if self.active_by_key.get(key, 0) >= self.max_per_key:
+                    continue
+                if best is None or heap[0][:2] < best[0][:2]:
+                    best = heap[0], key
+            if best is None:
+                return
+            (_, _, waiter), key = best
+            heapq.heappop(self.waiting_by_key[key])
+            waiter["removed"] = True
+            team = waiter["team"]
+            self.queued_by_team[team] -= 1
+            self.active += 1
+            self.active_by_key[key] = self.active_by_key.get(key, 0) + 1
+            self.virtual_time = max(self.virtual_time, waiter["start"])
+            
+            waited = time.monotonic() - waiter["enqueued_at"]
+            self.granted += 1
+            self.granted_by_team[team] = self.granted_by_team.get(team, 0) + 1
+            self.wait_seconds_total += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            waiter["future"].set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, api_key=None, team_id=None, cost=1, context=None):
+        """
+        在名额内执行一次上游请求，排队时间累加到翻译上下文的 upstream_wait_seconds 中
+        
+        用法:
+            async with upstream_scheduler.slot(api_key, team_id, cost):
+                ...
+        """
+        waited = await self.acquire(api_key, team_id, cost)
+        if context:
+            context.incr("upstream_wait_seconds", waited)
+        try:
+            yield
+        finally:
+            self.release(api_key)
+
+    def summary(self):
+        """返回调度器的当前状态：并发数、各团队的排队深度、累计等待时间等"""
+        # 可能在请求线程中调用，先复制一份再读取
+        queued_by_team = dict(self.queued_by_team)
+        now = time.monotonic()
+        oldest = [
+            now - entry[2]["enqueued_at"]
+            for heap in list(self.waiting_by_key.values())
+            for entry in list(heap) if not entry[2].get("removed")
+        ]
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "max_per_key": self.max_per_key,
+            "active_keys": len(self.active_by_key),
+            "queued": sum(queued_by_team.values()),
+            "queued_by_team": {team: count for team, count in queued_by_team.items() if count},
+            "oldest_wait_seconds": round(max(oldest), 3) if oldest else 0,
+            "granted": self.granted,
+            "granted_by_team": dict(self.granted_by_team),
+            "avg_wait_seconds": round(self.wait_seconds_total / self.granted, 3) if self.granted else 0,
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+            "team_weights": dict(self.weights),
+        }
+
+
+upstream_scheduler = UpstreamScheduler(
+    Config.GLOBAL_MAX_CONCURRENT_REQUESTS,
+    Config.UPSTREAM_MAX_CONCURRENT_PER_KEY,
+    parse_team_weights(Config.UPSTREAM_TEAM_WEIGHTS),
+)
+
+
+async def post_json_async(url, headers, payload, timeout=None, api_key=None, team_id=None, backend="other"):
+    """
+    通过共享连接池发送 JSON POST 请求，请求经过上游调度器排队
+
+    Args:
+        url: 请求地址
+        headers: 请求头
+        payload: 请求体
+        timeout: 超时时间（秒），不传时使用连接池的默认超时
+        api_key: 请求使用的API密钥，用于按密钥限制并发
+        team_id: 发起请求的团队，用于公平排队
+        backend: 上游服务名称，用于 /metrics 中的延迟和状态码统计
+
+    Returns:
+        (HTTP状态码, 响应文本)
+    """
+    session = async_runtime.get_session()
+    request_timeout = aiohttp.ClientTimeout(total=timeout) if timeout else None
+    cost = estimate_tokens(json.dumps(payload, ensure_ascii=False))
+    async with upstream_scheduler.slot(api_key, team_id, cost):
+        with observe_upstream(backend) as call:
+            async with session.post(url, headers=headers, json=payload, timeout=request_timeout) as response:
+                call["status"] = response.status
+                return response.status, await response.text()
+
+class SidecarUnavailableError(Exception):
+    """翻译服务（sidecar）无法连接、超时或返回了5xx错误"""
+
+
+class SidecarCircuitBreaker:
+    """
+    翻译服务（sidecar）的熔断器，在所有请求之间共享
+
+    连续失败达到阈值后熔断，之后的文档直接使用本地引擎，不再等待一个已经失效的服务；
+    熔断期间由后台线程定期访问健康检查地址，检查成功后恢复。
+    """
+
+    def __init__(self, health_url, failure_threshold, probe_interval):
+        self.health_url = health_url
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.opened_at = None
+        self._probe_thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """是否允许请求翻译服务"""
+        with self._lock:
+            if self.opened_at is not None:
+                # fork 出的子进程或者意外退出时，重新启动健康检查线程
+                self._ensure_probe()
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                logger.warning("翻译服务连续失败 %d 次，熔断并改用本地翻译引擎", self.failures)
+                self._ensure_probe()
+
+    def _ensure_probe(self):
+        if self._probe_thread is None or not self._probe_thread.is_alive():
+            self._probe_thread = threading.Thread(target=self._probe_loop, name="sidecar-probe", daemon=True)
+            self._probe_thread.start()
+
+    def probe(self):
+        """访问健康检查地址，服务能够正常响应（非5xx）即认为恢复"""
+        try:
+            response = requests.get(
+                self.health_url, timeout=(Config.SIDECAR_CONNECT_TIMEOUT, Config.SIDECAR_CONNECT_TIMEOUT)
+            )
+            return response.status_code < 500
+        except requests.RequestException:
+            return False
+
+    def _probe_loop(self):
+        while self.is_open:
+            time.sleep(self.probe_interval)
+            if self.probe():
+                logger.info("翻译服务健康检查成功，恢复使用翻译服务")
+                self.record_success()
+
+    def summary(self):
+        with self._lock:
+            return {
+                "state": "open" if self.opened_at is not None else "closed",
+                "failures": self.failures,
+                "opened_at": self.opened_at,
+            }
+
+
+sidecar_breaker = SidecarCircuitBreaker(
+    Config.SIDECAR_HEALTH_URL, Config.SIDECAR_FAILURE_THRESHOLD, Config.SIDECAR_PROBE_INTERVAL
+)
+
+ai_translation_ns = api.namespace("ai_translation", description="Document Translation API")
+ocr_ns = api.namespace("ocr", description="腾讯云OCR API")
+dify_ns = api.namespace("dify", description="Dify API")
+inference_ns = api.namespace("inference", description="Inference API")
+
+# Define document translation request and response models
+document_translation_request = ai_translation_ns.model(
+    "DocumentTranslationRequest",
+    {
+        "url": fields.String(required=True, description="URL of the document to translate"),
+        "target_language": fields.String(required=True, description="Target language for translation"),
+        "special_requirements": fields.String(required=False, description="Special requirements for translation"),
+        "api_key": fields.String(required=False, description="API key for translation service"),
+        "async": fields.Boolean(required=False, description="Return a job id immediately and translate in the background"),
+        "engine": fields.String(required=False, enum=["docx", "stream"], description="Local translation engine"),
+        "previous_document_url": fields.String(required=False, description="URL of the previous revision of the document"),
+        "previous_translated_url": fields.String(required=False, description="URL of the bilingual translation of the previous revision")
+    }
+)
+
+document_translation_response = ai_translation_ns.model(
+    "DocumentTranslationResponse",
+    {
+        "message": fields.String(description="Response message"),
+        "document_url": fields.String(description="URL to the translated document"),
+        "error": fields.String(description="Error message if any")
+    }
+)
+
+batch_translation_request = ai_translation_ns.model(
+    "BatchTranslationRequest",
+    {
+        "document_urls": fields.List(fields.String, required=True, description="URLs of the .docx documents to translate"),
+        "target_language": fields.String(required=True, description="Target language for translation"),
+        "special_requirements": fields.String(required=False, description="Special requirements for translation"),
+        "api_key": fields.String(required=True, description="API key for translation service"),
+        "engine": fields.String(required=False, enum=["docx", "stream"], description="Local translation engine")
+    }
+)
+
+# 克隆段落/文字属性时需要去掉的子元素：节属性、列表编号和修订记录不应出现在译文段落中
+PARAGRAPH_PROPERTY_EXCLUDES = {qn("w:sectPr"), qn("w:numPr"), qn("w:pPrChange")}
+RUN_PROPERTY_EXCLUDES = {qn("w:rPrChange")}
+# 判断一个 run 是否带有格式的属性
+RUN_FORMAT_TAGS = {qn("w:b"), qn("w:i"), qn("w:u"), qn("w:sz")}
+W_T, W_TAB, W_BR, W_CR = qn("w:t"), qn("w:tab"), qn("w:br"), qn("w:cr")
+W_P, W_TBL, W_TR, W_TC = qn("w:p"), qn("w:tbl"), qn("w:tr"), qn("w:tc")
+W_FOOTNOTE, W_ENDNOTE = qn("w:footnote"), qn("w:endnote")
+W_TXBX_CONTENT = qn("w:txbxContent")
+
+
+def clone_properties(properties, excludes):
+    """深拷贝属性元素并去掉不需要的子元素"""
+    cloned = copy.deepcopy(properties)
+    for child in list(cloned):
+        if child.tag in excludes:
+            cloned.remove(child)
+    return cloned
+
+
+def select_run_properties(p):
+    """
+    选择译文要沿用的 w:rPr：优先使用第一个带有加粗/斜体/下划线/字号的 run，
+    否则使用第一个带有属性的 run
+
+    Args:
+        p: 原段落的 w:p 元素
+
+    Returns:
+        w:rPr 元素，原段落没有文字属性时返回None
+    """
+    fallback = None
+    for r in p.iterchildren(qn("w:r")):
+        rPr = r.find(qn("w:rPr"))
+        if rPr is None:
+            continue
+        if any(child.tag in RUN_FORMAT_TAGS for child in rPr):
+            return rPr
+        if fallback is None:
+            fallback = rPr
+    return fallback
+
+
+# paragraph_text 需要读取的 run：直接子元素以及超链接、修订插入、智能标记和简单域中的 run
+PARAGRAPH_RUNS = etree.XPath(
+    "./w:r | ./w:hyperlink/w:r | ./w:ins/w:r | ./w:smartTag/w:r | ./w:fldSimple/w:r",
+    namespaces={"w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"}
+)
+# 文本框中的段落
+TEXTBOX_PARAGRAPHS = etree.XPath(
+    ".//w:txbxContent/w:p",
+    namespaces={"w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"}
+)
+
+
+def paragraph_text(p):
+    """
+    直接从 w:p 元素计算段落文本，w:tab 转换为制表符，w:br / w:cr 转换为换行
+
+    Args:
+        p: w:p 元素
+
+    Returns:
+        段落文本
+    """
+    parts = []
+    for r in PARAGRAPH_RUNS(p):
+        for child in r.iterchildren():
+            tag = child.tag
+            if tag == W_T:
+                parts.append(child.text or "")
+            elif tag == W_TAB:
+                parts.append("\t")
+            elif tag in (W_BR, W_CR):
+                parts.append("\n")
+    return "".join(parts)
+
+
+def cell_text(tc):
+    """计算单元格文本：单元格直接包含的各段落文本以换行连接"""
+    return "\n".join(paragraph_text(p) for p in tc.iterchildren(qn("w:p")))
+
+
+def should_append_cell_translation(source_text, first_paragraph_text, translated_text):
+    """
+    判断是否需要在单元格中追加翻译段落
+
+    Args:
+        source_text: 单元格原文
+        first_paragraph_text: 单元格第一个段落的文本，单元格没有段落时为None
+        translated_text: 翻译文本
+
+    Returns:
+        需要追加时返回True
+    """
+    # 检查单元格是否已经包含翻译
+    if translated_text.strip() in source_text:
+        logger.debug("跳过已翻译的单元格内容", extra={"sampled": True})
+        return False
+    # 只在第一个段落有内容时添加翻译段落
+    return bool(first_paragraph_text and first_paragraph_text.strip())
+
+
+def paragraph_format_skeleton(p):
+    """
+    只保留段落格式的轻量副本（w:pPr 和选中的 w:rPr），供之后构建译文段落使用
+
+    Args:
+        p: w:p 元素
+
+    Returns:
+        新的 w:p 元素，build_translation_paragraph 对它和原段落的结果相同
+    """
+    skeleton = OxmlElement("w:p")
+    pPr = p.find(qn("w:pPr"))
+    if pPr is not None:
+        skeleton.append(copy.deepcopy(pPr))
+    rPr = select_run_properties(p)
+    if rPr is not None:
+        r = OxmlElement("w:r")
+        r.append(copy.deepcopy(rPr))
+        skeleton.append(r)
+    return skeleton
+
+
+def build_translation_paragraph(source_p, translated_text, source_pPr=None):
+    """
+    构建一个沿用原段落格式的译文段落元素
+
+    Args:
+        source_p: 原段落的 w:p 元素，为None时只使用 source_pPr
+        translated_text: 翻译文本
+        source_pPr: 指定要沿用的 w:pPr，不传时使用原段落自己的 w:pPr
+
+    Returns:
+        新的 w:p 元素（尚未插入文档）
+    """
+    new_p = OxmlElement("w:p")
+    if source_pPr is None and source_p is not None:
+        source_pPr = source_p.find(qn("w:pPr"))
+    if source_pPr is not None:
+        new_p.append(clone_properties(source_pPr, PARAGRAPH_PROPERTY_EXCLUDES))
+    
+    r = OxmlElement("w:r")
+    rPr = select_run_properties(source_p) if source_p is not None else None
+    if rPr is not None:
+        r.append(clone_properties(rPr, RUN_PROPERTY_EXCLUDES))
+    # CT_R.text 会把换行和制表符转换为 w:br / w:tab
+    r.text = translated_text
+    new_p.append(r)
+    return new_p
+
+
+def clone_zip_info(info):
+    """复制压缩包条目信息（文件名、时间、属性），用于重新写入改动过的部件"""
+    clone = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    clone.compress_type = zipfile.ZIP_DEFLATED
+    clone._compresslevel = Config.DOCX_COMPRESS_LEVEL
+    clone.external_attr = info.external_attr
+    return clone
+
+
+# 通用标志位中表示使用数据描述符的位
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+# 本地文件头中签名、文件名长度和扩展字段长度的位置
+ZIP_FH_SIGNATURE, ZIP_FH_FILENAME_LENGTH, ZIP_FH_EXTRA_FIELD_LENGTH = 0, 10, 11
+
+
+def strip_zip64_extra(extra):
+    """去掉扩展字段中的 zip64 字段（头部ID为1）"""
+    fields = []
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack("<HH", extra[offset:offset + 4])
+        end = offset + 4 + size
+        if header_id != 1:
+            fields.append(extra[offset:end])
+        offset = end
+    return b"".join(fields)
+
+
+def copy_zip_member(archive, info, output):
+    """
+    把一个条目复制到输出压缩包，尽量不解压也不重新压缩
+    
+    当前Python版本不支持原样复制，或复制过程中出错时，退回解压后重新压缩写入。
+    
+    Args:
+        archive: 以读取模式打开的源 ZipFile
+        info: 源条目的 ZipInfo
+        output: 以写入模式打开的目标 ZipFile，输出文件必须支持 seek
+    """
+    if zip_raw_copy_supported():
+        start_dir = output.start_dir
+        entry_count = len(output.filelist)
+        previous_info = output.NameToInfo.get(info.filename)
+        try:
+            copy_zip_member_raw(archive, info, output)
+            return
+        except (AttributeError, TypeError, ValueError, struct.error, zipfile.BadZipFile) as e:
+            logger.warning("无法原样复制压缩包条目 %s，改为重新压缩: %s", info.filename, e)
+            # 恢复输出压缩包的状态并丢弃已经写出的部分数据，后续条目从原来的位置继续写
+            del output.filelist[entry_count:]
+            if previous_info is None:
+                output.NameToInfo.pop(info.filename, None)
+            else:
+                output.NameToInfo[info.filename] = previous_info
+            output.start_dir = start_dir
+            output.fp.seek(start_dir)
+            output.fp.truncate()
+    clone = clone_zip_info(info)
+    # 原来不压缩的条目（例如已经压缩过的图片）保持不压缩
+    if info.compress_type == zipfile.ZIP_STORED:
+        clone.compress_type = zipfile.ZIP_STORED
+    output.writestr(clone, archive.read(info))
+
+
+# 原样复制是否可用：None 表示尚未检查
+_zip_raw_copy_supported = None
+
+
+def zip_raw_copy_supported():
+    """
+    检查当前Python版本能否原样复制压缩包条目
+
+    原样复制依赖 zipfile 的内部接口，不同版本之间可能变化。第一次调用时在内存中构造一个压缩包，
+    用 copy_zip_member_raw 复制后重新读取并校验内容，接口缺失或行为不符时都退回重新压缩。
+    """
+    global _zip_raw_copy_supported
+    if _zip_raw_copy_supported is None:
+        data = {"a.xml": b"<a/>" * 64, "b.bin": bytes(range(256))}
+        try:
+            source = io.BytesIO()
+            with zipfile.ZipFile(source, "w") as archive:
+                archive.writestr("a.xml", data["a.xml"], zipfile.ZIP_DEFLATED)
+                archive.writestr("b.bin", data["b.bin"], zipfile.ZIP_STORED)
+            target = io.BytesIO()
+            with zipfile.ZipFile(source) as archive, zipfile.ZipFile(target, "w") as output:
+                for info in archive.infolist():
+                    copy_zip_member_raw(archive, info, output)
+            with zipfile.ZipFile(target) as copied:
+                _zip_raw_copy_supported = copied.testzip() is None and copied.namelist() == list(data) \
+                    and all(copied.read(name) == content for name, content in data.items())
+        except Exception as e:
+            logger.warning("当前Python版本不支持原样复制压缩包条目，将重新压缩: %s", e)
+            _zip_raw_copy_supported = False
+    return _zip_raw_copy_supported
+
+
+def copy_zip_member_raw(archive, info, output):
+    """
+    把一个条目的压缩数据原样复制到输出压缩包，不解压也不重新压缩
+    
+    zipfile 没有公开的原始复制接口，这里参照 ZipFile._open_to_write 直接写本地文件头和压缩数据，
+    再登记到输出压缩包的中央目录。CRC和大小沿用源条目，所以不需要数据描述符。
+    """
+    clone = copy.copy(info)
+    clone.flag_bits &= ~ZIP_FLAG_DATA_DESCRIPTOR
+    # zip64 扩展字段在写文件头时按需重新生成
+    clone.extra = strip_zip64_extra(info.extra)
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    
+    with archive._lock:
+        # 跳过源条目的本地文件头，定位到压缩数据
+        archive.fp.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, archive.fp.read(zipfile.sizeFileHeader))
+        if header[ZIP_FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad magic number for file header: {info.filename}")
+        archive.fp.seek(header[ZIP_FH_FILENAME_LENGTH] + header[ZIP_FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        
+        with output._lock:
+            output._writecheck(clone)
+            output._didModify = True
+            output.fp.seek(output.start_dir)
+            clone.header_offset = output.fp.tell()
+            output.fp.write(clone.FileHeader(zip64))
+            remaining = info.compress_size
+            while remaining > 0:
+                chunk = archive.fp.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise zipfile.BadZipFile(f"Truncated file data: {info.filename}")
+                output.fp.write(chunk)
+                remaining -= len(chunk)
+            output.start_dir = output.fp.tell()
+            output.filelist.append(clone)
+            output.NameToInfo[clone.filename] = clone
+
+
+class OoxmlStreamTranslator:
+    """
+    流式 OOXML 翻译引擎，不经过 python-docx 的对象模型
+
+    扫描阶段逐个部件 iterparse（正文、页眉页脚、脚注尾注），只保留紧凑的分段记录；
+    写出阶段再次 iterparse，按相同的规则定位分段，一边解析一边把双语XML写出。
+    已经处理完的元素会立即从解析树上移除，内存占用取决于分段数量，而不是整个DOM的大小。
+    分段的规则与 DocumentTranslationResource.collect_segments 一致，两种引擎的输出等价。
+    """
+
+    # 需要处理的部件类型
+    PART_CONTENT_TYPES = (
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml",
+        "application/vnd.ms-word.document.macroEnabled.main+xml",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml",
+        "application/vnd.ms-word.template.macroEnabledTemplate.main+xml",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.header+xml",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.footer+xml",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.endnotes+xml",
+    )
+    # 直接包含段落和表格的顶层容器
+    ROOT_TAGS = {qn("w:body"), qn("w:hdr"), qn("w:ftr"), W_FOOTNOTE, W_ENDNOTE}
+    # 写出时以开始/结束标签流式输出的元素，其余元素在结束时整体序列化
+    STREAM_TAGS = ROOT_TAGS | {
+        qn("w:document"), qn("w:footnotes"), qn("w:endnotes"), W_TBL, W_TR, W_TC
+    }
+    NS_DECLARATION = re.compile(rb'\sxmlns(?::([\w.\-]+))?="([^"]*)"')
+
+    def __init__(self, input_file_path):
+        self.input_file_path = input_file_path
+
+    def part_names(self, archive):
+        """根据 [Content_Types].xml 找出需要翻译的部件，正文排在最前面"""
+        content_types = etree.fromstring(archive.read("[Content_Types].xml"))
+        names = []
+        for override in content_types:
+            content_type = override.get("ContentType")
+            if content_type in self.PART_CONTENT_TYPES and override.get("PartName"):
+                names.append((self.PART_CONTENT_TYPES.index(content_type), override.get("PartName").lstrip("/")))
+        available = set(archive.namelist())
+        return [name for _, name in sorted(names) if name in available]
+
+    def walk(self, source):
+        """
+        iterparse 一个部件，产出流式处理需要的事件
+
+        产出 (事件, 元素, 分段) 三元组：
+            ("open", 元素, None)：流式容器开始
+            ("close", 元素, 分段)：流式容器结束
+            ("child", 元素, 分段)：流式容器的直接子元素结束，可以整体序列化
+            ("inner", 元素, 分段)：更深层的元素结束（只在包含文本框段落时有意义）
+        分段为 None 或 (序号, 类型)，序号在扫描和写出两个阶段中保持一致。
+        消费方处理完 "child"/"close" 事件后，元素会从树上移除（单元格中的段落保留到单元格结束）。
+        """
+        open_elements = []
+        counted_cells = []
+        slot = 0
+        for event, element in etree.iterparse(
+            source, events=("start", "end"), resolve_entities=False, no_network=True, huge_tree=True
+        ):
+            parent = element.getparent()
+            if event == "start":
+                if element.tag == W_TC:
+                    counted_cells.append(self.is_counted_cell(element, counted_cells))
+                if element.tag in self.STREAM_TAGS and (parent is None or (open_elements and parent is open_elements[-1])):
+                    open_elements.append(element)
+                    yield "open", element, None
+                continue
+            
+            segment = None
+            if element.tag == W_P and parent is not None and (parent.tag in self.ROOT_TAGS or parent.tag == W_TXBX_CONTENT):
+                segment = (slot, "paragraph")
+            elif element.tag == W_TC and counted_cells.pop():
+                segment = (slot, "cell")
+            if segment is not None:
+                slot += 1
+            
+            if open_elements and open_elements[-1] is element:
+                open_elements.pop()
+                yield "close", element, segment
+                if parent is not None:
+                    parent.remove(element)
+            elif open_elements and parent is open_elements[-1]:
+                yield "child", element, segment
+                # 单元格的段落要保留到单元格结束，用于计算单元格文本
+                if not (element.tag == W_P and parent.tag == W_TC):
+                    parent.remove(element)
+            else:
+                yield "inner", element, segment
+
+    @staticmethod
+    def is_counted_cell(tc, counted_cells):
+        """单元格所在表格直接位于顶层容器中，或位于另一个需要翻译的单元格中时才需要翻译"""
+        tr = tc.getparent()
+        tbl = tr.getparent() if tr is not None else None
+        holder = tbl.getparent() if tbl is not None else None
+        if tr.tag != W_TR or tbl is None or tbl.tag != W_TBL or holder is None:
+            return False
+        if holder.tag in OoxmlStreamTranslator.ROOT_TAGS:
+            return True
+        return holder.tag == W_TC and bool(counted_cells) and counted_cells[-1]
+
+    def scan(self):
+        """
+        扫描文档，返回紧凑的分段记录
+
+        Returns:
+            (部件名, 序号, 类型, 原文) 的列表
+        """
+        records = []
+        with zipfile.ZipFile(self.input_file_path) as archive:
+            for name in self.part_names(archive):
+                with archive.open(name) as source:
+                    for event, element, segment in self.walk(source):
+                        if segment is None:
+                            continue
+                        slot, kind = segment
+                        if kind == "paragraph":
+                            text = paragraph_text(element)
+                        else:
+                            text = cell_text(element).strip()
+                        if text.strip():
+                            records.append((name, slot, kind, text))
+        return records
+
+    def write(self, output_file_path, translations):
+        """
+        写出双语文档
+
+        Args:
+            output_file_path: 输出文件路径
+            translations: {(部件名, 序号): (原文, 翻译文本)}
+        """
+        # 只重写包含译文的部件，其余部件（图片、样式等）原样复制压缩数据
+        changed_parts = {part_name for part_name, _ in translations}
+        with zipfile.ZipFile(self.input_file_path) as archive, \
+                zipfile.ZipFile(output_file_path, "w", zipfile.ZIP_DEFLATED) as output:
+            for info in archive.infolist():
+                if info.filename in changed_parts:
+                    with archive.open(info) as source, output.open(clone_zip_info(info), "w") as target:
+                        self.write_part(source, target, info.filename, translations)
+                else:
+                    copy_zip_member(archive, info, output)
+
+    def write_part(self, source, target, part_name, translations):
+        """流式改写一个部件"""
+        declared = {}
+        # 当前所在单元格的第一个段落的格式和文本：(格式骨架, 文本)
+        cell_first_paragraphs = []
+        target.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n')
+        for event, element, segment in self.walk(source):
+            if event == "open":
+                target.write(self.start_tag(element, declared))
+                if not declared:
+                    declared = dict(element.nsmap)
+                if element.tag == W_TC:
+                    cell_first_paragraphs.append(None)
+                continue
+            
+            translation = translations.get((part_name, segment[0])) if segment is not None else None
+            if event == "close":
+                if element.tag == W_TC:
+                    first = cell_first_paragraphs.pop()
+                    if translation is not None and first is not None:
+                        skeleton, first_paragraph_text = first
+                        source_text, translated_text = translation
+                        if should_append_cell_translation(source_text, first_paragraph_text, translated_text):
+                            target.write(self.serialize(build_translation_paragraph(skeleton, translated_text), declared))
+                target.write(self.end_tag(element))
+                continue
+            
+            # 流式单元格的直接子段落，父元素就是当前所在的单元格
+            if event == "child" and element.tag == W_P and element.getparent().tag == W_TC \
+                    and cell_first_paragraphs[-1] is None:
+                cell_first_paragraphs[-1] = (paragraph_format_skeleton(element), paragraph_text(element))
+            if event == "inner":
+                # 文本框中的段落位于一个还没有写出的元素内部，直接在树上插入译文
+                if translation is not None:
+                    element.addnext(build_translation_paragraph(element, translation[1]))
+                continue
+            
+            target.write(self.serialize(element, declared))
+            if translation is not None and segment[1] == "paragraph":
+                target.write(self.serialize(build_translation_paragraph(element, translation[1]), declared))
+
+    def serialize(self, element, declared):
+        """序列化一个完整的子树，去掉根元素上已经声明过的命名空间"""
+        return self.strip_declared(etree.tostring(element, encoding="UTF-8", with_tail=False), declared)
+
+    def start_tag(self, element, declared):
+        shallow = etree.Element(element.tag, dict(element.attrib), nsmap=element.nsmap)
+        data = etree.tostring(shallow, encoding="UTF-8")
+        # "<w:body .../>" -> "<w:body ...>"
+        return self.strip_declared(data[:-2] + b">", declared)
+
+    @staticmethod
+    def end_tag(element):
+        local_name = etree.QName(element).localname
+        tag = f"{element.prefix}:{local_name}" if element.prefix else local_name
+        return f"</{tag}>".encode("utf-8")
+
+    def strip_declared(self, data, declared):
+        if not declared:
+            return data
+        end = data.index(b">")
+
+        def replace(match):
+            prefix = match.group(1).decode() if match.group(1) else None
+            return b"" if declared.get(prefix) == match.group(2).decode() else match.group(0)
+
+        return self.NS_DECLARATION.sub(replace, data[:end]) + data[end:]
+
+
+class PreviousTranslation:
+    """
+    文档上一个版本的原文和译文，用于增量翻译修订后的文档
+
+    从上一版原文和它的双语译文中还原出每个分段的译文，再与新版本的分段对齐：
+    先按内容哈希序列做差异比对，未改动区域中的分段按位置沿用原译文（同一原文在不同位置的不同译法得以保留）；
+    其余分段（例如被移动的段落）按内容哈希查找；都找不到的才需要请求API。
+    """
+
+    # 在双语文档中寻找原文分段时，最多向后查找的分段数
+    SEARCH_WINDOW = 50
+
+    def __init__(self, pairs):
+        # 上一版原文中每个分段的 (原文, 译文)，没有译文的为None
+        self.pairs = pairs
+        self.hashes = [self.content_hash(source) for source, _ in pairs]
+        self.by_hash = {}
+        for content_hash, (_, translation) in zip(self.hashes, pairs):
+            if translation is not None:
+                self.by_hash.setdefault(content_hash, translation)
+
+    @staticmethod
+    def content_hash(text):
+        return hashlib.sha256(translation_memory.normalize(text).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def load(cls, source_file_path, translated_file_path):
+        """
+        从上一版原文和双语译文中提取分段译文
+
+        双语文档中，译文段落紧跟在原文段落之后，单元格的译文是单元格末尾追加的段落。
+        两份文档按部件逐个扫描，依次在双语文档中定位原文分段，再读取紧随其后的译文。
+
+        Args:
+            source_file_path: 上一版原文路径
+            translated_file_path: 上一版双语译文路径
+        """
+        def by_part(records):
+            parts = {}
+            for part_name, _, kind, text in records:
+                parts.setdefault(part_name, []).append((kind, text))
+            return parts
+
+        source_parts = by_part(OoxmlStreamTranslator(source_file_path).scan())
+        translated_parts = by_part(OoxmlStreamTranslator(translated_file_path).scan())
+        pairs = []
+        for part_name, sources in source_parts.items():
+            translated = translated_parts.get(part_name, [])
+            position = 0
+            for index, (kind, text) in enumerate(sources):
+                match = next((
+                    candidate for candidate in range(position, min(len(translated), position + cls.SEARCH_WINDOW))
+                    if translated[candidate][0] == kind and cls.is_source_of(text, translated[candidate][1], kind)
+                ), None)
+                if match is None:
+                    pairs.append((text, None))
+                    continue
+                position = match + 1
+                if kind == "cell":
+                    translation = translated[match][1][len(text):].strip()
+                    pairs.append((text, translation or None))
+                    continue
+                # 下一个分段就是原文中的下一个段落时，说明这个段落没有译文（例如原样保留的数字、编号）
+                following = sources[index + 1] if index + 1 < len(sources) else None
+                if position < len(translated) and translated[position][0] == "paragraph" \
+                        and translated[position] != following:
+                    pairs.append((text, translated[position][1]))
+                    position += 1
+                else:
+                    pairs.append((text, None))
+        return cls(pairs)
+
+    @staticmethod
+    def is_source_of(source_text, translated_text, kind):
+        if kind == "cell":
+            return translated_text == source_text or translated_text.startswith(source_text + "\n")
+        return translated_text == source_text
+
+    def align(self, texts):
+        """
+        把新版本的分段与上一版对齐
+
+        Args:
+            texts: 新版本的分段原文列表
+
+        Returns:
+            (与 texts 一一对应的可沿用译文，不能沿用的为None, 按位置沿用的数量, 按内容沿用的数量)
+        """
+        hashes = [self.content_hash(text) for text in texts]
+        results = [None] * len(texts)
+        by_position = 0
+        matcher = difflib.SequenceMatcher(None, self.hashes, hashes, autojunk=False)
+        for old_start, new_start, size in matcher.get_matching_blocks():
+            for offset in range(size):
+                translation = self.pairs[old_start + offset][1]
+                if translation is not None:
+                    results[new_start + offset] = translation
+                    by_position += 1
+        by_content = 0
+        for index, content_hash in enumerate(hashes):
+            if results[index] is None and content_hash in self.by_hash:
+                results[index] = self.by_hash[content_hash]
+                by_content += 1
+        return results, by_position, by_content
+
+
+class DocumentDownloadError(Exception):
+    """从CDN下载文档失败"""
+
+
+class TranslationJob:
+    """
+    一个后台执行的文档翻译任务
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.status = "queued"
+        self.context = TranslationContext()
+        # 任务所属的追踪trace，提交任务时确定
+        self.trace_id = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        """返回任务状态，包括进度和预计剩余时间"""
+        stats = self.context.summary()
+        done = stats.get("segments_done", 0)
+        total = stats.get("segments_total", 0)
+        eta = None
+        if self.status == "running" and self.started_at and done and total:
+            elapsed = time.time() - self.started_at
+            eta = round(elapsed / done * (total - done), 1)
+        elif self.status in ("succeeded", "failed"):
+            eta = 0
+        data = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "segments_done": done,
+            "segments_total": total,
+            "eta_seconds": eta,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "file_url": (self.result or {}).get("file_url", ""),
+            "result": self.result,
+            "error": self.error,
+            "trace_id": self.trace_id,
+            "success": self.status != "failed",
+        }
+        # 批量翻译任务：已经完成的文档结果，运行过程中逐个增加
+        if self.context.documents:
+            data["documents"] = sorted(list(self.context.documents), key=lambda document: document["index"])
+        return data
+
+
+class TranslationJobManager:
+    """
+    有界的后台线程池，用于执行异步翻译任务并保存任务状态
+    """
+
+    def __init__(self, max_workers, max_pending, ttl):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="translation-job")
+
+    def submit(self, func, *args, team_id=None):
+        """
+        提交任务，func 会以 context=任务上下文 的关键字参数被调用
+
+        Args:
+            team_id: 提交任务的团队，任务中的上游请求按团队公平排队
+
+        Returns:
+            TranslationJob，排队任务过多时返回None
+        """
+        with self._lock:
+            self._cleanup()
+            pending = sum(1 for job in self.jobs.values() if job.status in ("queued", "running"))
+            if pending >= self.max_pending:
+                return None
+            job = TranslationJob(str(uuid.uuid4()))
+            job.context.team_id = team_id
+            self.jobs[job.job_id] = job
+        # 任务在后台线程中执行，span 作为提交请求的子span
+        span = tracer.start_span("translation_job", job_id=job.job_id)
+        job.trace_id = span.trace_id
+        self._executor.submit(self._run, job, func, args, span)
+        return job
+
+    def _run(self, job, func, args, span):
+        job.status = "running"
+        job.started_at = time.time()
+        span.set_attribute("queued_ms", round((time.time_ns() - span.start_ns) / 1e6, 3))
+        with tracer.activate(span):
+            try:
+                job.result = func(*args, context=job.context)
+                job.status = "succeeded"
+            except Exception as e:
+                logger.exception("翻译任务 %s 失败", job.job_id)
+                job.error = str(e)
+                job.status = "failed"
+                span.set_error(e)
+            finally:
+                job.finished_at = time.time()
+                tracer.finish(span)
+
+    def _cleanup(self):
+        # 清理超过保留时间的已完成任务
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished_at and now - job.finished_at > self.ttl
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def summary(self):
+        """返回各状态的任务数量"""
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "succeeded": 0, "failed": 0}
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return counts
+
+
+translation_jobs = TranslationJobManager(
+    Config.TRANSLATION_JOB_WORKERS, Config.TRANSLATION_JOB_MAX_PENDING, Config.TRANSLATION_JOB_TTL
+)
+
+
+def translation_memory_hit_ratio():
+    lookups = translation_memory_lookups_total.samples()
+    total = sum(value for _, _, _, value in lookups)
+    hits = sum(value for _, key, _, value in lookups if key != ("miss",))
+    return {(): hits / total if total else 0}
+
+
+# 以下指标在导出时读取当前状态，不占用热路径
+metrics.gauge(
+    "translation_jobs", "Translation jobs by status", ("status",),
+    lambda: {(status,): count for status, count in translation_jobs.summary().items()}
+)
+metrics.gauge("translation_memory_hit_ratio", "Share of translation memory lookups that hit", (), translation_memory_hit_ratio)
+metrics.gauge(
+    "upstream_requests_in_flight", "Upstream requests holding a scheduler slot", (),
+    lambda: {(): upstream_scheduler.active}
+)
+metrics.gauge(
+    "upstream_requests_queued", "Upstream requests waiting for a scheduler slot", (),
+    lambda: {(): sum(dict(upstream_scheduler.queued_by_team).values())}
+)
+metrics.gauge(
+    "sidecar_circuit_open", "1 when the translation sidecar circuit breaker is open", (),
+    lambda: {(): 1 if sidecar_breaker.summary()["state"] == "open" else 0}
+)
+
+class NoSuccessfulRequestLoggingFilter(logging.Filter):
+    def filter(self, record):
+        return "GET /" not in record.getMessage()
+
+# 获取 Flask 的默认日志记录器
+log = logging.getLogger("werkzeug")
+# 创建并添加过滤器
+log.addFilter(NoSuccessfulRequestLoggingFilter())
+
+@app.before_request
+def before_request():
+    request.started_at = time.perf_counter()
+    request.app_id = request.headers.get("x-monkeys-appid")
+    request.user_id = request.headers.get("x-monkeys-userid")
+    request.team_id = request.headers.get("x-monkeys-teamid")
+    request.workflow_id = request.headers.get("x-monkeys-workflowid")
+    request.workflow_instance_id = request.headers.get("x-monkeys-workflow-instanceid")
+    # 每个请求一个根span，工作流相关的ID作为标签传给所有子span；不追踪指标抓取请求
+    if http_namespace(request.path) == "metrics":
+        return
+    request.span = tracer.start_span(
+        f"{request.method} {request.path}", tags=workflow_tags(request.headers), **{"http.method": request.method}
+    )
+    request.span_token = current_span.set(request.span)
+
+@app.after_request
+def after_request(response):
+    namespace = http_namespace(request.path)
+    http_requests_total.inc(namespace, request.method, str(response.status_code))
+    started_at = getattr(request, "started_at", None)
+    if started_at is not None:
+        http_request_duration_seconds.observe(time.perf_counter() - started_at, namespace)
+    span = getattr(request, "span", None)
+    if span is not None:
+        span.set_attribute("http.status_code", response.status_code)
+        response.headers["X-Trace-Id"] = span.trace_id
+    return response
+
+@app.teardown_request
+def teardown_request(error=None):
+    span = getattr(request, "span", None)
+    if span is None:
+        return
+    if error is not None:
+        span.set_error(error)
+    current_span.reset(request.span_token)
+    tracer.finish(span)
+
+# 添加静态文件托管路由
+@app.route('/files/<path:filename>')
+def serve_file(filename):
+    """提供对文件的访问"""
+    file_path = os.path.join(Config.OUTPUT_FILES_DIR, filename)
+    response = send_file(file_path)
+    bytes_served_total.inc(value=os.path.getsize(file_path))
+    return response
+
+@app.route('/metrics')
+def serve_metrics():
+    """以 Prometheus 文本格式导出指标"""
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@api.errorhandler(Exception)
+def handle_exception(error):
+    return {"message": str(error)}, 500
+
+@app.get("/manifest.json")
+def get_manifest():
+    return {
+        "schema_version": "v1",
+        "display_name": "Deyong",
+        "namespace": "monkey_tools_deyong",
+        "auth": {"type": "none"},
+        "api": {"type": "openapi", "url": "/swagger.json"},
+        "contact_email": "dev@inf-monkeys.com",
+        "categories": ["ai", "translation", "document"],
+        "description": {
+            "zh-CN": "Deyong Tools",
+            "en-US": "Deyong Tools"
+        },
+        "icon": "emoji:📄:#3a8fe5",
+        "credentials": [
+            {
+                "name": "cursor-ai",
+                "type": "aksk",
+                "displayName": {
+                    "zh-CN": "Cursor AI",
+                    "en-US": "Cursor AI"
+                },
+                "iconUrl": "emoji:🤖:#3a8fe5",
+                "properties": [
+                    {
+                        "displayName": {
+                            "zh-CN": "从 Cursor AI 获取你的 API Key",
+                            "en-US": "Get your API Key from Cursor AI"
+                        },
+                        "type": "notice",
+                        "name": "docs"
+                    },
+                    {
+                        "displayName": {
+                            "zh-CN": "API Key",
+                            "en-US": "API Key"
+                        },
+                        "type": "string",
+                        "name": "api_key",
+                        "required": True
+                    }
+                ]
+            },
+            {
+                "name": "dify",
+                "type": "aksk",
+                "displayName": {
+                    "zh-CN": "Dify",
+                    "en-US": "Dify"
+                },
+                "iconUrl": "https://dify.ai/favicon.ico",
+                "properties": [
+                    {
+                        "displayName": {
+                            "zh-CN": "从 [Dify](https://dify.ai) 获取你的 API Key",
+                            "en-US": "Get your API Key from [Dify](https://dify.ai)"
+                        },
+                        "type": "notice",
+                        "name": "docs"
+                    },
+                    {
+                        "displayName": {
+                            "zh-CN": "API Key",
+                            "en-US": "API Key"
+                        },
+                        "type": "string",
+                        "name": "api_key",
+                        "required": True
+                    }
+                ]
+            }
+        ]
+    }
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    file_base64 = None
+    file_type = None
+    
+    # 检查是否是从本地上传的文件
+    if 'file' in request.files and request.files['file'].filename != '':
+        file = request.files['file']
+        
+        # 获取文件类型
+        file_type = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
+        if file_type not in ['jpg', 'jpeg', 'png', 'bmp', 'pdf']:
+            return jsonify({'error': '不支持的文件类型'}), 400
+        
+        # 保存文件
+        filename = secure_filename(file.filename)
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        file.save(file_path)
+        
+        # 将文件转换为base64编码
+        with open(file_path, 'rb') as f:
+            file_content = f.read()
+            file_base64 = base64.b64encode(file_content).decode('utf-8')
+        
+        # 删除临时文件
+        os.remove(file_path)
+        
+    # 检查是否提供了CDN URL
+    elif 'cdn_url' in request.form and request.form['cdn_url'] != '':
+        cdn_url = request.form['cdn_url']
+        
+        try:
+            # 从URL获取文件内容
+            response = requests.get(cdn_url, stream=True)
+            response.raise_for_status() # 确保请求成功
+            
+            # 从URL中提取文件类型
+            content_type = response.headers.get('Content-Type', '')
             if 'image/jpeg' in content_type:
                 file_type = 'jpg'
             elif 'image/png' in content_type:
@@ -381,6 +2990,47 @@ class DocumentTranslationResource(Resource):
                     "name": "special_requirements",
                     "type": "string",
                     "required": False,
+                },
+                {
+                    "displayName": {
+                        "zh-CN": "异步任务模式",
+                        "en-US": "Async Job Mode",
+                    },
+                    "name": "async",
+                    "type": "boolean",
+                    "required": False,
+                },
+                {
+                    "displayName": {
+                        "zh-CN": "翻译引擎",
+                        "en-US": "Translation Engine",
+                    },
+                    "name": "engine",
+                    "type": "options",
+                    "options": [
+                        {"name": "python-docx", "value": "docx"},
+                        {"name": "Streaming OOXML", "value": "stream"},
+                    ],
+                    "default": "docx",
+                    "required": False,
+                },
+                {
+                    "displayName": {
+                        "zh-CN": "上一版文档CDN URL",
+                        "en-US": "Previous Document CDN URL",
+                    },
+                    "name": "previous_document_url",
+                    "type": "string",
+                    "required": False,
+                },
+                {
+                    "displayName": {
+                        "zh-CN": "上一版译文CDN URL",
+                        "en-US": "Previous Translation CDN URL",
+                    },
+                    "name": "previous_translated_url",
+                    "type": "string",
+                    "required": False,
                 }
             ],
             "x-monkey-tool-output": [
@@ -413,206 +3063,907 @@ class DocumentTranslationResource(Resource):
         
         Returns a Word document with the translated content.
         """
+        team_id = current_team_id()
         try:
-            # 获取JSON请求数据
-            json_data = request.json
-            if not json_data:
-                return {
-                    "file_url": "",
-                    "success": False,
-                    "message": "无效的请求数据。必须提供有效的JSON数据。"
-                }, 400
-                
-            api_key = json_data.get('api_key')
-            if not api_key:
-                return {
-                    "file_url": "",
-                    "success": False,
-                    "message": "Missing API key"
-                }, 401
-                
-            target_language = json_data.get('target_language')
-            special_requirements = json_data.get('special_requirements', '')
-            document_url = json_data.get('document_url')
+            params, error = self.parse_request(request.json)
+            if error is not None:
+                return error
             
-            if not target_language:
-                return {
-                    "file_url": "",
-                    "success": False,
-                    "message": "Missing target language parameter"
-                }, 400
-                
-            if not document_url:
-                return {
-                    "file_url": "",
-                    "success": False,
-                    "message": "未提供文档CDN URL"
-                }, 400
-                
-            # Create a temporary file to store the document
-            temp_dir = tempfile.mkdtemp()
-            input_file_path = os.path.join(temp_dir, f"input_{uuid.uuid4()}.docx")
-            output_file_path = os.path.join(temp_dir, f"output_{uuid.uuid4()}.docx")
+            # 异步任务模式：立即返回任务ID，由后台线程池执行翻译
+            if params.pop("async"):
+                return self.submit_job(params, team_id)
             
-            # 从URL中提取文件名
-            url_path = urllib.parse.urlparse(document_url).path
-            file_name = os.path.basename(url_path)
-            if not file_name.endswith('.docx'):
-                return {
-                    "file_url": "",
-                    "success": False,
-                    "message": "只支持 .docx 格式的文件"
-                }, 400
-                
+            context = TranslationContext(team_id=team_id)
             try:
-                # 从URL下载文件
-                response = requests.get(document_url, stream=True)
-                response.raise_for_status()  # 确保请求成功
-                
-                # 保存下载的文件
-                with open(input_file_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                        
-            except requests.exceptions.RequestException as e:
+                return self.run_translation(**params, context=context)
+            except DocumentDownloadError as e:
                 return {
                     "file_url": "",
                     "success": False,
-                    "message": f"无法从CDN URL下载文件: {str(e)}"
+                    "message": str(e)
                 }, 400
                 
-            # 处理文档
-            translated_doc = self.translate_document(input_file_path, target_language, special_requirements, api_key)
-            translated_doc.save(output_file_path)
-            
-            # 删除输入临时文件，但保留输出文件以供上传到S3
-            os.remove(input_file_path)
+        except Exception as e:
+            logger.exception("文档翻译请求处理失败")
+            return {
+                "file_url": "",
+                "success": False,
+                "message": str(e)
+            }, 500
+
+    @staticmethod
+    def parse_request(json_data):
+        """
+        校验文档翻译请求，WSGI 和 ASGI 模式共用
+        
+        Args:
+            json_data: 请求数据
+        
+        Returns:
+            (run_translation 的参数加上 async 标志, None)，请求无效时返回 (None, (响应数据, HTTP状态码))
+        """
+        if not json_data:
+            return None, ({
+                "file_url": "",
+                "success": False,
+                "message": "无效的请求数据。必须提供有效的JSON数据。"
+            }, 400)
             
-            # 创建一个持久化的输出目录，确保S3上传工具能访问到
-            output_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'output_files')
-            os.makedirs(output_dir, exist_ok=True)
+        api_key = json_data.get('api_key')
+        if not api_key:
+            return None, ({
+                "file_url": "",
+                "success": False,
+                "message": "Missing API key"
+            }, 401)
             
-            # 生成一个有意义的文件名，包含时间戳和原始文件名
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            original_filename = os.path.basename(url_path)
-            filename_base, _ = os.path.splitext(original_filename)
-            persistent_filename = f"{filename_base}_{target_language}_{timestamp}.docx"
-            persistent_filepath = os.path.join(output_dir, persistent_filename)
+        target_language = json_data.get('target_language')
+        special_requirements = json_data.get('special_requirements', '')
+        document_url = json_data.get('document_url')
+        engine = json_data.get('engine') or Config.TRANSLATION_ENGINE
+        previous_document_url = json_data.get('previous_document_url')
+        previous_translated_url = json_data.get('previous_translated_url')
+        
+        if not target_language:
+            return None, ({
+                "file_url": "",
+                "success": False,
+                "message": "Missing target language parameter"
+            }, 400)
             
-            # 复制翻译后的文件到持久化目录
-            shutil.copy2(output_file_path, persistent_filepath)
+        if not document_url:
+            return None, ({
+                "file_url": "",
+                "success": False,
+                "message": "未提供文档CDN URL"
+            }, 400)
+        
+        if engine not in TRANSLATION_ENGINES:
+            return None, ({
+                "file_url": "",
+                "success": False,
+                "message": f"不支持的翻译引擎: {engine}，可选值为 {', '.join(TRANSLATION_ENGINES)}"
+            }, 400)
             
-            # 清理剩余的临时文件
-            os.remove(output_file_path)
-            os.rmdir(temp_dir)
+        # 从URL中提取文件名
+        url_path = urllib.parse.urlparse(document_url).path
+        file_name = os.path.basename(url_path)
+        if not file_name.endswith('.docx'):
+            return None, ({
+                "file_url": "",
+                "success": False,
+                "message": "只支持 .docx 格式的文件"
+            }, 400)
+        
+        # 增量翻译需要同时提供上一版原文和上一版译文
+        if bool(previous_document_url) != bool(previous_translated_url):
+            return None, ({
+                "file_url": "",
+                "success": False,
+                "message": "previous_document_url 和 previous_translated_url 必须同时提供"
+            }, 400)
+        previous_urls = (previous_document_url, previous_translated_url) if previous_document_url else None
+        return {
+            "document_url": document_url,
+            "target_language": target_language,
+            "special_requirements": special_requirements,
+            "api_key": api_key,
+            "engine": engine,
+            "previous_urls": previous_urls,
+            "async": bool(json_data.get('async')),
+        }, None
+
+    def submit_job(self, params, team_id=None):
+        """把文档翻译提交到后台任务队列，立即返回任务ID"""
+        job = translation_jobs.submit(
+            self.run_translation, params["document_url"], params["target_language"], params["special_requirements"],
+            params["api_key"], params["engine"], params["previous_urls"], team_id=team_id
+        )
+        if job is None:
+            return {
+                "file_url": "",
+                "success": False,
+                "message": "翻译任务队列已满，请稍后重试"
+            }, 429
+        return {
+            "job_id": job.job_id,
+            "status": job.status,
+            "status_url": f"/ai_translation/jobs/{job.job_id}",
+            "file_url": "",
+            "success": True,
+            "message": f"翻译任务已提交，可通过 /ai_translation/jobs/{job.job_id} 查询进度"
+        }, 202
+
+    def run_translation(self, document_url, target_language, special_requirements, api_key, engine=None,
+                        previous_urls=None, context=None):
+        """
+        下载文档、翻译并保存到文件托管目录
+        
+        Args:
+            document_url: 文档CDN URL
+            target_language: 目标语言
+            special_requirements: 特殊翻译要求
+            api_key: API密钥
+            engine: 本地翻译引擎，"docx" 或 "stream"
+            previous_urls: 上一版原文和上一版双语译文的URL，传入时沿用未修改分段的译文
+            context: 翻译上下文
+        
+        Returns:
+            包含文件URL和统计信息的结果字典
+        """
+        if context is None:
+            context = TranslationContext()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            input_file_path, output_file_path = self.download_inputs(document_url, previous_urls, temp_dir, context)
+            # 处理文档
+            self.translate_document(input_file_path, output_file_path, target_language, special_requirements, api_key, context, engine)
+            return self.publish_document(document_url, output_file_path, target_language, context)
+        finally:
+            # 清理临时文件
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    async def run_translation_async(self, document_url, target_language, special_requirements, api_key, engine=None,
+                                    previous_urls=None, context=None):
+        """
+        run_translation 的协程版本，ASGI 模式下直接在服务器的事件循环中执行，参数与 run_translation 相同
+        
+        下载、解析和保存文档在线程中执行，不占用 ASGI 服务转发同步接口的线程。
+        """
+        if context is None:
+            context = TranslationContext()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            input_file_path, output_file_path = await asyncio.to_thread(
+                self.download_inputs, document_url, previous_urls, temp_dir, context
+            )
+            await self.translate_document_async(
+                input_file_path, output_file_path, target_language, special_requirements, api_key, context, engine
+            )
+            return await asyncio.to_thread(self.publish_document, document_url, output_file_path, target_language, context)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+
+    def download_inputs(self, document_url, previous_urls, temp_dir, context):
+        """
+        把文档（以及增量翻译的上一版原文和译文）下载到临时目录
+        
+        Args:
+            document_url: 文档CDN URL
+            previous_urls: 上一版原文和上一版双语译文的URL，可以为None
+            temp_dir: 临时目录
+            context: 翻译上下文，读取到上一版译文时保存在 context.reference 中
+        
+        Returns:
+            (输入文档路径, 输出文档路径)
+        """
+        # Create a temporary file to store the document
+        input_file_path = os.path.join(temp_dir, f"input_{uuid.uuid4()}.docx")
+        output_file_path = os.path.join(temp_dir, f"output_{uuid.uuid4()}.docx")
+        
+        # 从URL下载文件
+        with context.phase("download"):
+            self.download_file(document_url, input_file_path)
+            if previous_urls:
+                previous_paths = [os.path.join(temp_dir, f"previous_{uuid.uuid4()}.docx") for _ in previous_urls]
+                for url, path in zip(previous_urls, previous_paths):
+                    self.download_file(url, path)
+        
+        if previous_urls:
+            try:
+                context.reference = PreviousTranslation.load(*previous_paths)
+            except (zipfile.BadZipFile, KeyError, etree.XMLSyntaxError) as e:
+                # 上一版文档无法解析时退回完整翻译
+                logger.warning("无法读取上一版文档，将完整翻译: %s", e)
+        return input_file_path, output_file_path
+
+    def publish_document(self, document_url, output_file_path, target_language, context):
+        """
+        把翻译后的文档复制到文件托管目录
+        
+        Args:
+            document_url: 原文档CDN URL，用于生成输出文件名
+            output_file_path: 翻译后的文档路径
+            target_language: 目标语言
+            context: 翻译上下文
+        
+        Returns:
+            包含文件URL和统计信息的结果字典
+        """
+        url_path = urllib.parse.urlparse(document_url).path
+        
+        # 创建一个持久化的输出目录，确保S3上传工具能访问到
+        output_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'output_files')
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # 生成一个有意义的文件名，包含时间戳和原始文件名
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        original_filename = os.path.basename(url_path)
+        filename_base, _ = os.path.splitext(original_filename)
+        persistent_filename = f"{filename_base}_{target_language}_{timestamp}.docx"
+        persistent_filepath = os.path.join(output_dir, persistent_filename)
+        
+        # 复制翻译后的文件到持久化目录
+        shutil.copy2(output_file_path, persistent_filepath)
+        
+        # 生成可访问的URL
+        file_url = f"{Config.FILE_ACCESS_URL_PREFIX}{persistent_filename}"
+        
+        # 返回文件URL和相关信息
+        return {
+            "file_path": persistent_filepath,     # 本地文件系统路径（用于调试）
+            "file_url": file_url,                # 可访问的URL
+            "publicAccessUrl": file_url,         # 给S3用的公开访问URL
+            "filename": persistent_filename,      # 文件名
+            "stats": context.summary(),          # 翻译统计信息（翻译记忆命中等）
+            "timings": context.timing_summary(), # 各处理阶段的耗时（秒）
+            "untranslated_segments": context.summary().get("untranslated", 0),  # 重试后仍未翻译的段落数
+            "success": True,
+            "message": f"文档翻译成功，可通过 {file_url} 访问"
+        }
+
+    def build_system_prompt(self, target_language, special_requirements=""):
+        """构建单段翻译使用的系统提示词"""
+        return f"你是一个专业的中文到{target_language}翻译器。请将用户提供的中文文本翻译成{target_language}，只输出翻译结果，不要有任何解释或额外内容。保持原始格式，但不要重复原文中的标点符号，特别是在行尾的标点符号。如果原文中有标点符号，请使用{target_language}中的对应标点符号，而不是重复使用原文的标点符号。如果遇到单独的字母或数字，请保持原样不翻译。如果文本中包含“百”、“千”、“万”等数字单位，请按照特定规则翻译。{special_requirements if special_requirements else ''}"
+
+    def glossary_terms(self, texts, target_language):
+        """
+        找出文本中出现的术语
+        
+        Args:
+            texts: 文本列表
+            target_language: 目标语言
+        
+        Returns:
+            按出现顺序排列、去重后的 (术语, 译法) 列表
+        """
+        glossary = glossary_store.get(target_language)
+        if glossary is None:
+            return []
+        matched = {}
+        for text in texts:
+            for term, translation in glossary.match(text):
+                matched.setdefault(term, translation)
+        return list(matched.items())
+
+    @staticmethod
+    def build_glossary_prompt(terms):
+        """把术语列表格式化为追加在系统提示词后面的说明"""
+        if not terms:
+            return ""
+        lines = "\n".join(f"{term} => {translation}" for term, translation in terms)
+        return f"\n以下术语必须使用指定的译法：\n{lines}"
+
+    def make_memory_key(self, text, target_language, special_requirements=""):
+        """翻译记忆的键，提示词中注入的术语也参与计算，术语表更新后不会命中旧的翻译"""
+        glossary_prompt = self.build_glossary_prompt(self.glossary_terms([text], target_language))
+        return translation_memory.make_key(text, target_language, (special_requirements or "") + glossary_prompt, TRANSLATION_MODEL)
+
+    def build_packed_system_prompt(self, target_language, special_requirements=""):
+        """构建多段打包翻译使用的系统提示词，要求按编号返回结构化结果"""
+        return (
+            self.build_system_prompt(target_language, special_requirements)
+            + '\n用户会以JSON格式提供多段待翻译文本：{"segments": [{"id": 1, "text": "..."}, ...]}。'
+            + '请逐段独立翻译，并且只输出如下格式的JSON：{"translations": [{"id": 1, "text": "..."}, ...]}。'
+            + "每个id必须且只能出现一次，数量与输入完全一致，不要合并或拆分段落。"
+        )
+
+    async def request_completion(self, session, messages, api_key=None):
+        """
+        发送一次 chat completion 请求
+        
+        Args:
+            session: aiohttp 客户端会话
+            messages: 对话消息列表
+            api_key: API密钥
+        
+        Returns:
+            模型返回的文本，失败时返回None
+        """
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        
+        # 新的OpenAI API格式要求有user参数
+        data = {
+            "model": TRANSLATION_MODEL,
+            "messages": messages,
+            "temperature": 0.3,
+            "user": "translation_service"  # 添加user参数以满足API要求
+        }
+        
+        with observe_upstream("translation") as call:
+            async with session.post(f"{API_URL}/v1/chat/completions", headers=headers, json=data) as response:
+                call["status"] = response.status
+                # 限流和服务端错误可以重试
+                if response.status == 429 or response.status >= 500:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    raise RetryableUpstreamError(f"上游返回 {response.status}", response.status, retry_after)
                 
-            # 生成可访问的URL
-            file_url = f"{Config.FILE_ACCESS_URL_PREFIX}{persistent_filename}"
-            
-            # 返回文件URL和相关信息
-            return {
-                "file_path": persistent_filepath,     # 本地文件系统路径（用于调试）
-                "file_url": file_url,                # 可访问的URL
-                "publicAccessUrl": file_url,         # 给S3用的公开访问URL
-                "filename": persistent_filename,      # 文件名
-                "success": True,
-                "message": f"文档翻译成功，可通过 {file_url} 访问"
-            }
+                response_data = await response.json(content_type=None)
                 
-        except Exception as e:
-            traceback.print_exc()
-            return {
-                "file_url": "",
-                "success": False,
-                "message": str(e)
-            }, 500
+                # 处理 API 响应
+                if response.status == 200 and "choices" in response_data:
+                    return response_data["choices"][0]["message"]["content"]
+                logger.warning("翻译失败: %s - %s", response.status, response_data)
+                return None
 
-    async def translate_text_async(self, text, session, target_language, special_requirements="", api_key=None):
+    async def request_completion_with_retry(self, session, messages, api_key=None, context=None):
         """
-        使用 GPT-4o API 异步翻译中文文本
+        发送 chat completion 请求，遇到 429/5xx/网络错误时按指数退避重试
+        
+        优先使用上游返回的 Retry-After，否则使用带随机抖动的指数退避；
+        每个文档的重试次数受 context 中的重试预算限制。
         
         Args:
-            text: 要翻译的文本
             session: aiohttp 客户端会话
+            messages: 对话消息列表
+            api_key: API密钥
+            context: 翻译上下文，用于扣减重试预算
+        
+        Returns:
+            模型返回的文本，失败时返回None
+        """
+        attempt = 0
+        while True:
+            try:
+                # 经过进程级的上游调度器排队，退避等待期间不占用名额
+                cost = sum(estimate_tokens(message["content"]) for message in messages)
+                team_id = context.team_id if context else None
+                async with upstream_scheduler.slot(api_key, team_id, cost, context):
+                    return await self.request_completion(session, messages, api_key)
+            except (RetryableUpstreamError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempt += 1
+                if attempt >= Config.RETRY_MAX_ATTEMPTS or (context and not context.consume_retry()):
+                    logger.warning("翻译请求重试次数已用尽: %s", str(e) or type(e).__name__)
+                    return None
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is not None:
+                    delay = min(retry_after, Config.RETRY_MAX_DELAY)
+                else:
+                    delay = random.uniform(0, min(Config.RETRY_MAX_DELAY, Config.RETRY_BASE_DELAY * 2 ** attempt))
+                if context:
+                    context.incr("retries")
+                logger.info("翻译请求失败，%.1f 秒后第 %d 次重试: %s", delay, attempt, str(e) or type(e).__name__)
+                await asyncio.sleep(delay)
+
+    def lookup_translation(self, text, target_language, special_requirements="", context=None):
+        """
+        在不调用API的情况下尝试得到翻译结果
+        
+        Args:
+            text: 要翻译的文本
             target_language: 目标语言
             special_requirements: 特殊翻译要求
+            context: 翻译上下文，用于记录翻译记忆命中情况
         
         Returns:
-            翻译后的文本
+            (翻译结果, 翻译记忆键)，无法在本地得到结果时翻译结果为None
         """
         if not text.strip():
-            return ""
+            return "", None
         
         # 检查是否为单独的字符或阿拉伯数字
         if len(text.strip()) <= 1 or text.strip().isdigit():
-            return text
+            return text, None
+        
+        # 整段文本是术语表中的术语时直接使用固定译法
+        glossary = glossary_store.get(target_language)
+        if glossary is not None:
+            fixed = glossary.exact(text)
+            if fixed is not None:
+                if context:
+                    context.incr("glossary_hits")
+                return fixed, None
+        
+        # 数字、日期、编号以及不含中文的文本原样保留
+        category = classify_passthrough(text)
+        if category is not None:
+            if context:
+                context.incr("segments_skipped")
+                context.incr(f"skipped_{category}")
+            return text, None
+        
+        # 重试中断的文档时，检查点里已经完成的段落直接使用
+        checkpoint = context.checkpoint if context else None
+        if checkpoint is not None:
+            saved = checkpoint.get(text)
+            if saved is not None:
+                context.incr("checkpoint_hits")
+                return saved, None
+        
+        # 查询翻译记忆库，命中时无需调用API
+        memory_key = self.make_memory_key(text, target_language, special_requirements)
+        cached = translation_memory.get(memory_key)
+        if cached is not None:
+            if context:
+                context.incr("memory_hits")
+            return cached, memory_key
+        if context:
+            context.incr("memory_misses")
+        return None, memory_key
+
+    @staticmethod
+    def remember_translation(text, memory_key, translated_text, context=None):
+        """把API返回的译文写入翻译记忆库，以及当前文档的检查点"""
+        translation_memory.put(memory_key, translated_text)
+        if context is not None and context.checkpoint is not None:
+            context.checkpoint.record(text, translated_text)
+
+    async def translate_text_async(self, text, session, target_language, special_requirements="", api_key=None, context=None, memory_key=None):
+        """
+        使用 GPT-4o API 异步翻译中文文本
+        
+        Args:
+            text: 要翻译的文本
+            session: aiohttp 客户端会话
+            target_language: 目标语言
+            special_requirements: 特殊翻译要求
+            context: 翻译上下文，用于记录翻译记忆命中情况
+            memory_key: 已经查询过翻译记忆时传入对应的键，跳过本地查询
         
-        # 检查是否为特定词语
-        # if text.strip() in SPECIAL_TRANSLATIONS:
-        #     return SPECIAL_TRANSLATIONS[text.strip()]
+        Returns:
+            翻译后的文本
+        """
+        if memory_key is None:
+            local, memory_key = await asyncio.to_thread(
+                self.lookup_translation, text, target_language, special_requirements, context
+            )
+            if local is not None:
+                return local
         
         try:
-            # 构建 API 请求
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            
-            # 新的OpenAI API格式要求有user参数
-            data = {
-                "model": "gpt-4o",
-                "messages": [
-                    {"role": "system", "content": f"你是一个专业的中文到{target_language}翻译器。请将用户提供的中文文本翻译成{target_language}，只输出翻译结果，不要有任何解释或额外内容。保持原始格式，但不要重复原文中的标点符号，特别是在行尾的标点符号。如果原文中有标点符号，请使用{target_language}中的对应标点符号，而不是重复使用原文的标点符号。如果遇到单独的字母或数字，请保持原样不翻译。如果文本中包含“百”、“千”、“万”等数字单位，请按照特定规则翻译。{special_requirements if special_requirements else ''}"},
-                    {"role": "user", "content": text}
-                ],
-                "temperature": 0.3,
-                "user": "translation_service"  # 添加user参数以满足API要求
-            }
+            # 只注入这段文本中实际出现的术语
+            glossary_prompt = self.build_glossary_prompt(self.glossary_terms([text], target_language))
+            messages = [
+                {"role": "system", "content": self.build_system_prompt(target_language, special_requirements) + glossary_prompt},
+                {"role": "user", "content": text}
+            ]
             
             # 发送 API 请求
-            print(f"正在发送翻译请求: {text[:30]}...")
-            async with session.post(f"{API_URL}/v1/chat/completions", headers=headers, json=data) as response:
-                response_data = await response.json()
-                
-                # 处理 API 响应
-                if response.status == 200 and "choices" in response_data:
-                    translated_text = response_data["choices"][0]["message"]["content"]
-                    print(f"翻译成功: {translated_text[:30]}...")
-                    return translated_text
-                else:
-                    print(f"翻译失败: {response.status} - {response_data}")
-                    return ""
+            logger.debug("正在发送翻译请求: %s...", text[:30], extra={"sampled": True})
+            translated_text = await self.request_completion_with_retry(session, messages, api_key, context)
+            if translated_text is None:
+                return ""
+            logger.debug("翻译成功: %s...", translated_text[:30], extra={"sampled": True})
+            if translated_text.strip():
+                self.remember_translation(text, memory_key, translated_text, context)
+            return translated_text
         except Exception as e:
-            print(f"翻译过程中发生错误: {str(e)}")
+            logger.warning("翻译过程中发生错误: %s", e)
             return ""
 
-    async def batch_translate_texts(self, texts, target_language, special_requirements="", api_key=None):
+    @staticmethod
+    def parse_packed_response(content, expected_count):
+        """
+        解析打包翻译的返回结果，编号或数量不一致时返回None
+        
+        Args:
+            content: 模型返回的文本
+            expected_count: 期望的段落数量
+        
+        Returns:
+            按编号排序的翻译结果列表
+        """
+        if not content:
+            return None
+        content = content.strip()
+        # 去掉模型可能添加的 ```json 代码块标记
+        fenced = re.match(r"^```(?:json)?\s*([\s\S]*?)\s*```$", content)
+        if fenced:
+            content = fenced.group(1)
+        try:
+            items = json.loads(content).get("translations")
+        except (ValueError, AttributeError):
+            return None
+        if not isinstance(items, list) or len(items) != expected_count:
+            return None
+        translations = {}
+        for item in items:
+            if not isinstance(item, dict):
+                return None
+            try:
+                item_id = int(item.get("id"))
+            except (TypeError, ValueError):
+                return None
+            item_text = item.get("text")
+            if item_id in translations or not isinstance(item_text, str) or not item_text.strip():
+                return None
+            translations[item_id] = item_text
+        if sorted(translations) != list(range(1, expected_count + 1)):
+            return None
+        return [translations[i] for i in range(1, expected_count + 1)]
+
+    async def translate_packed_async(self, texts, session, target_language, special_requirements="", api_key=None, context=None):
+        """
+        将多段文本打包到一次请求中翻译
+        
+        Args:
+            texts: 要翻译的文本列表
+            session: aiohttp 客户端会话
+            target_language: 目标语言
+            special_requirements: 特殊翻译要求
+            context: 翻译上下文
+        
+        Returns:
+            翻译结果列表；收到了响应但编号或数量校验失败时返回None；
+            没有拿到响应时返回 PACKED_REQUEST_FAILED
+        """
+        payload = {"segments": [{"id": i + 1, "text": text} for i, text in enumerate(texts)]}
+        glossary_prompt = self.build_glossary_prompt(self.glossary_terms(texts, target_language))
+        messages = [
+            {"role": "system", "content": self.build_packed_system_prompt(target_language, special_requirements) + glossary_prompt},
+            {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
+        ]
+        try:
+            logger.debug("正在发送打包翻译请求: %d 段", len(texts), extra={"sampled": True})
+            content = await self.request_completion_with_retry(session, messages, api_key, context)
+        except Exception as e:
+            logger.warning("打包翻译过程中发生错误: %s", e)
+            content = None
+        if context:
+            context.incr("packed_requests")
+        if content is None:
+            # 上游不可用或被限流时拆分只会成倍增加请求，整组按失败处理
+            logger.info("打包翻译请求失败，不拆分为单段请求: %d 段", len(texts))
+            if context:
+                context.incr("packed_request_failures")
+            return PACKED_REQUEST_FAILED
+        translations = self.parse_packed_response(content, len(texts))
+        if translations is None:
+            logger.info("打包翻译结果校验失败，拆分为单段重试: %d 段", len(texts))
+        return translations
+
+    @staticmethod
+    def estimate_tokens(text):
+        """粗略估算文本的token数"""
+        return estimate_tokens(text)
+
+    def pack_segments(self, texts, solo=()):
+        """
+        按照 BATCH_SIZE 和 token 预算把短文本分组，较长的文本单独成组
+        
+        Args:
+            texts: 要翻译的文本列表
+            solo: 需要单独成组的文本下标（超长段落拆分出的片段，保证它们并发翻译）
+        
+        Returns:
+            分组后的文本下标列表
+        """
+        groups = []
+        current = []
+        current_tokens = 0
+        for index, text in enumerate(texts):
+            tokens = self.estimate_tokens(text)
+            if len(text) > Config.PACKED_SEGMENT_MAX_CHARS or index in solo:
+                groups.append([index])
+                continue
+            if current and (len(current) >= BATCH_SIZE or current_tokens + tokens > Config.PACKED_MAX_TOKENS):
+                groups.append(current)
+                current = []
+                current_tokens = 0
+            current.append(index)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    def split_segment(self, text, max_tokens):
+        """
+        在句子边界把超长文本拆分成不超过 max_tokens 的片段，单个句子仍然过长时再按分句拆分
+        
+        Args:
+            text: 原文
+            max_tokens: 每个片段的token上限
+        
+        Returns:
+            (片段, 片段后面的空白) 的列表，片段按原文顺序排列
+        """
+        def pieces(chunk, patterns):
+            if self.estimate_tokens(chunk) <= max_tokens or not patterns:
+                return [chunk]
+            result = []
+            for sentence in patterns[0].findall(chunk):
+                result.extend(pieces(sentence, patterns[1:]))
+            return result
+        
+        # 按顺序合并相邻的句子，直到接近token上限
+        chunks = []
+        current = ""
+        for piece in pieces(text, (SENTENCE_BOUNDARY, CLAUSE_BOUNDARY)):
+            if current and self.estimate_tokens(current + piece) > max_tokens:
+                chunks.append(current)
+                current = ""
+            current += piece
+        if current:
+            chunks.append(current)
+        
+        segments = []
+        for chunk in chunks:
+            stripped = chunk.rstrip()
+            segments.append((stripped, chunk[len(stripped):]))
+        return segments
+
+    async def batch_translate_texts(self, texts, target_language, special_requirements="", api_key=None, context=None, packed=None):
         """
         批量异步翻译多个文本
         
+        超过 Config.SPLIT_SEGMENT_MAX_TOKENS 的文本先在句子边界拆分，各个片段和其他文本一起并发翻译，
+        翻译完成后再按顺序拼接，一个超长段落不会拖慢整个文档。
+        
         Args:
             texts: 要翻译的文本列表
             target_language: 目标语言
             special_requirements: 特殊翻译要求
+            context: 翻译上下文，用于汇总统计信息
+            packed: 是否把多段短文本打包到一次请求中，默认使用 Config.PACKED_TRANSLATION
         
         Returns:
             翻译后的文本列表
         """
-        # 创建异步会话
-        async with aiohttp.ClientSession() as session:
-            # 创建信号量限制并发请求数
-            semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-            
-            async def translate_with_semaphore(text):
-                async with semaphore:
-                    return await self.translate_text_async(text, session, target_language, special_requirements, api_key)
-            
-            # 创建所有翻译任务
-            tasks = [translate_with_semaphore(text) for text in texts]
-            
-            # 等待所有任务完成
-            results = await asyncio.gather(*tasks)
+        max_tokens = Config.SPLIT_SEGMENT_MAX_TOKENS
+        # 每个原文对应的片段范围和片段后面的空白
+        layout = []
+        pieces = []
+        for text in texts:
+            if max_tokens > 0 and self.estimate_tokens(text) > max_tokens:
+                split = self.split_segment(text, max_tokens)
+                if len(split) > 1:
+                    if context:
+                        context.incr("segments_split")
+                        context.incr("split_pieces", len(split))
+                    layout.append((len(pieces), [separator for _, separator in split]))
+                    pieces.extend(piece for piece, _ in split)
+                    continue
+            layout.append((len(pieces), None))
+            pieces.append(text)
+        
+        split_pieces = {piece for start, separators in layout if separators for piece in pieces[start:start + len(separators)]}
+        results = await self.translate_segments(pieces, target_language, special_requirements, api_key, context, packed, split_pieces)
+        if len(pieces) == len(texts):
             return results
+        
+        joined = []
+        for start, separators in layout:
+            if separators is None:
+                joined.append(results[start])
+                continue
+            translated = results[start:start + len(separators)]
+            # 任意一个片段失败时整段按失败处理
+            if any(not piece.strip() for piece in translated):
+                joined.append("")
+                continue
+            text = ""
+            for piece, separator in zip(translated, separators):
+                # 原文片段之间没有换行时，译文片段之间用空格分隔
+                text += piece.strip() + (separator if "\n" in separator else " ")
+            joined.append(text.rstrip())
+        return joined
+
+    async def translate_segments(self, texts, target_language, special_requirements="", api_key=None, context=None, packed=None, split_pieces=frozenset()):
+        """
+        去重后并发翻译多个文本，batch_translate_texts 拆分超长文本后调用
+        
+        Args:
+            texts: 要翻译的文本列表
+            target_language: 目标语言
+            special_requirements: 特殊翻译要求
+            context: 翻译上下文，用于汇总统计信息
+            packed: 是否把多段短文本打包到一次请求中，默认使用 Config.PACKED_TRANSLATION
+            split_pieces: 超长段落拆分出的片段，不参与打包，各自单独请求
+        
+        Returns:
+            翻译后的文本列表
+        """
+        if packed is None:
+            packed = Config.PACKED_TRANSLATION
+        
+        # 使用进程级共享的连接池，并发由 upstream_scheduler 统一控制
+        session = async_runtime.get_session()
+        
+        async def translate_one(text, memory_key=None):
+            return await self.translate_text_async(text, session, target_language, special_requirements, api_key, context, memory_key)
+        
+        async def translate_pack(group_texts):
+            return await self.translate_packed_async(group_texts, session, target_language, special_requirements, api_key, context)
+        
+        # 将重复的文本合并为唯一的键，每个键只翻译一次
+        unique_texts = []
+        unique_index = {}
+        positions = []
+        for text in texts:
+            key = translation_memory.normalize(text)
+            if key not in unique_index:
+                unique_index[key] = len(unique_texts)
+                unique_texts.append(text)
+            positions.append(unique_index[key])
+        
+        if context:
+            context.incr("segments_found", len(texts))
+            context.incr("segments_sent", len(unique_texts))
+            context.incr("segments_total", len(unique_texts))
+        
+        # 先在本地查询，剩下的文本才需要请求API。查询会读取SQLite并扫描术语表，
+        # 放到线程池中执行，避免阻塞共享事件循环上的其他请求（ASGI模式下就是服务器的事件循环）
+        lookups = await asyncio.to_thread(
+            lambda: [self.lookup_translation(text, target_language, special_requirements, context) for text in unique_texts]
+        )
+        unique_results = [None] * len(unique_texts)
+        pending = []
+        pending_keys = []
+        # 其他文档正在翻译的相同文本，等待它们的结果
+        shared = []
+        for index, (local, memory_key) in enumerate(lookups):
+            if local is not None:
+                unique_results[index] = local
+                if context:
+                    context.incr("segments_done")
+                continue
+            owner, future = inflight_translations.claim(memory_key)
+            if owner:
+                pending.append(index)
+                pending_keys.append(memory_key)
+            else:
+                shared.append((index, future))
+        
+        async def translate_group(group):
+            group_texts = [unique_texts[pending[i]] for i in group]
+            if len(group) > 1:
+                translations = await translate_pack(group_texts)
+                if translations is PACKED_REQUEST_FAILED:
+                    # 整组留给 finish_batch 重新打包请求一次
+                    failed_groups.append([pending[i] for i in group])
+                    for i in group:
+                        unique_results[pending[i]] = ""
+                    if context:
+                        context.incr("segments_done", len(group))
+                    return
+                if translations is not None:
+                    if context:
+                        context.incr("packed_segments", len(group))
+                    for i, translated_text in zip(group, translations):
+                        unique_results[pending[i]] = translated_text
+                        self.remember_translation(unique_texts[pending[i]], pending_keys[i], translated_text, context)
+                        inflight_translations.resolve(pending_keys[i], translated_text)
+                    if context:
+                        context.incr("segments_done", len(group))
+                    return
+                if context:
+                    context.incr("packed_fallbacks")
+            # 单段文本或打包结果不可用时，逐段单独翻译
+            results = await asyncio.gather(*[
+                translate_one(unique_texts[pending[i]], pending_keys[i]) for i in group
+            ])
+            for i, translated_text in zip(group, results):
+                unique_results[pending[i]] = translated_text
+                inflight_translations.resolve(pending_keys[i], translated_text)
+            if context:
+                context.incr("segments_done", len(group))
+        
+        async def wait_shared(index, future):
+            unique_results[index] = await asyncio.shield(future)
+            if context and context.checkpoint is not None:
+                context.checkpoint.record(unique_texts[index], unique_results[index])
+            if context:
+                context.incr("segments_shared")
+                context.incr("segments_done")
+        
+        failed_groups = []
+        if packed:
+            # 打包模式：短文本分组后打包请求
+            solo = {i for i, index in enumerate(pending) if unique_texts[index] in split_pieces}
+            groups = self.pack_segments([unique_texts[index] for index in pending], solo)
+        else:
+            groups = [[i] for i in range(len(pending))]
+        try:
+            await asyncio.gather(
+                *[translate_group(group) for group in groups],
+                *[wait_shared(index, future) for index, future in shared]
+            )
+        finally:
+            # 出错或被取消时也要唤醒等待这些文本的其他文档
+            for index, memory_key in zip(pending, pending_keys):
+                inflight_translations.resolve(memory_key, unique_results[index] or "")
+        return await self.finish_batch(
+            texts, unique_texts, unique_results, positions, translate_one, target_language, special_requirements, context,
+            translate_pack, failed_groups
+        )
+
+    async def finish_batch(self, texts, unique_texts, unique_results, positions, translate_one, target_language, special_requirements="", context=None, translate_pack=None, failed_groups=()):
+        """
+        把第一轮失败的文本放到队尾重新翻译一次，然后把结果分发回每个出现的位置
+        
+        打包请求没有拿到响应的分组仍然整组打包重试，不拆分为单段请求；
+        文档的重试预算已经用尽（上游持续故障）时不再重新排队。
+        
+        Args:
+            texts: 原始文本列表
+            unique_texts: 去重后的文本列表
+            unique_results: 去重后文本的翻译结果，失败的为空字符串
+            positions: 每个原始文本对应的去重下标
+            translate_one: 单段翻译协程函数
+            target_language: 目标语言
+            special_requirements: 特殊翻译要求
+            context: 翻译上下文
+            translate_pack: 打包翻译协程函数
+            failed_groups: 打包请求没有拿到响应的分组，每组是去重后文本的下标列表
+        
+        Returns:
+            与 texts 一一对应的翻译结果列表
+        """
+        def is_failed(index):
+            return not (unique_results[index] or "").strip() and unique_texts[index].strip()
+        
+        if context and context.retry_budget <= 0:
+            failed = []
+        else:
+            failed = [index for index in range(len(unique_texts)) if is_failed(index)]
+        # 打包重试的分组：重试仍然没有拿到响应的保持失败，响应校验失败的再逐段重试
+        packed_failed = set()
+        packed_requeued = set()
+        for group in failed_groups if failed else ():
+            group = [index for index in group if is_failed(index)]
+            if not group:
+                continue
+            packed_requeued.update(group)
+            if context:
+                context.incr("segments_requeued", len(group))
+            translations = await translate_pack([unique_texts[index] for index in group])
+            if translations is PACKED_REQUEST_FAILED:
+                packed_failed.update(group)
+            elif translations is not None:
+                if context:
+                    context.incr("packed_segments", len(group))
+                for index, translated_text in zip(group, translations):
+                    unique_results[index] = translated_text
+                    self.remember_translation(
+                        unique_texts[index], self.make_memory_key(unique_texts[index], target_language, special_requirements),
+                        translated_text, context
+                    )
+            else:
+                if context:
+                    context.incr("packed_fallbacks")
+        failed = [index for index in failed if is_failed(index) and index not in packed_failed]
+        if failed:
+            logger.info("%d 段文本翻译失败，重新排队翻译...", len(failed))
+            if context:
+                context.incr("segments_requeued", sum(1 for index in failed if index not in packed_requeued))
+            retried = await asyncio.gather(*[
+                translate_one(
+                    unique_texts[index],
+                    self.make_memory_key(unique_texts[index], target_language, special_requirements)
+                )
+                for index in failed
+            ])
+            for index, translated_text in zip(failed, retried):
+                unique_results[index] = translated_text
+        
+        results = [unique_results[index] or "" for index in positions]
+        if context:
+            untranslated = sum(1 for text, result in zip(texts, results) if text.strip() and not result.strip())
+            context.incr("untranslated", untranslated)
+        return results
     
     def translate_text(self, text, target_language, special_requirements="", api_key=None):
         """
@@ -631,16 +3982,250 @@ class DocumentTranslationResource(Resource):
         
         # 使用同步方式调用异步函数
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            result = loop.run_until_complete(self.batch_translate_texts([text], target_language, special_requirements, api_key))[0]
-            loop.close()
-            return result
+            return async_runtime.run(self.batch_translate_texts([text], target_language, special_requirements, api_key))[0]
         except Exception as e:
-            print(f"同步翻译过程中发生错误: {str(e)}")
+            logger.warning("同步翻译过程中发生错误: %s", e)
             return ""
     
-    def process_docx(self, input_file_path, target_language, special_requirements, api_key=None):
+    def collect_segments(self, doc):
+        """
+        一次遍历整个文档，收集所有需要翻译的位置
+        
+        包括正文段落、表格单元格、页眉页脚（含其中的表格）、脚注尾注以及文本框中的段落。
+        
+        Args:
+            doc: Document对象
+            
+        Returns:
+            (类型, 段落对象或 w:tc 元素, 原文) 的列表，类型为 "paragraph" 或 "cell"
+        """
+        segments = []
+        
+        def collect_paragraph(paragraph):
+            text = paragraph_text(paragraph._p)
+            if text.strip():
+                segments.append(("paragraph", paragraph, text))
+        
+        def collect_table(tbl):
+            # 直接遍历唯一的 w:tc 元素，合并单元格只会出现一次；单元格中的嵌套表格递归处理
+            for tr in tbl.iterchildren(W_TR):
+                for tc in tr.iterchildren(W_TC):
+                    text = cell_text(tc).strip()
+                    if text:
+                        segments.append(("cell", tc, text))
+                    for nested in tc.iterchildren(W_TBL):
+                        collect_table(nested)
+        
+        def collect_container(element, parent):
+            # 按文档顺序遍历段落和表格
+            for child in element.iterchildren():
+                if child.tag == W_P:
+                    collect_paragraph(Paragraph(child, parent))
+                elif child.tag == W_TBL:
+                    collect_table(child)
+            # 文本框中的段落
+            for p in TEXTBOX_PARAGRAPHS(element):
+                collect_paragraph(Paragraph(p, parent))
+        
+        # 正文
+        collect_container(doc.element.body, doc._body)
+        
+        # 页眉页脚：链接到上一节的页眉页脚没有自己的内容，多个节共用的部分只处理一次
+        seen_parts = set()
+        for section in doc.sections:
+            for header_footer in (
+                section.header, section.first_page_header, section.even_page_header,
+                section.footer, section.first_page_footer, section.even_page_footer,
+            ):
+                if header_footer.is_linked_to_previous:
+                    continue
+                if header_footer._element in seen_parts:
+                    continue
+                seen_parts.add(header_footer._element)
+                collect_container(header_footer._element, header_footer)
+        
+        # 脚注和尾注
+        for _, notes in self.iter_note_parts(doc):
+            for note in notes.iterchildren(W_FOOTNOTE, W_ENDNOTE):
+                collect_container(note, None)
+        
+        return segments
+
+    def iter_note_parts(self, doc):
+        """
+        返回文档的脚注和尾注部件及其根元素
+        
+        python-docx 没有脚注尾注的对象模型，这些部件以原始XML保存，
+        第一次访问时解析并缓存，process_docx 结束时再写回部件。
+        
+        Args:
+            doc: Document对象
+            
+        Returns:
+            (部件, 根元素) 的列表
+        """
+        note_parts = getattr(doc.part, "_translation_note_parts", None)
+        if note_parts is None:
+            note_parts = []
+            for rel in doc.part.rels.values():
+                if rel.is_external or rel.reltype not in (RT.FOOTNOTES, RT.ENDNOTES):
+                    continue
+                part = rel.target_part
+                element = getattr(part, "element", None)
+                if element is None:
+                    element = parse_xml(part.blob)
+                note_parts.append((part, element))
+            # Document 使用 __slots__，缓存在文档部件上
+            doc.part._translation_note_parts = note_parts
+        return note_parts
+
+    def insert_paragraph_translation(self, paragraph, translated_text):
+        """
+        在原段落后面插入一个包含翻译文本的新段落，并复制原段落的格式
+        
+        新段落直接作为原段落的下一个兄弟节点插入，耗时与文档大小无关；
+        格式通过克隆 w:pPr / w:rPr 元素复制，不经过 python-docx 的属性代理对象。
+        
+        Args:
+            paragraph: 原段落
+            translated_text: 翻译文本
+            
+        Returns:
+            新插入的段落
+        """
+        new_p = build_translation_paragraph(paragraph._p, translated_text)
+        paragraph._p.addnext(new_p)
+        return Paragraph(new_p, paragraph._parent)
+    
+    def append_cell_translation(self, tc, source_text, translated_text):
+        """
+        在表格单元格末尾添加翻译段落
+        
+        Args:
+            tc: 单元格的 w:tc 元素
+            source_text: 收集时计算好的单元格原文
+            translated_text: 翻译文本
+        """
+        first_p = tc.find(W_P)
+        first_paragraph_text = paragraph_text(first_p) if first_p is not None else None
+        if should_append_cell_translation(source_text, first_paragraph_text, translated_text):
+            # 沿用第一个段落的格式
+            tc.append(build_translation_paragraph(first_p, translated_text))
+    
+    def translate_collected_texts(self, texts, target_language, special_requirements, api_key, context):
+        """
+        翻译文档中收集到的全部分段，同步等待 translate_collected_texts_async 的结果
+        
+        Returns:
+            与 texts 一一对应的翻译结果列表
+        """
+        return async_runtime.run(self.translate_collected_texts_async(
+            texts, target_language, special_requirements, api_key, context
+        ))
+    
+    async def translate_collected_texts_async(self, texts, target_language, special_requirements, api_key, context):
+        """
+        翻译文档中收集到的全部分段
+
+        上下文中带有上一版译文时，先沿用未修改分段的译文，只把修改过或新增的分段交给批量翻译。
+
+        Returns:
+            与 texts 一一对应的翻译结果列表
+        """
+        if not texts:
+            return []
+        logger.info("开始批量翻译 %d 段文本...", len(texts))
+        if context.reference is None:
+            return await self.batch_translate_texts(texts, target_language, special_requirements, api_key, context)
+        
+        translated_texts, by_position, by_content = await asyncio.to_thread(context.reference.align, texts)
+        context.incr("segments_reused_position", by_position)
+        context.incr("segments_reused_content", by_content)
+        missing = [index for index, translated_text in enumerate(translated_texts) if translated_text is None]
+        # 沿用的分段没有发送到上游，不计入 segments_sent；segments_total 按整篇文档的唯一文本计算，
+        # 与需要翻译的分段内容相同的沿用分段已由批量翻译计入，不再重复统计
+        reused = [text for text, translated_text in zip(texts, translated_texts) if translated_text is not None]
+        missing_keys = {translation_memory.normalize(texts[index]) for index in missing}
+        reused_only = len({translation_memory.normalize(text) for text in reused} - missing_keys)
+        context.incr("segments_found", len(reused))
+        context.incr("segments_total", reused_only)
+        context.incr("segments_done", reused_only)
+        logger.info(
+            "沿用上一版译文 %d 段，需要翻译 %d 段", by_position + by_content, len(missing),
+            extra={"reused_position": by_position, "reused_content": by_content, "missing": len(missing)}
+        )
+        if missing:
+            results = await self.batch_translate_texts(
+                [texts[index] for index in missing], target_language, special_requirements, api_key, context
+            )
+            for index, translated_text in zip(missing, results):
+                translated_texts[index] = translated_text
+        return translated_texts
+    
+    def collect_document(self, input_file_path, engine, context):
+        """
+        打开文档并收集需要翻译的分段
+        
+        Args:
+            input_file_path: Word文档路径
+            engine: 本地翻译引擎，"docx" 或 "stream"
+            context: 翻译上下文
+        
+        Returns:
+            收集结果，texts 为按文档顺序排列的分段原文，交给 write_document 写出译文
+        """
+        collected = {"engine": engine}
+        if engine == "stream":
+            collected["translator"] = OoxmlStreamTranslator(input_file_path)
+            with context.phase("collect"):
+                collected["segments"] = collected["translator"].scan()
+            kinds = [record[2] for record in collected["segments"]]
+            collected["texts"] = [record[3] for record in collected["segments"]]
+        else:
+            # 打开原始文档
+            with context.phase("load"):
+                collected["doc"] = Document(input_file_path)
+            # 一次遍历收集正文、表格、页眉页脚和文本框中的全部文本
+            with context.phase("collect"):
+                collected["segments"] = self.collect_segments(collected["doc"])
+            kinds = [kind for kind, _, _ in collected["segments"]]
+            collected["texts"] = [text for _, _, text in collected["segments"]]
+        paragraph_count = kinds.count("paragraph")
+        logger.info(
+            "文档共有 %d 个段落、%d 个表格单元格需要翻译", paragraph_count, len(kinds) - paragraph_count,
+            extra={"paragraphs": paragraph_count, "cells": len(kinds) - paragraph_count}
+        )
+        return collected
+    
+    def write_document(self, collected, translated_texts, input_file_path, output_file_path, context):
+        """
+        把译文插入 collect_document 收集到的位置，并写出双语文档
+        
+        Args:
+            collected: collect_document 的返回值
+            translated_texts: 与 collected["texts"] 一一对应的翻译结果
+            input_file_path: 原始Word文档路径
+            output_file_path: 输出文档路径
+            context: 翻译上下文
+        """
+        if collected["engine"] != "stream":
+            with context.phase("insert"):
+                self.apply_translations(collected["doc"], collected["segments"], translated_texts)
+            with context.phase("save"):
+                self.save_document(collected["doc"], input_file_path, output_file_path)
+            return
+        
+        translations = {}
+        for (part_name, slot, kind, source_text), translated_text in zip(collected["segments"], translated_texts):
+            if not translated_text.strip():
+                logger.warning("%s翻译失败，不添加翻译", "段落" if kind == "paragraph" else "表格单元格")
+            elif translated_text.strip() != source_text.strip():
+                translations[(part_name, slot)] = (source_text, translated_text)
+        # 流式引擎在写出的同时插入译文，插入和保存合并为一个阶段
+        with context.phase("save"):
+            collected["translator"].write(output_file_path, translations)
+    
+    def process_docx(self, input_file_path, target_language, special_requirements, api_key=None, context=None):
         """
         处理Word文档，翻译其中的文本并创建双语文档
         
@@ -648,172 +4233,105 @@ class DocumentTranslationResource(Resource):
             input_file_path: Word文档路径
             target_language: 目标语言
             special_requirements: 特殊翻译要求
+            context: 翻译上下文，用于汇总统计信息
             
         Returns:
             翻译后的Document对象
         """
-        # 打开原始文档
-        doc = Document(input_file_path)
+        if context is None:
+            context = TranslationContext()
+        collected = self.collect_document(input_file_path, "docx", context)
         
-        # 翻译正文段落
-        total_paragraphs = len(doc.paragraphs)
-        print(f"文档共有 {total_paragraphs} 个段落")
+        # 所有位置放入同一个并发翻译队列，总耗时取决于最慢的一段而不是各阶段之和
+        with context.phase("translate"):
+            translated_texts = self.translate_collected_texts(
+                collected["texts"], target_language, special_requirements, api_key, context
+            )
         
-        # 收集需要翻译的段落文本
-        paragraph_texts = []
-        paragraph_refs = []
+        with context.phase("insert"):
+            self.apply_translations(collected["doc"], collected["segments"], translated_texts)
+        return collected["doc"]
+    
+    def apply_translations(self, doc, segments, translated_texts):
+        """
+        把翻译结果插入文档，并记录改动过的部件
         
-        for paragraph in doc.paragraphs:
-            if paragraph.text.strip():
-                paragraph_texts.append(paragraph.text)
-                paragraph_refs.append(paragraph)
+        Args:
+            doc: Document对象
+            segments: collect_segments 收集到的位置
+            translated_texts: 与 segments 一一对应的翻译结果
+        """
+        # 创建段落/单元格和翻译结果的映射
+        paragraphs_to_translate = []
+        cell_translations = []
+        for (kind, ref, source_text), translated_text in zip(segments, translated_texts):
+            if not translated_text.strip():
+                logger.warning("%s翻译失败，不添加翻译", "段落" if kind == "paragraph" else "表格单元格")
+            elif translated_text.strip() == source_text.strip():
+                # 原样保留的文本（数字、日期、编号等）不重复添加
+                continue
+            elif kind == "paragraph":
+                paragraphs_to_translate.append((ref, translated_text))
+            else:
+                cell_translations.append((ref, source_text, translated_text))
         
-        # 批量并行翻译段落
-        if paragraph_texts:
-            print(f"开始批量翻译 {len(paragraph_texts)} 个段落...")
-            # 使用异步方式批量翻译
-            translated_texts = asyncio.run(self.batch_translate_texts(paragraph_texts, target_language, special_requirements, api_key))
-            
-            # 创建段落和翻译结果的映射
-            paragraphs_to_translate = []
-            for paragraph, translated_text in zip(paragraph_refs, translated_texts):
-                if translated_text.strip():
-                    paragraphs_to_translate.append((paragraph, translated_text))
-                else:
-                    print(f"  警告: 段落翻译失败，不添加翻译")
-        else:
-            paragraphs_to_translate = []
+        # 在每个原段落后面插入翻译段落（一次线性遍历，不需要查找段落在父元素中的位置）
+        for paragraph, translated_text in paragraphs_to_translate:
+            self.insert_paragraph_translation(paragraph, translated_text)
         
-        # 现在在原文后面添加翻译文本
-        # 从后往前遍历，这样我们在添加新段落时不会影响前面的段落索引
-        for paragraph, translated_text in reversed(paragraphs_to_translate):
+        # 将翻译结果添加到表格单元格中
+        for tc, source_text, translated_text in cell_translations:
             try:
-                # 使用更安全的方式插入翻译文本
-                # 直接在段落后面添加一个新段落
-                p = doc.add_paragraph()
-                # 获取原段落的父元素
-                parent_element = paragraph._p.getparent()
-                # 获取原段落在父元素中的索引
-                if parent_element is not None:
-                    index_in_parent = list(parent_element).index(paragraph._p)
-                    # 在原段落后面插入新段落
-                    parent_element.insert(index_in_parent + 1, p._p)
+                self.append_cell_translation(tc, source_text, translated_text)
             except Exception as e:
-                print(f"  警告: 插入段落时出错: {str(e)}")
-                # 如果插入失败，尝试直接在文档末尾添加段落
-                p = doc.add_paragraph()
-            
-            # 设置翻译文本和样式
-            run = p.add_run(translated_text)
-            
-            # 复制原段落的样式
-            if paragraph.style:
-                p.style = paragraph.style
-            
-            # 复制原段落的对齐方式
-            if paragraph.alignment is not None:
-                p.alignment = paragraph.alignment
-            
-            # 如果原段落有格式，复制字体格式
-            if paragraph.runs:
-                # 获取所有格式属性
-                for orig_run in paragraph.runs:
-                    if orig_run.font.size:
-                        run.font.size = orig_run.font.size
-                    if orig_run.font.name:
-                        run.font.name = orig_run.font.name
-                    # 复制加粗、斜体、下划线等格式
-                    if hasattr(orig_run.font, 'bold') and orig_run.font.bold:
-                        run.font.bold = orig_run.font.bold
-                    if hasattr(orig_run.font, 'italic') and orig_run.font.italic:
-                        run.font.italic = orig_run.font.italic
-                    if hasattr(orig_run.font, 'underline') and orig_run.font.underline:
-                        run.font.underline = orig_run.font.underline
-                    # 复制颜色
-                    if hasattr(orig_run.font, 'color') and orig_run.font.color and hasattr(orig_run.font.color, 'rgb') and orig_run.font.color.rgb:
-                        run.font.color.rgb = orig_run.font.color.rgb
-                    # 一旦找到有格式的run，就使用它的格式
-                    if any([orig_run.font.bold, orig_run.font.italic, orig_run.font.underline, orig_run.font.size]):
-                        break
+                logger.warning("处理表格单元格时出错: %s", e)
         
-        # 处理表格
-        all_table_cells = []
-        all_table_texts = []
+        # 记录插入了译文的部件，保存时只重写这些部件。根元素都被部件引用着，可以按 id 比较
+        changed_roots = {id(paragraph._p.getroottree().getroot()) for paragraph, _ in paragraphs_to_translate}
+        changed_roots.update(id(tc.getroottree().getroot()) for tc, _, _ in cell_translations)
+        changed_parts = []
+        for part in doc.part.package.iter_parts():
+            element = getattr(part, "element", None)
+            if element is not None and id(element) in changed_roots:
+                changed_parts.append(part)
         
-        # 收集所有表格单元格的文本
-        for table in doc.tables:
-            print("正在处理表格...")
-            
-            for row in table.rows:
-                for cell in row.cells:
-                    # 获取单元格的文本
-                    cell_text = cell.text.strip()
-                    
-                    if cell_text:
-                        all_table_cells.append(cell)
-                        all_table_texts.append(cell_text)
-        
-        # 批量并行翻译表格单元格
-        if all_table_texts:
-            print(f"开始批量翻译 {len(all_table_texts)} 个表格单元格...")
-            # 使用异步方式批量翻译
-            translated_table_texts = asyncio.run(self.batch_translate_texts(all_table_texts, target_language, special_requirements, api_key))
-            
-            # 处理翻译结果
-            cell_translations = []
-            for cell, translated_text in zip(all_table_cells, translated_table_texts):
-                if translated_text.strip():
-                    cell_translations.append((cell, translated_text))
-                else:
-                    print(f"  警告: 表格单元格翻译失败，不添加翻译")
-            
-            # 创建一个集合来跟踪已处理的单元格，防止重复处理
-            processed_cells = set()
-            
-            # 将翻译结果添加到表格单元格中
-            for cell, translated_text in zip(all_table_cells, translated_table_texts):
-                # 使用单元格对象的ID作为唯一标识符
-                cell_id = id(cell)
-                
-                # 如果这个单元格已经处理过，则跳过
-                if cell_id in processed_cells:
-                    continue
-                    
-                # 标记这个单元格为已处理
-                processed_cells.add(cell_id)
-                
-                try:
-                    # 检查单元格是否已经包含翻译
-                    already_translated = False
-                    
-                    # 获取所有段落文本，检查是否已包含翻译
-                    all_cell_text = cell.text
-                    if translated_text.strip() in all_cell_text:
-                        print(f"  跳过已翻译的单元格内容")
-                        continue
-                    
-                    # 逐段检查是否已包含翻译
-                    for para in cell.paragraphs[1:] if len(cell.paragraphs) > 1 else []:
-                        if para.text.strip() == translated_text.strip():
-                            already_translated = True
-                            break
-                            
-                    if already_translated:
-                        continue
-                    
-                    # 添加翻译段落
-                    if len(cell.paragraphs) > 0 and cell.paragraphs[0].text.strip():
-                        # 添加新段落
-                        p = cell.add_paragraph()
-                        p.text = translated_text
-                        
-                        # 尝试应用原始段落的样式
-                        if cell.paragraphs[0].style:
-                            p.style = cell.paragraphs[0].style
-                except Exception as e:
-                    print(f"  处理表格单元格时出错: {str(e)}")
+        # 把修改过的脚注尾注写回部件
+        for part, element in self.iter_note_parts(doc):
+            if getattr(part, "element", None) is None and id(element) in changed_roots:
+                part._blob = serialize_part_xml(element)
+                changed_parts.append(part)
+        # Document 使用 __slots__，记录在文档部件上
+        doc.part._translation_changed_parts = changed_parts
+    
+    def save_document(self, doc, input_file_path, output_file_path):
+        """
+        保存 process_docx 翻译后的文档
+        
+        只重新序列化和压缩插入了译文的部件，图片等未改动的部件直接从原文件复制压缩数据，
+        不经过解压和重新压缩。
+        
+        Args:
+            doc: process_docx 返回的Document对象
+            input_file_path: 原始Word文档路径
+            output_file_path: 输出文档路径
+        """
+        changed_parts = getattr(doc.part, "_translation_changed_parts", None)
+        if changed_parts is None:
+            doc.save(output_file_path)
+            return
         
-        return doc
+        changed_parts = {part.partname.membername: part for part in changed_parts}
+        with zipfile.ZipFile(input_file_path) as archive, \
+                zipfile.ZipFile(output_file_path, "w", zipfile.ZIP_DEFLATED, compresslevel=Config.DOCX_COMPRESS_LEVEL) as output:
+            for info in archive.infolist():
+                part = changed_parts.pop(info.filename, None)
+                if part is None:
+                    copy_zip_member(archive, info, output)
+                else:
+                    output.writestr(clone_zip_info(info), part.blob)
+            # 原文件中不存在的部件（正常情况下不会出现）
+            for name, part in changed_parts.items():
+                output.writestr(name, part.blob)
     
     def call_translation_api(self, input_file_path, target_language,api_key):
         """
@@ -835,7 +4353,7 @@ class DocumentTranslationResource(Resource):
         output_path = os.path.join(temp_dir, f"translated_output.docx")
         
         # 准备API请求
-        url = "http://localhost:5005/api/translate"  # app.py运行的地址
+        url = f"{Config.SIDECAR_URL}/api/translate"  # app.py运行的地址
         
         # 准备文件和表单数据
         files = {
@@ -848,8 +4366,14 @@ class DocumentTranslationResource(Resource):
         
         try:
             # 发送请求
-            print(f"正在调用翻译API...")
-            response = requests.post(url, files=files, data=data, stream=True)
+            logger.info("正在调用翻译API...")
+            # 连接超时和读取超时分开设置，读取超时是两次收到数据之间的最长间隔
+            with observe_upstream("sidecar") as call:
+                response = requests.post(
+                    url, files=files, data=data, stream=True,
+                    timeout=(Config.SIDECAR_CONNECT_TIMEOUT, Config.SIDECAR_READ_TIMEOUT)
+                )
+                call["status"] = response.status_code
             
             # 检查响应
             if response.status_code == 200:
@@ -857,41 +4381,534 @@ class DocumentTranslationResource(Resource):
                 with open(output_path, 'wb') as f:
                     for chunk in response.iter_content(chunk_size=8192):
                         f.write(chunk)
-                print(f"翻译成功，结果保存到: {output_path}")
+                logger.info("翻译成功，结果保存到: %s", output_path)
                 return output_path
             else:
-                print(f"翻译API调用失败: {response.status_code} - {response.text}")
+                logger.warning("翻译API调用失败: %s - %s", response.status_code, response.text)
+                if response.status_code >= 500:
+                    raise SidecarUnavailableError(f"翻译API调用失败: {response.status_code}")
                 raise Exception(f"翻译API调用失败: {response.status_code}")
+        except requests.RequestException as e:
+            logger.warning("调用翻译API时出错: %s", e)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise SidecarUnavailableError(str(e)) from e
         except Exception as e:
-            print(f"调用翻译API时出错: {str(e)}")
+            logger.warning("调用翻译API时出错: %s", e)
+            shutil.rmtree(temp_dir, ignore_errors=True)
             raise e
         finally:
             # 关闭文件
             files['file'][1].close()
     
-    def translate_document(self, input_file_path, target_language, special_requirements,api_key):
+    def process_docx_streaming(self, input_file_path, output_file_path, target_language, special_requirements, api_key=None, context=None):
+        """
+        使用流式 OOXML 引擎翻译Word文档，直接写出双语文档
+        
+        Args:
+            input_file_path: Word文档路径
+            output_file_path: 输出文档路径
+            target_language: 目标语言
+            special_requirements: 特殊翻译要求
+            context: 翻译上下文，用于汇总统计信息
+        """
+        if context is None:
+            context = TranslationContext()
+        collected = self.collect_document(input_file_path, "stream", context)
+        with context.phase("translate"):
+            translated_texts = self.translate_collected_texts(
+                collected["texts"], target_language, special_requirements, api_key, context
+            )
+        self.write_document(collected, translated_texts, input_file_path, output_file_path, context)
+    
+    @staticmethod
+    def download_file(url, file_path):
+        """
+        下载文件到本地路径
+
+        Raises:
+            DocumentDownloadError: 下载失败
+        """
+        try:
+            response = requests.get(url, stream=True)
+            response.raise_for_status()  # 确保请求成功
+            
+            # 保存下载的文件
+            with open(file_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=8192):
+                    f.write(chunk)
+                    bytes_downloaded_total.inc(value=len(chunk))
+        except requests.exceptions.RequestException as e:
+            raise DocumentDownloadError(f"无法从CDN URL下载文件: {str(e)}")
+
+    def translate_document(self, input_file_path, output_file_path, target_language, special_requirements,api_key, context=None, engine=None):
         """
         Translate a Word document using GPT-4o
         
         Args:
             input_file_path: Path to the input Word document
+            output_file_path: Path the bilingual document is written to
             target_language: Target language for translation
             special_requirements: Special translation requirements
-            
+            context: Translation context collecting per-document statistics
+            engine: Local engine, "docx" (python-docx object model) or "stream" (streaming OOXML);
+                defaults to Config.TRANSLATION_ENGINE
+        
+        The backend is chosen by Config.TRANSLATION_BACKEND: "sidecar" only uses the translation
+        service on SIDECAR_URL, "local" only uses the local engine, and "auto" tries the service
+        first unless its circuit breaker is open, falling back to the local engine on failure.
+        
+        When context.reference holds a previous revision (see PreviousTranslation), "auto" skips the
+        service and the local engine reuses the previous translations of unchanged segments, so only
+        edited and new segments are sent upstream.
+        
+        The local engine checkpoints every completed segment under a key derived from the document
+        hash and parameters (see TranslationCheckpointStore); a retry of the same document only
+        requests the missing segments, and the checkpoint is removed once every segment succeeded.
+        """
+        if self.translate_with_sidecar(input_file_path, output_file_path, target_language, api_key, context):
+            return
+        
+        engine = engine or Config.TRANSLATION_ENGINE
+        if context is None:
+            context = TranslationContext()
+        self.open_checkpoint(input_file_path, target_language, special_requirements, context)
+        try:
+            collected = self.collect_document(input_file_path, engine, context)
+            # 所有位置放入同一个并发翻译队列，总耗时取决于最慢的一段而不是各阶段之和
+            with context.phase("translate"):
+                translated_texts = self.translate_collected_texts(
+                    collected["texts"], target_language, special_requirements, api_key, context
+                )
+            self.write_document(collected, translated_texts, input_file_path, output_file_path, context)
+        except Exception:
+            documents_translated_total.inc(engine, "failed")
+            raise
+        documents_translated_total.inc(engine, "succeeded")
+        self.close_checkpoint(context)
+
+    async def translate_document_async(self, input_file_path, output_file_path, target_language, special_requirements, api_key, context=None, engine=None):
+        """
+        translate_document 的协程版本，ASGI 模式下直接在服务器的事件循环中执行
+        
+        调用翻译服务、解析和保存文档在线程中执行，批量翻译直接在事件循环中等待，
+        翻译期间不占用任何线程。参数与 translate_document 相同。
+        """
+        if await asyncio.to_thread(
+            self.translate_with_sidecar, input_file_path, output_file_path, target_language, api_key, context
+        ):
+            return
+        
+        engine = engine or Config.TRANSLATION_ENGINE
+        if context is None:
+            context = TranslationContext()
+        await asyncio.to_thread(self.open_checkpoint, input_file_path, target_language, special_requirements, context)
+        try:
+            collected = await asyncio.to_thread(self.collect_document, input_file_path, engine, context)
+            with context.phase("translate"):
+                translated_texts = await self.translate_collected_texts_async(
+                    collected["texts"], target_language, special_requirements, api_key, context
+                )
+            await asyncio.to_thread(
+                self.write_document, collected, translated_texts, input_file_path, output_file_path, context
+            )
+        except Exception:
+            documents_translated_total.inc(engine, "failed")
+            raise
+        documents_translated_total.inc(engine, "succeeded")
+        self.close_checkpoint(context)
+
+    def translate_with_sidecar(self, input_file_path, output_file_path, target_language, api_key, context=None):
+        """
+        按 Config.TRANSLATION_BACKEND 的设置尝试使用翻译服务翻译文档
+        
+        Returns:
+            翻译服务完成翻译时返回True，需要使用本地翻译方法时返回False
+        
+        Raises:
+            TRANSLATION_BACKEND 为 "sidecar" 时抛出翻译服务的错误
+        """
+        backend = Config.TRANSLATION_BACKEND if Config.TRANSLATION_BACKEND in TRANSLATION_BACKENDS else "auto"
+        # 翻译服务不支持增量翻译，有上一版译文时直接使用本地翻译方法
+        incremental = context is not None and context.reference is not None
+        if backend == "sidecar" or (backend == "auto" and not incremental and sidecar_breaker.allow()):
+            try:
+                # 调用翻译API
+                output_path = self.call_translation_api(input_file_path, target_language,api_key)
+                sidecar_breaker.record_success()
+                
+                # 保存翻译后的文档
+                shutil.copyfile(output_path, output_file_path)
+                shutil.rmtree(os.path.dirname(output_path), ignore_errors=True)
+                documents_translated_total.inc("sidecar", "succeeded")
+                return True
+            except Exception as e:
+                logger.warning("翻译文档时出错: %s", e)
+                documents_translated_total.inc("sidecar", "failed")
+                if isinstance(e, SidecarUnavailableError):
+                    sidecar_breaker.record_failure()
+                if backend == "sidecar":
+                    raise
+                # 如果API调用失败，回退到使用本地翻译方法
+                logger.info("尝试使用本地翻译方法...")
+        elif backend == "auto" and not incremental:
+            logger.info("翻译服务已熔断，直接使用本地翻译方法...")
+            if context is not None:
+                context.incr("sidecar_skipped")
+        return False
+
+    @staticmethod
+    def open_checkpoint(input_file_path, target_language, special_requirements, context):
+        """同一个文档以相同参数重新翻译时，从检查点恢复已完成的段落"""
+        if Config.CHECKPOINT_ENABLED and context.checkpoint is None:
+            context.checkpoint = translation_checkpoints.open(input_file_path, target_language, special_requirements)
+            if context.checkpoint is not None and context.checkpoint.resumed:
+                logger.info("从检查点恢复 %d 段已完成的译文", context.checkpoint.resumed)
+                context.incr("checkpoint_resumed", context.checkpoint.resumed)
+
+    @staticmethod
+    def close_checkpoint(context):
+        """所有段落都翻译成功后才删除检查点，有段落失败时留给下一次重试"""
+        if context.checkpoint is not None and not context.summary().get("untranslated"):
+            context.checkpoint.discard()
+
+
+async def translate_document_request(request_data, team_id=None):
+    """
+    文档翻译接口的 ASGI 处理逻辑，直接在服务器的事件循环中执行，WSGI 模式下由 DocumentTranslationResource 处理
+    
+    Args:
+        request_data: 请求数据
+        team_id: 发起请求的团队，用于上游请求的公平排队
+    
+    Returns:
+        (响应数据, HTTP状态码)
+    """
+    resource = DocumentTranslationResource(api=api)
+    try:
+        params, error = resource.parse_request(request_data)
+        if error is not None:
+            return error
+        if params.pop("async"):
+            return resource.submit_job(params, team_id)
+        
+        context = TranslationContext(team_id=team_id)
+        try:
+            return await resource.run_translation_async(**params, context=context), 200
+        except DocumentDownloadError as e:
+            return {
+                "file_url": "",
+                "success": False,
+                "message": str(e)
+            }, 400
+    except Exception as e:
+        logger.exception("文档翻译请求处理失败")
+        return {
+            "file_url": "",
+            "success": False,
+            "message": str(e)
+        }, 500
+
+
+@ai_translation_ns.route("/batch")
+class BatchTranslationResource(Resource):
+    @ai_translation_ns.doc("translate_documents_batch")
+    @ai_translation_ns.expect(batch_translation_request)
+    def post(self):
+        """
+        批量翻译多个Word文档
+        
+        立即返回任务ID，文档在后台并发下载，所有文档的文本合并后一起翻译，
+        多个文档中重复的内容只翻译一次。
+        每个文档完成后，结果立即出现在 /ai_translation/jobs/<job_id> 的 documents 中。
+        """
+        return self.submit(request.json, current_team_id())
+
+    def submit(self, json_data, team_id=None):
+        """
+        校验批量翻译请求并提交到后台任务队列，WSGI 和 ASGI 模式共用
+        
         Returns:
-            A Document object with the translated content
+            (响应数据, HTTP状态码)
         """
         try:
-            # 调用翻译API
-            output_path = self.call_translation_api(input_file_path, target_language,api_key)
+            if not json_data:
+                return {"success": False, "message": "无效的请求数据。必须提供有效的JSON数据。"}, 400
+            
+            api_key = json_data.get('api_key')
+            if not api_key:
+                return {"success": False, "message": "Missing API key"}, 401
+            
+            target_language = json_data.get('target_language')
+            special_requirements = json_data.get('special_requirements', '')
+            document_urls = json_data.get('document_urls')
+            engine = json_data.get('engine') or Config.TRANSLATION_ENGINE
+            
+            if not target_language:
+                return {"success": False, "message": "Missing target language parameter"}, 400
+            if not document_urls or not isinstance(document_urls, list):
+                return {"success": False, "message": "未提供文档CDN URL列表"}, 400
+            if len(document_urls) > Config.BATCH_MAX_DOCUMENTS:
+                return {"success": False, "message": f"单次最多翻译 {Config.BATCH_MAX_DOCUMENTS} 个文档"}, 400
+            if engine not in TRANSLATION_ENGINES:
+                return {
+                    "success": False,
+                    "message": f"不支持的翻译引擎: {engine}，可选值为 {', '.join(TRANSLATION_ENGINES)}"
+                }, 400
+            for document_url in document_urls:
+                if not isinstance(document_url, str) or not urllib.parse.urlparse(document_url).path.endswith('.docx'):
+                    return {"success": False, "message": f"只支持 .docx 格式的文件: {document_url}"}, 400
             
-            # 返回翻译后的文档
-            return Document(output_path)
+            job = translation_jobs.submit(
+                self.run_batch_translation, document_urls, target_language, special_requirements, api_key, engine,
+                team_id=team_id
+            )
+            if job is None:
+                return {"success": False, "message": "翻译任务队列已满，请稍后重试"}, 429
+            return {
+                "job_id": job.job_id,
+                "status": job.status,
+                "status_url": f"/ai_translation/jobs/{job.job_id}",
+                "document_count": len(document_urls),
+                "success": True,
+                "message": f"批量翻译任务已提交，可通过 /ai_translation/jobs/{job.job_id} 查询进度"
+            }, 202
         except Exception as e:
-            print(f"翻译文档时出错: {str(e)}")
-            # 如果API调用失败，回退到使用本地翻译方法
-            print("尝试使用本地翻译方法...")
-            return self.process_docx(input_file_path, target_language, special_requirements, api_key)
+            logger.exception("批量翻译请求处理失败")
+            return {"success": False, "message": str(e)}, 500
+
+    def run_batch_translation(self, document_urls, target_language, special_requirements, api_key, engine=None, context=None):
+        """
+        批量翻译多个文档
+        
+        使用本地翻译引擎时分三步：并发下载每个文档并收集分段；把所有文档的分段合并后只调用一次
+        batch_translate_texts，重复的内容只翻译一次，打包请求也可以跨文档凑满；最后并发地把译文
+        插入各个文档并保存，每个文档保存完成后立即记录到任务结果中。
+        TRANSLATION_BACKEND 为 "sidecar" 时翻译服务只能逐个文档处理，仍然按文档并发调用。
+        
+        Args:
+            document_urls: 文档CDN URL列表
+            target_language: 目标语言
+            special_requirements: 特殊翻译要求
+            api_key: API密钥
+            engine: 本地翻译引擎，"docx" 或 "stream"
+            context: 整个批次的翻译上下文
+        
+        Returns:
+            按输入顺序排列的每个文档的结果
+        """
+        if context is None:
+            context = TranslationContext()
+        translator = DocumentTranslationResource(api=api)
+        engine = engine or Config.TRANSLATION_ENGINE
+        documents = [None] * len(document_urls)
+        batch_span = current_span.get()
+        
+        def finish_document(index, document_url, document_context, result=None, error=None):
+            # 每个文档完成后立即记录，任务查询接口可以看到已经完成的文档
+            if error is not None:
+                logger.warning(
+                    "批量翻译中的文档 %s 失败: %s", document_url, error,
+                    exc_info=None if isinstance(error, DocumentDownloadError) else error
+                )
+                result = {
+                    "file_url": "",
+                    "stats": document_context.summary(),
+                    "success": False,
+                    "message": str(error)
+                }
+            result = dict(result, index=index, document_url=document_url)
+            documents[index] = result
+            context.add_document(result)
+        
+        workers = max(1, min(Config.BATCH_DOCUMENT_CONCURRENCY, len(document_urls)))
+        backend = Config.TRANSLATION_BACKEND if Config.TRANSLATION_BACKEND in TRANSLATION_BACKENDS else "auto"
+        if backend == "sidecar":
+            def translate_one(index, document_url):
+                document_context = TranslationContext(parent=context)
+                with tracer.activate(batch_span), tracer.span("document", index=index, document_url=document_url) as span:
+                    try:
+                        result = translator.run_translation(
+                            document_url, target_language, special_requirements, api_key, engine, context=document_context
+                        )
+                    except Exception as e:
+                        span.set_error(e)
+                        finish_document(index, document_url, document_context, error=e)
+                        return
+                finish_document(index, document_url, document_context, result)
+            
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-document") as executor:
+                list(executor.map(translate_one, range(len(document_urls)), document_urls))
+            return self.batch_result(documents, context)
+        
+        def prepare_one(index, document_url):
+            # 下载文档并收集需要翻译的分段
+            document_context = TranslationContext(parent=context)
+            temp_dir = tempfile.mkdtemp()
+            prepared = {
+                "index": index,
+                "document_url": document_url,
+                "context": document_context,
+                "temp_dir": temp_dir,
+                "input_path": os.path.join(temp_dir, f"input_{uuid.uuid4()}.docx"),
+                "output_path": os.path.join(temp_dir, f"output_{uuid.uuid4()}.docx"),
+            }
+            with tracer.activate(batch_span), tracer.span("document", index=index, document_url=document_url) as span:
+                try:
+                    with document_context.phase("download"):
+                        translator.download_file(document_url, prepared["input_path"])
+                    if Config.CHECKPOINT_ENABLED:
+                        document_context.checkpoint = translation_checkpoints.open(
+                            prepared["input_path"], target_language, special_requirements
+                        )
+                    prepared["collected"] = translator.collect_document(prepared["input_path"], engine, document_context)
+                    prepared["texts"] = prepared["collected"]["texts"]
+                except Exception as e:
+                    span.set_error(e)
+                    documents_translated_total.inc(engine, "failed")
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    finish_document(index, document_url, document_context, error=e)
+                    return None
+            return prepared
+        
+        def save_one(prepared, translated_texts):
+            # 插入译文、保存并复制到文件托管目录
+            index, document_url = prepared["index"], prepared["document_url"]
+            document_context = prepared["context"]
+            with tracer.activate(batch_span), tracer.span("document_save", index=index, document_url=document_url) as span:
+                try:
+                    translator.write_document(
+                        prepared["collected"], translated_texts, prepared["input_path"], prepared["output_path"], document_context
+                    )
+                    result = translator.publish_document(document_url, prepared["output_path"], target_language, document_context)
+                except Exception as e:
+                    span.set_error(e)
+                    documents_translated_total.inc(engine, "failed")
+                    finish_document(index, document_url, document_context, error=e)
+                    return
+                finally:
+                    shutil.rmtree(prepared["temp_dir"], ignore_errors=True)
+            documents_translated_total.inc(engine, "succeeded")
+            # 所有段落都翻译成功后才删除检查点，有段落失败时留给下一次重试
+            untranslated = sum(1 for translated_text in translated_texts if not translated_text.strip())
+            checkpoint = document_context.checkpoint
+            if checkpoint is not None:
+                for text, translated_text in zip(prepared["texts"], translated_texts):
+                    checkpoint.record(text, translated_text)
+                if not untranslated:
+                    checkpoint.discard()
+            # 分段统计汇总在批次的上下文中，这里补上每个文档自己的分段数
+            finish_document(index, document_url, document_context, dict(
+                result, segments=len(translated_texts), untranslated_segments=untranslated
+            ))
+        
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-document") as executor:
+            prepared_documents = [
+                prepared for prepared in executor.map(prepare_one, range(len(document_urls)), document_urls)
+                if prepared is not None
+            ]
+            
+            # 检查点中已经完成的段落直接使用，其余分段合并到一次批量翻译中
+            all_translated = []
+            union_texts = []
+            for prepared in prepared_documents:
+                checkpoint = prepared["context"].checkpoint
+                translated_texts = [None] * len(prepared["texts"])
+                if checkpoint is not None:
+                    for i, text in enumerate(prepared["texts"]):
+                        translated_texts[i] = checkpoint.get(text)
+                    resumed = sum(1 for translated_text in translated_texts if translated_text is not None)
+                    if resumed:
+                        prepared["context"].incr("checkpoint_hits", resumed)
+                union_texts.extend(text for text, translated_text in zip(prepared["texts"], translated_texts) if translated_text is None)
+                all_translated.append(translated_texts)
+            logger.info(
+                "批量翻译 %d 个文档，合并翻译 %d 段文本", len(prepared_documents), len(union_texts),
+                extra={"documents": len(prepared_documents), "segments": len(union_texts)}
+            )
+            
+            # 重试预算按文档数累加，与逐个文档翻译时相同
+            context.retry_budget = Config.RETRY_BUDGET_PER_DOCUMENT * max(1, len(prepared_documents))
+            try:
+                with context.phase("translate"):
+                    union_results = async_runtime.run(translator.batch_translate_texts(
+                        union_texts, target_language, special_requirements, api_key, context
+                    )) if union_texts else []
+            except Exception as e:
+                for prepared in prepared_documents:
+                    shutil.rmtree(prepared["temp_dir"], ignore_errors=True)
+                    documents_translated_total.inc(engine, "failed")
+                    finish_document(prepared["index"], prepared["document_url"], prepared["context"], error=e)
+                return self.batch_result(documents, context)
+            
+            remaining = iter(union_results)
+            for translated_texts in all_translated:
+                for i, translated_text in enumerate(translated_texts):
+                    if translated_text is None:
+                        translated_texts[i] = next(remaining)
+            list(executor.map(save_one, prepared_documents, all_translated))
+        
+        return self.batch_result(documents, context)
+    
+    @staticmethod
+    def batch_result(documents, context):
+        """汇总批量翻译中每个文档的结果"""
+        failed = sum(1 for document in documents if not document["success"])
+        return {
+            "documents": documents,
+            "succeeded": len(documents) - failed,
+            "failed": failed,
+            "stats": context.summary(),
+            "success": failed == 0,
+            "message": f"批量翻译完成：成功 {len(documents) - failed} 个，失败 {failed} 个"
+        }
+
+
+async def batch_translation_request(request_data, team_id=None):
+    """
+    批量翻译接口的 ASGI 处理逻辑：只做校验和提交任务，直接在服务器的事件循环中执行
+    
+    Returns:
+        (响应数据, HTTP状态码)
+    """
+    return BatchTranslationResource(api=api).submit(request_data, team_id)
+
+
+@ai_translation_ns.route("/jobs")
+class TranslationJobListResource(Resource):
+    @ai_translation_ns.doc("list_translation_jobs")
+    def get(self):
+        """
+        查询异步翻译任务队列的概况
+        """
+        return {"jobs": translation_jobs.summary(), "success": True}
+
+
+@ai_translation_ns.route("/scheduler")
+class UpstreamSchedulerResource(Resource):
+    @ai_translation_ns.doc("get_upstream_scheduler")
+    def get(self):
+        """
+        查询上游请求调度器的状态：当前并发数、各团队的排队深度和等待时间
+        """
+        return {"scheduler": upstream_scheduler.summary(), "success": True}
+
+
+@ai_translation_ns.route("/jobs/<string:job_id>")
+class TranslationJobResource(Resource):
+    @ai_translation_ns.doc("get_translation_job")
+    def get(self, job_id):
+        """
+        查询异步翻译任务的状态、进度、预计剩余时间和最终的文件URL
+        """
+        job = translation_jobs.get(job_id)
+        if job is None:
+            return {
+                "job_id": job_id,
+                "file_url": "",
+                "success": False,
+                "message": "翻译任务不存在或已过期"
+            }, 404
+        return job.to_dict()
 
 
 # 定义OCR请求模型
@@ -1048,7 +5065,9 @@ class OCRExtractResource(Resource):
             # req.IsWords = False        # 是否返回单字信息
             
             # 调用通用印刷体识别接口
-            response = client.GeneralBasicOCR(req)
+            with observe_upstream("tencent_ocr") as call:
+                response = client.GeneralBasicOCR(req)
+                call["status"] = 200
             
             # 提取文本和位置信息
             result = []
@@ -1064,14 +5083,16 @@ class OCRExtractResource(Resource):
                     } if hasattr(item, 'Polygon') and item.Polygon else None
                 })
             
-            # 打印详细结果信息（调试用）
-            print(f"OCR识别结果: {response.to_json_string()}")
+            # 详细结果只在调试级别输出，避免每次调用都写出完整的响应
+            logger.info("OCR识别完成: %d 段文本", len(text_items), extra={"text_count": len(text_items)})
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("OCR识别结果: %s", response.to_json_string())
             
             # 返回纯文本结果
             return "\n".join(text_items)
         
         except Exception as e:
-            print(f"OCR错误: {str(e)}")
+            logger.warning("OCR错误: %s", e)
             return f"OCR错误: {str(e)}"
 
 
@@ -1102,7 +5123,11 @@ document_translation_request = ai_translation_ns.model(
         "document_url": fields.String(required=True, description="文档CDN URL，必须是.docx格式文件"),
         "api_key": fields.String(required=True, description="Cursor AI API密钥"),
         "target_language": fields.String(required=True, description="目标翻译语言"),
-        "special_requirements": fields.String(required=False, description="特殊翻译要求")
+        "special_requirements": fields.String(required=False, description="特殊翻译要求"),
+        "async": fields.Boolean(required=False, description="是否以异步任务方式执行，立即返回任务ID"),
+        "engine": fields.String(required=False, enum=["docx", "stream"], description="本地翻译引擎：docx（python-docx）或 stream（流式OOXML，适合大文档）"),
+        "previous_document_url": fields.String(required=False, description="上一版文档的CDN URL，与上一版译文一起传入时只翻译修改过的内容"),
+        "previous_translated_url": fields.String(required=False, description="上一版文档的双语译文CDN URL")
     },
 )
 
@@ -1194,64 +5219,74 @@ class DifyQAResource(Resource):
         }
     )
     def post(self):
-        
-            # 获取请求数据
-            data = request.json
-            api_key = data.get("api_key")
-            if not api_key:
-                return {"error": "Missing Dify API key"}, 401
-                
-            question = data.get("question")
-            conversation_id = data.get("conversation_id", "")
+        return async_runtime.run(dify_qa(request.json, current_team_id()))
 
 
-            if not question:
-                return {"error": "问题不能为空"}, 400
-            
-            # 准备请求头
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-            user_id = "user-" + str(hash(datetime.now().strftime('%Y%m%d%H%M%S')))
-            # 准备请求数据
-            data = {
-                "inputs": {},
-                "query": question,
-                "user": user_id,
-                "response_mode": "blocking",
-            }
+async def dify_qa(data, team_id=None):
+    """
+    调用 Dify 问答接口，WSGI 模式下由 DifyQAResource 提交到共享事件循环，ASGI 模式下直接在服务器的事件循环中执行
+    
+    Args:
+        data: 请求数据
+        team_id: 发起请求的团队，用于上游请求的公平排队
+    
+    Returns:
+        (响应数据, HTTP状态码)
+    """
+    # 获取请求数据
+    if not isinstance(data, dict):
+        return {"error": "无效的请求数据"}, 400
+    api_key = data.get("api_key")
+    if not api_key:
+        return {"error": "Missing Dify API key"}, 401
+        
+    question = data.get("question")
+    conversation_id = data.get("conversation_id", "")
 
-            # 仅当会话ID存在且有效时才添加到请求中
-            import re
-            uuid_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.I)
-            if conversation_id and (isinstance(conversation_id, str) and uuid_pattern.match(conversation_id)):
-                data["conversation_id"] = conversation_id
-            
-            try:
-                # 发送请求到Dify API
-                response = requests.post(
-                    f"{DIFY_API_URL}/chat-messages",
-                    headers=headers,
-                    json=data
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    answer = result.get("answer", "抱歉，我无法回答这个问题。")
-                    
-                    # 返回结果
-                    return {
-                        "answer": answer,
-                        "conversation_id": result.get("conversation_id", ""),
-                        "success": True
-                    }
-                else:
-                    return {"error": f"API请求失败: {response.text}"}, response.status_code
+    if not question:
+        return {"error": "问题不能为空"}, 400
+    
+    # 准备请求头
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    user_id = "user-" + str(hash(datetime.now().strftime('%Y%m%d%H%M%S')))
+    # 准备请求数据
+    data = {
+        "inputs": {},
+        "query": question,
+        "user": user_id,
+        "response_mode": "blocking",
+    }
+
+    # 仅当会话ID存在且有效时才添加到请求中
+    uuid_pattern = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.I)
+    if conversation_id and (isinstance(conversation_id, str) and uuid_pattern.match(conversation_id)):
+        data["conversation_id"] = conversation_id
+    
+    try:
+        # 通过共享连接池发送请求到Dify API
+        status_code, response_text = await post_json_async(
+            f"{DIFY_API_URL}/chat-messages", headers, data, api_key=api_key, team_id=team_id, backend="dify"
+        )
+        
+        if status_code == 200:
+            result = json.loads(response_text)
+            answer = result.get("answer", "抱歉，我无法回答这个问题。")
             
-            except Exception as e:
-                error_msg = f"发生错误: {str(e)}"
-                return {"answer": error_msg, "success": False}
+            # 返回结果
+            return {
+                "answer": answer,
+                "conversation_id": result.get("conversation_id", ""),
+                "success": True
+            }, 200
+        else:
+            return {"error": f"API请求失败: {response_text}"}, status_code
+    
+    except Exception as e:
+        error_msg = f"发生错误: {str(e)}"
+        return {"answer": error_msg, "success": False}, 200
 
 
 def extract_formulas_from_response(response_text: str) -> List[str]:
@@ -1387,6 +5422,13 @@ def call_gpt_o3(json_data, api_key) -> Dict[str, Any]:
     """
     调用 GPT-o3 API 来进行数据推理
     """
+    return async_runtime.run(call_gpt_o3_async(json_data, api_key, current_team_id()))
+
+
+async def call_gpt_o3_async(json_data, api_key, team_id=None) -> Dict[str, Any]:
+    """
+    调用 GPT-o3 API 来进行数据推理，在共享事件循环中执行
+    """
     try:
         # 构建 API 请求
         headers = {
@@ -1448,14 +5490,16 @@ def call_gpt_o3(json_data, api_key) -> Dict[str, Any]:
         }
         
         # 发送 API 请求
-        print(f"正在发送数据分析请求...")
-        response = requests.post(f"{API_URL}/v1/chat/completions", headers=headers, json=data, timeout=30)
+        logger.info("正在发送数据分析请求...")
+        status_code, response_text = await post_json_async(
+            f"{API_URL}/v1/chat/completions", headers, data, timeout=30, api_key=api_key, team_id=team_id, backend="inference"
+        )
         
         # 处理 API 响应
-        if response.status_code == 200 and "choices" in response.json():
-            gpt_response = response.json()
+        gpt_response = json.loads(response_text) if status_code == 200 else {}
+        if status_code == 200 and "choices" in gpt_response:
             ai_message = gpt_response["choices"][0]["message"]["content"]
-            print(f"分析成功!")
+            logger.info("分析成功!")
             
             # 从响应中提取Python代码
             python_code = ""
@@ -1474,8 +5518,8 @@ def call_gpt_o3(json_data, api_key) -> Dict[str, Any]:
             }
         else:
             # API 调用失败
-            error_msg = f"分析失败: {response.status_code} - {response.text}"
-            print(error_msg)
+            error_msg = f"分析失败: {status_code} - {response_text}"
+            logger.warning(error_msg)
             return {
                 "input_data": json_data,
                 "error": error_msg
@@ -1483,8 +5527,7 @@ def call_gpt_o3(json_data, api_key) -> Dict[str, Any]:
     except Exception as e:
         # 异常处理
         error_msg = f"API 调用异常: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        logger.exception(error_msg)
         return {
             "input_data": json_data,
             "error": error_msg
@@ -1629,31 +5672,323 @@ class InferenceO3Resource(Resource):
         """
         分析数据点之间的规律和可换算的公式
         """
-        try:
-            # 获取请求数据
-            request_data = request.json
-            if request_data is None:
-                return {"message": "Invalid request data. Must provide valid JSON data."}, 400
-            
-            # 获取API密钥
-            api_key = request_data.get('api_key')
-            if not api_key:
-                return {"error": "Missing API key"}, 401
-                
-            # 如果请求中有 data 字段，则使用该字段的值
-            # 否则直接使用整个请求数据
-            json_data = request_data.get('data', request_data)
-            
-            # 直接将 JSON 数据发送给 GPT-o3 进行分析
-            result = call_gpt_o3(json_data, api_key)
-            
-            return result
+        return async_runtime.run(infer_data_patterns(request.json, current_team_id()))
+
+
+async def infer_data_patterns(request_data, team_id=None):
+    """
+    数据规律推理接口的处理逻辑，WSGI 和 ASGI 模式共用
+    
+    Args:
+        request_data: 请求数据
+        team_id: 发起请求的团队，用于上游请求的公平排队
+    
+    Returns:
+        (响应数据, HTTP状态码)
+    """
+    try:
+        # 获取请求数据
+        if request_data is None:
+            return {"message": "Invalid request data. Must provide valid JSON data."}, 400
+        
+        # 获取API密钥
+        api_key = request_data.get('api_key')
+        if not api_key:
+            return {"error": "Missing API key"}, 401
             
+        # 如果请求中有 data 字段，则使用该字段的值
+        # 否则直接使用整个请求数据
+        json_data = request_data.get('data', request_data)
+        
+        # 直接将 JSON 数据发送给 GPT-o3 进行分析
+        result = await call_gpt_o3_async(json_data, api_key, team_id)
+        
+        return result, 200
+        
+    except Exception as e:
+        # 异常处理
+        logger.exception("数据分析请求处理失败")
+        return {"message": f"Error analyzing data: {str(e)}"}, 500
+
+
+
+class AsgiRequestBody(io.RawIOBase):
+    """
+    WSGI 的 wsgi.input：桥接线程读取请求体时才从 ASGI 服务器接收下一段，不在内存中缓存整个请求体
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._pending = b""
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending and not self._finished:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message["type"] != "http.request":
+                # 客户端已断开，按请求体结束处理，Werkzeug 会根据 Content-Length 判断请求体不完整
+                self._finished = True
+                break
+            self._pending = message.get("body", b"")
+            self._finished = not message.get("more_body", False)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+class AsgiApp:
+    """
+    ASGI 服务入口（SERVER_MODE=asgi，由 uvicorn 运行）
+
+    Dify、推理、文档翻译等工具接口直接作为协程在服务器的事件循环中执行，
+    等待上游响应时不占用线程，一个进程可以同时等待成千上万个上游请求；共享事件循环也改用服务器的事件循环。
+    其余接口（文件上传和下载、Swagger 等）通过有界线程池交给 Flask 应用处理，
+    请求体和响应体都按片段在线程和事件循环之间传递；/metrics 等控制接口使用单独的线程池，
+    不会排在耗时的同步请求后面。
+    """
+
+    def __init__(self, wsgi_app, native_routes, wsgi_threads, control_paths=(), control_threads=1):
+        self.wsgi_app = wsgi_app
+        # {(请求方法, 路径): 返回 (响应数据, HTTP状态码) 的协程函数}
+        self.native_routes = native_routes
+        self.control_paths = set(control_paths)
+        self._executor = ThreadPoolExecutor(max_workers=wsgi_threads, thread_name_prefix="wsgi-bridge")
+        self._control_executor = ThreadPoolExecutor(max_workers=control_threads, thread_name_prefix="wsgi-control")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            await send({"type": "websocket.close", "code": 1000})
+            return
+        handler = self.native_routes.get((scope["method"], scope["path"]))
+        if handler is None:
+            await self.call_wsgi(scope, receive, send)
+        else:
+            await self.call_native(handler, scope, await self.read_body(receive), send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                async_runtime.adopt(asyncio.get_running_loop())
+                logger.info("ASGI 服务已启动，上游请求在服务器的事件循环中执行")
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.drain()
+                await async_runtime.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def drain(self):
+        """等待线程池中正在处理和排队的同步请求完成，最多等待 Config.ASGI_SHUTDOWN_TIMEOUT 秒"""
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                asyncio.to_thread(self._executor.shutdown, wait=True),
+                asyncio.to_thread(self._control_executor.shutdown, wait=True),
+            ), Config.ASGI_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("等待同步请求完成超时（%s 秒），不再等待", Config.ASGI_SHUTDOWN_TIMEOUT)
+
+    @staticmethod
+    async def read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    @staticmethod
+    async def send_response(send, status, headers, chunks):
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        for chunk in chunks:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def call_native(self, handler, scope, body, send):
+        """在服务器的事件循环中直接执行工具接口，记录与 Flask 请求相同的指标和追踪span"""
+        started_at = time.perf_counter()
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        span = tracer.start_span(
+            f"{scope['method']} {scope['path']}", tags=workflow_tags(headers), **{"http.method": scope["method"]}
+        )
+        token = current_span.set(span)
+        try:
+            try:
+                data = json.loads(body) if body else None
+            except ValueError:
+                payload, status = {"message": "无效的JSON数据"}, 400
+            else:
+                payload, status = await handler(data, headers.get(WORKFLOW_HEADERS["team_id"]))
+        except Exception as e:
+            logger.exception("请求处理失败: %s", scope["path"])
+            span.set_error(e)
+            payload, status = {"message": str(e)}, 500
+        finally:
+            current_span.reset(token)
+        span.set_attribute("http.status_code", status)
+        tracer.finish(span)
+
+        namespace = http_namespace(scope["path"])
+        http_requests_total.inc(namespace, scope["method"], str(status))
+        http_request_duration_seconds.observe(time.perf_counter() - started_at, namespace)
+        content = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        await self.send_response(send, status, [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(content)).encode()),
+            (b"x-trace-id", span.trace_id.encode()),
+        ], [content])
+
+    @staticmethod
+    def build_environ(scope, stream):
+        """根据 ASGI scope 构造 WSGI environ，stream 为请求体的 wsgi.input"""
+        server_name, server_port = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": stream,
+            # 请求体在客户端发送完毕时结束，没有 Content-Length 的分块请求也可以读取
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            # send_file 默认每次读取 8KB，每个片段都要在线程和事件循环之间传递一次，这里改为按较大的块读取
+            "wsgi.file_wrapper": lambda file, buffer_size=8192: FileWrapper(file, max(buffer_size, Config.ASGI_FILE_CHUNK_SIZE)),
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[name] = value
+            else:
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def run_wsgi(self, environ, responses, loop, closed):
+        """
+        在线程池中执行 Flask 应用，响应头和每个响应体片段产生后立即放入 responses 队列
+
+        队列有界，客户端接收慢时桥接线程在这里等待；closed 被设置（客户端断开）后不再继续生成响应。
+        队列中依次是 ("start", 状态行, 响应头)、若干 ("body", 片段)，出错时是 ("error", 异常)，最后是 None。
+        """
+        response = {}
+
+        def put(item):
+            if not closed.is_set():
+                asyncio.run_coroutine_threadsafe(responses.put(item), loop).result()
+
+        def send_headers():
+            # 按 WSGI 的约定，第一个非空片段产生（或响应结束）时才发送响应头
+            if "status" in response and not response.get("sent"):
+                response["sent"] = True
+                put(("start", response["status"], response["headers"]))
+
+        def write(chunk):
+            send_headers()
+            if chunk:
+                put(("body", chunk))
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get("sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"], response["headers"] = status, headers
+            return write
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    if closed.is_set():
+                        break
+                    if chunk:
+                        write(chunk)
+                send_headers()
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
         except Exception as e:
-            # 异常处理
-            traceback.print_exc()
-            return {"message": f"Error analyzing data: {str(e)}"}, 500
+            put(("error", e))
+        finally:
+            put(None)
+
+    async def call_wsgi(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        environ = self.build_environ(scope, io.BufferedReader(AsgiRequestBody(receive, loop)))
+        executor = self._control_executor if scope["path"] in self.control_paths else self._executor
+        responses = asyncio.Queue(maxsize=8)
+        closed = threading.Event()
+        loop.run_in_executor(executor, self.run_wsgi, environ, responses, loop, closed)
+        started = False
+        try:
+            while True:
+                item = await responses.get()
+                if item is None:
+                    break
+                if item[0] == "start":
+                    _, status, headers = item
+                    await send({
+                        "type": "http.response.start",
+                        "status": int(status.split(" ", 1)[0]),
+                        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+                    })
+                    started = True
+                elif item[0] == "body":
+                    await send({"type": "http.response.body", "body": item[1], "more_body": True})
+                elif started:
+                    # 响应头已经发出，只能中断连接
+                    raise item[1]
+                else:
+                    logger.error("请求处理失败: %s", scope["path"], exc_info=item[1])
+                    await send({
+                        "type": "http.response.start", "status": 500,
+                        "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+                    })
+                    await send({"type": "http.response.body", "body": b"Internal Server Error", "more_body": True})
+                    started = True
+            await send({"type": "http.response.body", "body": b""})
+        except BaseException:
+            # 停止生成响应，并取出队列中的片段，让等待放入队列的桥接线程继续执行到结束
+            closed.set()
+            while not responses.empty():
+                responses.get_nowait()
+            raise
+
+
+asgi_app = AsgiApp(app, {
+    ("POST", "/dify/qa"): dify_qa,
+    ("POST", "/inference/o3"): infer_data_patterns,
+    ("POST", "/ai_translation/document"): translate_document_request,
+    ("POST", "/ai_translation/batch"): batch_translation_request,
+}, Config.ASGI_WSGI_THREADS, ("/metrics", "/manifest.json"), Config.ASGI_CONTROL_THREADS)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5001)
+    if Config.SERVER_MODE == "asgi":
+        try:
+            import uvicorn
+        except ImportError:
+            logger.error("ASGI 模式需要安装 uvicorn: pip install uvicorn")
+            raise SystemExit(1)
+        uvicorn.run(asgi_app, host="0.0.0.0", port=5001, lifespan="on", access_log=False)
+    else:
+        app.run(host="0.0.0.0", port=5001)